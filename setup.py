@@ -20,10 +20,13 @@ def get_macros():
     else:
         return [("HAVE_MEMALIGN", None)]
  
+# gthread is only needed by glib < 2.32, newer versions provide an empty
+# compatibility library
 wagomu_ext = Extension('_wagomu', ['wagomu.cpp',
                                   'wagomu.i'],
                        include_dirs = pkg_config('glib-2.0','--cflags'),
-                       libraries = pkg_config('glib-2.0','--libs'),
+                       libraries = pkg_config('glib-2.0','--libs') +
+                                   pkg_config('gthread-2.0','--libs'),
                        define_macros=get_macros(),
                        library_dirs = pkg_config('glib-2.0','--libs'),
                        swig_opts=['-c++'])
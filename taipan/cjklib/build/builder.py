@@ -65,6 +65,11 @@ __all__ = [
     "CEDICTWordIndexBuilder", "CEDICTGRBuilder", "CEDICTGRWordIndexBuilder",
     "TimestampedCEDICTFormatBuilder", "HanDeDictBuilder",
     "HanDeDictWordIndexBuilder", "CFDICTBuilder", "CFDICTWordIndexBuilder",
+    "TranslationIndexBuilder", "EDICTTranslationIndexBuilder",
+    "CEDICTTranslationIndexBuilder", "CEDICTGRTranslationIndexBuilder",
+    "HanDeDictTranslationIndexBuilder", "CFDICTTranslationIndexBuilder",
+    "ReadingIndexBuilder", "CEDICTReadingIndexBuilder",
+    "HanDeDictReadingIndexBuilder", "CFDICTReadingIndexBuilder",
     "SimpleWenlinFormatBuilder"
     ]
 
@@ -86,7 +91,7 @@ from cjklib import characterlookup
 from cjklib import exception
 from cjklib.build import warn
 from cjklib.util import (UnicodeCSVFileIterator, CollationString, CollationText,
-    deprecated, fromCodepoint, getCharacterList)
+    deprecated, fromCodepoint, getCharacterList, getWordTokens)
 
 # pylint: disable-msg=E1101
 #  member variables are set by setattr()
@@ -3507,6 +3512,93 @@ class WordIndexBuilder(EntryGeneratorBuilder):
         return WordIndexBuilder.WordEntryGenerator(entries).generator()
 
 
+class TranslationIndexBuilder(EntryGeneratorBuilder):
+    """
+    Builds a translation token index for a given dictionary.
+
+    The index is an inverted index mapping every lower case word (token) found
+    in a translation to the headwords of the entries including it, see
+    :func:`~cjklib.util.getWordTokens`. Translation search strategies use it
+    to look up candidate entries instead of scanning the whole dictionary
+    with ``LIKE``.
+
+    As for :class:`~cjklib.build.builder.WordIndexBuilder` entries are
+    referenced by their headword, as dictionary tables don't have a portable
+    row id.
+    """
+    COLUMNS = ['Token', 'Headword']
+    PRIMARY_KEYS = ['Token', 'Headword']
+    COLUMN_TYPES = {'Token': String(255), 'Headword': String(255)}
+
+    TABLE_SOURCE = None
+    """Dictionary source"""
+    HEADWORD_SOURCE = 'Headword'
+    """Source of headword"""
+
+    def getGenerator(self):
+        table = self.db.tables[self.TABLE_SOURCE]
+        headwordColumn = table.c[self.HEADWORD_SOURCE]
+        entries = self.db.selectRows(
+            select([headwordColumn, table.c.Translation]).order_by(
+                headwordColumn))
+
+        # entries are ordered by headword, so only remember the tokens of the
+        #   current one to prevent double entries
+        currentHeadword = None
+        seenTokens = set()
+        for headword, translation in entries:
+            if headword != currentHeadword:
+                currentHeadword = headword
+                seenTokens = set()
+            for token in getWordTokens(translation):
+                if token not in seenTokens:
+                    seenTokens.add(token)
+                    yield {'Token': token, 'Headword': headword}
+
+
+class ReadingIndexBuilder(EntryGeneratorBuilder):
+    """
+    Builds a toneless reading index for a given dictionary.
+
+    Every distinct reading of the dictionary is stored together with its plain
+    form, its entities without tones in lower case separated by a single
+    space, e.g. ``'xi an'`` for ``'Xi1 an1'``. Reading search strategies use
+    it to look up readings with missing tonal information by equality or
+    prefix instead of expanding them into ``LIKE`` patterns.
+    """
+    COLUMNS = ['PlainReading', 'Reading']
+    PRIMARY_KEYS = ['PlainReading', 'Reading']
+    COLUMN_TYPES = {'PlainReading': String(255), 'Reading': String(255)}
+
+    TABLE_SOURCE = None
+    """Dictionary source"""
+    READING = 'Pinyin'
+    """Reading of the dictionary"""
+    READING_OPTIONS = {'toneMarkType': 'numbers', 'yVowel': 'u:'}
+    """Options for reading of dictionary entries"""
+
+    def getGenerator(self):
+        from cjklib.reading import ReadingFactory
+
+        readingFactory = ReadingFactory(dbConnectInst=self.db)
+        table = self.db.tables[self.TABLE_SOURCE]
+        readings = self.db.selectScalars(
+            select([table.c.Reading], distinct=True))
+
+        for reading in readings:
+            plainEntities = []
+            for entity in reading.split():
+                try:
+                    entity, _ = readingFactory.splitEntityTone(entity,
+                        self.READING, **self.READING_OPTIONS)
+                except (exception.InvalidEntityError,
+                    exception.UnsupportedError):
+                    pass
+                plainEntities.append(entity.lower())
+
+            yield {'PlainReading': ' '.join(plainEntities), 'Reading': reading}
+
+
 class VersionBuilder(EntryGeneratorBuilder):
     """Table for keeping track of version of installed dictionary."""
     PROVIDES = 'Version'
@@ -3537,6 +3629,15 @@ class EDICTWordIndexBuilder(WordIndexBuilder):
     TABLE_SOURCE = 'EDICT'
 
 
+class EDICTTranslationIndexBuilder(TranslationIndexBuilder):
+    """
+    Builds the translation token index of the EDICT dictionary.
+    """
+    PROVIDES = 'EDICT_Tokens'
+    DEPENDS = ['EDICT']
+    TABLE_SOURCE = 'EDICT'
+
+
 class CEDICTFormatBuilder(EDICTFormatBuilder):
     """
     Provides an abstract class for loading CEDICT formatted dictionaries.
@@ -3581,6 +3682,25 @@ class CEDICTWordIndexBuilder(WordIndexBuilder):
     HEADWORD_SOURCE = 'HeadwordTraditional'
 
 
+class CEDICTTranslationIndexBuilder(TranslationIndexBuilder):
+    """
+    Builds the translation token index of the CEDICT dictionary.
+    """
+    PROVIDES = 'CEDICT_Tokens'
+    DEPENDS = ['CEDICT']
+    TABLE_SOURCE = 'CEDICT'
+    HEADWORD_SOURCE = 'HeadwordTraditional'
+
+
+class CEDICTReadingIndexBuilder(ReadingIndexBuilder):
+    """
+    Builds the toneless reading index of the CEDICT dictionary.
+    """
+    PROVIDES = 'CEDICT_Readings'
+    DEPENDS = ['CEDICT', 'PinyinSyllables']
+    TABLE_SOURCE = 'CEDICT'
+
+
 class CEDICTGRBuilder(EDICTFormatBuilder):
     """
     Builds the CEDICT-GR dictionary.
@@ -3604,6 +3724,16 @@ class CEDICTGRWordIndexBuilder(WordIndexBuilder):
     HEADWORD_SOURCE = 'Headword'
 
 
+class CEDICTGRTranslationIndexBuilder(TranslationIndexBuilder):
+    """
+    Builds the translation token index of the CEDICT-GR dictionary.
+    """
+    PROVIDES = 'CEDICTGR_Tokens'
+    DEPENDS = ['CEDICTGR']
+    TABLE_SOURCE = 'CEDICTGR'
+    HEADWORD_SOURCE = 'Headword'
+
+
 class TimestampedCEDICTFormatBuilder(CEDICTFormatBuilder):
     """
     Shared functionality for dictionaries whose file names include a timestamp.
@@ -3701,6 +3831,25 @@ class HanDeDictWordIndexBuilder(WordIndexBuilder):
     HEADWORD_SOURCE = 'HeadwordTraditional'
 
 
+class HanDeDictTranslationIndexBuilder(TranslationIndexBuilder):
+    """
+    Builds the translation token index of the HanDeDict dictionary.
+    """
+    PROVIDES = 'HanDeDict_Tokens'
+    DEPENDS = ['HanDeDict']
+    TABLE_SOURCE = 'HanDeDict'
+    HEADWORD_SOURCE = 'HeadwordTraditional'
+
+
+class HanDeDictReadingIndexBuilder(ReadingIndexBuilder):
+    """
+    Builds the toneless reading index of the HanDeDict dictionary.
+    """
+    PROVIDES = 'HanDeDict_Readings'
+    DEPENDS = ['HanDeDict', 'PinyinSyllables']
+    TABLE_SOURCE = 'HanDeDict'
+
+
 class CFDICTBuilder(TimestampedCEDICTFormatBuilder):
     """
     Builds the CFDICT dictionary.
@@ -3723,6 +3872,25 @@ class CFDICTWordIndexBuilder(WordIndexBuilder):
     HEADWORD_SOURCE = 'HeadwordTraditional'
 
 
+class CFDICTTranslationIndexBuilder(TranslationIndexBuilder):
+    """
+    Builds the translation token index of the CFDICT dictionary.
+    """
+    PROVIDES = 'CFDICT_Tokens'
+    DEPENDS = ['CFDICT']
+    TABLE_SOURCE = 'CFDICT'
+    HEADWORD_SOURCE = 'HeadwordTraditional'
+
+
+class CFDICTReadingIndexBuilder(ReadingIndexBuilder):
+    """
+    Builds the toneless reading index of the CFDICT dictionary.
+    """
+    PROVIDES = 'CFDICT_Readings'
+    DEPENDS = ['CFDICT', 'PinyinSyllables']
+    TABLE_SOURCE = 'CFDICT'
+
+
 class SimpleWenlinFormatBuilder(EntryGeneratorBuilder):
     """
     Provides a builder for loading dictionaries following the Wenlin format::
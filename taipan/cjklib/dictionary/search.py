@@ -18,6 +18,12 @@
 """
 Search strategies for dictionaries.
 
+Translation search strategies make use of a translation token index if the
+dictionary provides one (see
+:class:`~cjklib.build.builder.TranslationIndexBuilder`), as does
+:class:`~cjklib.dictionary.search.TonelessWildcardReading` with a toneless
+reading index (see :class:`~cjklib.build.builder.ReadingIndexBuilder`).
+
 .. todo::
     * Impl: Allow simple FTS3 searching as build support is already provided.
 """
@@ -40,12 +46,12 @@ __all__ = [
 import re
 import string
 
-from sqlalchemy.sql import and_, or_
+from sqlalchemy.sql import and_, or_, select
 from sqlalchemy.sql.expression import func
 
 from cjklib.reading import ReadingFactory
 from cjklib import exception
-from cjklib.util import toCodepoint, getCharacterList
+from cjklib.util import toCodepoint, getCharacterList, getWordTokens
 
 # Python 2.4 support
 if not hasattr(__builtins__, 'any'):
@@ -410,12 +416,102 @@ class Wildcard(Exact, _WildcardBase):
 #{ Translation search strategies
 
 class SingleEntryTranslation(Exact):
-    """Basic translation search strategy."""
-    def __init__(self, caseInsensitive=True, **options):
+    """
+    Basic translation search strategy.
+
+    If the dictionary provides a translation token index, only entries whose
+    translation includes every word of the search string are selected through
+    the index, instead of matching the whole table with ``LIKE``.
+    """
+    def __init__(self, caseInsensitive=True, useIndex=True, **options):
+        """
+        :type caseInsensitive: bool
+        :param caseInsensitive: if ``True``, latin characters match their
+            upper/lower case equivalent, if ``False`` case sensitive matches
+            will be made
+        :type useIndex: bool
+        :param useIndex: if ``True`` the dictionary's translation token index
+            is used if available (default)
+        """
         Exact.__init__(self, caseInsensitive=caseInsensitive,
             **options)
+        self._useIndex = useIndex
+        self._indexTable = None
+
+    def setDictionaryInstance(self, dictInstance):
+        super(SingleEntryTranslation, self).setDictionaryInstance(
+            dictInstance)
+
+        indexName = getattr(dictInstance, 'TRANSLATION_INDEX', None)
+        if self._useIndex and indexName and dictInstance.db.hasTable(indexName):
+            self._indexTable = dictInstance.db.tables[indexName]
+            dictionaryTable = dictInstance.db.tables[
+                dictInstance.DICTIONARY_TABLE]
+            self._indexedColumn = dictionaryTable.c[
+                dictInstance.TRANSLATION_INDEX_HEADWORD]
+        else:
+            self._indexTable = None
+
+    def _getIndexClause(self, entities):
+        """
+        Returns a clause selecting entries by the translation token index, or
+        ``None`` if no index is available or the search string has no
+        indexable words.
+
+        Words of the search string are looked up exactly, or by prefix if
+        followed by a wildcard. Words preceded by a wildcard are skipped.
+
+        :type entities: list
+        :param entities: search string split into strings and wildcards
+        """
+        if self._indexTable is None:
+            return None
+
+        # join plain strings and remember if they border on a wildcard
+        parts = [[u'', False, False]]
+        for entity in entities:
+            if isinstance(entity, basestring):
+                parts[-1][0] += entity
+            else:
+                parts[-1][2] = True
+                parts.append([u'', True, False])
+
+        tokens = set()
+        for string, wildcardBefore, wildcardAfter in parts:
+            words = getWordTokens(string)
+            if not words:
+                continue
+            string = string.lower()
+            prefix = wildcardAfter and string.endswith(words[-1])
+            if wildcardBefore and string.startswith(words[0]):
+                words = words[1:]
+            for idx, word in enumerate(words):
+                tokens.add((word, prefix and idx == len(words) - 1))
+
+        if not tokens:
+            return None
+
+        # look up longer words first, they are likely to be rarer
+        clauses = []
+        tokenColumn = self._indexTable.c.Token
+        for token, prefix in sorted(tokens,
+            key=lambda (token, prefix): (prefix, -len(token))):
+            if prefix:
+                upperBound = token[:-1] + unichr(ord(token[-1]) + 1)
+                tokenClause = and_(tokenColumn >= token,
+                    tokenColumn < upperBound)
+            else:
+                tokenClause = tokenColumn == token
+            clauses.append(self._indexedColumn.in_(
+                select([self._indexTable.c.Headword], tokenClause)))
+
+        return and_(*clauses)
 
     def getWhereClause(self, column, searchStr):
+        indexClause = self._getIndexClause([searchStr])
+        if indexClause is not None:
+            return indexClause
+
         return self._contains(column, _escapeWildcards(searchStr), escape='\\')
 
     def getMatchFunction(self, searchStr):
@@ -439,6 +535,11 @@ class WildcardTranslation(SingleEntryTranslation,
             + '/')
 
     def getWhereClause(self, column, searchStr):
+        indexClause = self._getIndexClause(
+            self._parseWildcardString(searchStr))
+        if indexClause is not None:
+            return indexClause
+
         wildcardSearchStr = self._getWildcardQuery(searchStr)
         return self._contains(column, wildcardSearchStr)
 
@@ -501,6 +602,11 @@ class SimpleWildcardTranslation(SingleEntryTranslation,
         return self._compileRegex('/' + regexStr + '/')
 
     def getWhereClause(self, column, searchStr):
+        indexClause = self._getIndexClause(
+            self._parseWildcardString(searchStr))
+        if indexClause is not None:
+            return indexClause
+
         wildcardSearchStr = self._getWildcardQuery(searchStr)
         return self._contains(column, wildcardSearchStr)
 
@@ -549,6 +655,11 @@ class CEDICTWildcardTranslation(SingleEntryTranslation,
         return self._compileRegex('/' + regexStr + '[/,]')
 
     def getWhereClause(self, column, searchStr):
+        indexClause = self._getIndexClause(
+            self._parseWildcardString(searchStr))
+        if indexClause is not None:
+            return indexClause
+
         wildcardSearchStr = self._getWildcardQuery(searchStr)
         return self._contains(column, wildcardSearchStr)
 
@@ -602,6 +713,11 @@ class HanDeDictWildcardTranslation(SingleEntryTranslation,
             + '[/\,\;\.\?\!]')
 
     def getWhereClause(self, column, searchStr):
+        indexClause = self._getIndexClause(
+            self._parseWildcardString(searchStr))
+        if indexClause is not None:
+            return indexClause
+
         wildcardSearchStr = self._getWildcardQuery(searchStr)
         return self._contains(column, wildcardSearchStr)
 
@@ -1020,13 +1136,24 @@ class TonelessWildcardReading(SimpleReading,
         [u'zh\xec d\u01ceo', u'zh\xed d\u01ceo', u'zh\u01d0 d\u01ceo',\
  u'zh\xed d\xe0o', u'zh\xed d\u01ceo', u'zh\u012b dao']
 
+    If the dictionary provides a toneless reading index, readings are looked
+    up by their plain form, exactly or by prefix if followed by a non-reading
+    entity or wildcard.
+
     .. todo::
         * Impl: Support readings with toneless base forms but without support
           for missing tone
     """
-    def __init__(self, **options):
+    def __init__(self, useIndex=True, **options):
+        """
+        :type useIndex: bool
+        :param useIndex: if ``True`` the dictionary's toneless reading index
+            is used if available (default)
+        """
         SimpleReading.__init__(self, **options)
         _TonelessReadingWildcardBase.__init__(self, **options)
+        self._useIndex = useIndex
+        self._indexTable = None
 
     def setDictionaryInstance(self, dictInstance):
         super(TonelessWildcardReading,
@@ -1035,6 +1162,12 @@ class TonelessWildcardReading(SimpleReading,
             raise ValueError(
                 "Dictionary's reading not supported for toneless searching")
 
+        indexName = getattr(dictInstance, 'READING_INDEX', None)
+        if self._useIndex and indexName and dictInstance.db.hasTable(indexName):
+            self._indexTable = dictInstance.db.tables[indexName]
+        else:
+            self._indexTable = None
+
     def _hasTonlessSupport(self):
         """
         Checks if the dictionary's reading has tonal support and can be searched
@@ -1050,7 +1183,49 @@ class TonelessWildcardReading(SimpleReading,
                 self._dictInstance.READING,
                 **self._dictInstance.READING_OPTIONS))
 
+    def _getIndexClause(self, column, searchStr, **options):
+        """
+        Returns a clause selecting readings by the toneless reading index, or
+        ``None`` if no index is available or a decomposition of the search
+        string doesn't start with a reading entity.
+        """
+        if self._indexTable is None:
+            return None
+
+        plainColumn = self._indexTable.c.PlainReading
+        clauses = []
+        for entities in self._getPlainForms(searchStr, **options):
+            plainEntities = []
+            prefix = False
+            for entity in entities:
+                if isinstance(entity, basestring) or entity[1] is None:
+                    # non-reading entity or wildcard, look up the preceding
+                    #   entities only
+                    prefix = True
+                    break
+                plainEntities.append(entity[1].lower())
+
+            if not plainEntities:
+                return None
+
+            plainReading = ' '.join(plainEntities)
+            if prefix:
+                upperBound = (plainReading[:-1]
+                    + unichr(ord(plainReading[-1]) + 1))
+                plainClause = and_(plainColumn >= plainReading,
+                    plainColumn < upperBound)
+            else:
+                plainClause = plainColumn == plainReading
+            clauses.append(plainClause)
+
+        return column.in_(select([self._indexTable.c.Reading],
+            or_(*clauses)))
+
     def getWhereClause(self, column, searchStr, **options):
+        indexClause = self._getIndexClause(column, searchStr, **options)
+        if indexClause is not None:
+            return indexClause
+
         if self._hasWildcardForms(searchStr, **options):
             queries = self._getWildcardQuery(searchStr, **options)
             return or_(*[self._like(column, query) for query in queries])
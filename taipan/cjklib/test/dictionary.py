@@ -449,3 +449,283 @@ class WildcardParameterTest(ParameterTest, unittest.TestCase):
         'translationSearchStrategy': searchstrategy.SimpleWildcardTranslation(
             singleCharacter='?', multipleCharacters='*'),
         }
+
+
+class IndexResultTest(DictionaryResultTest):
+    """Base class for testing of dictionary return values with an index."""
+    INDEX = None
+    """Attribute of the dictionary class giving the index table."""
+
+    def setUp(self):
+        DictionaryResultTest.setUp(self)
+
+        self.indexTable = getattr(self.dictionaryClass, self.INDEX)
+        self.builder.build(self.indexTable)
+        assert self.db.mainHasTable(self.indexTable)
+
+        self.dictionary = self.dictionaryClass(dbConnectInst=self.db,
+            **self.DICTIONARY_OPTIONS)
+
+    def tearDown(self):
+        self.builder.remove(self.indexTable)
+        assert not self.db.mainHasTable(self.indexTable)
+        DictionaryResultTest.tearDown(self)
+
+
+class TranslationIndexResultTest(IndexResultTest):
+    """
+    Base class for testing of dictionary return values with a translation
+    token index.
+    """
+    INDEX = 'TRANSLATION_INDEX'
+
+    def testIndexUsed(self):
+        """Test if the translation search strategy uses the index."""
+        whereClause = self.dictionary.translationSearchStrategy.getWhereClause(
+            self.db.tables[self.table].c.Translation, u'term')
+        self.assert_(self.indexTable in unicode(whereClause))
+
+
+class EDICTTranslationIndexResultTest(TranslationIndexResultTest,
+    EDICTDictionaryResultTest):
+    pass
+
+
+class CEDICTTranslationIndexResultTest(TranslationIndexResultTest,
+    CEDICTDictionaryResultTest):
+    ACCESS_RESULTS = CEDICTDictionaryResultTest.ACCESS_RESULTS + [
+        ('getForTranslation', (), [(u'to direct', [1, 4])]),
+        ('getForTranslation', (), [(u'To Direct', [1, 4])]),
+        ('getForTranslation', (), [(u'to gui%', [4, 5])]),
+        ('getForTranslation', (), [(u'guid%', [4])]),
+        ('getForTranslation', (), [(u'%tuition', [4])]),
+        ('getForTranslation', (), [(u'%capital of%', [9])]),
+        ('getForTranslation', (), [(u'to_direct', [1, 4])]),
+        ('getForTranslation', (), [(u'direct', [])]),
+        ]
+
+
+class HanDeDictTranslationIndexResultTest(TranslationIndexResultTest,
+    HanDeDictDictionaryResultTest):
+    pass
+
+
+class EscapeTranslationIndexParameterTest(TranslationIndexResultTest,
+    EscapeParameterTest):
+    pass
+
+
+class WildcardTranslationIndexParameterTest(TranslationIndexResultTest,
+    WildcardParameterTest):
+    pass
+
+
+class ReadingIndexResultTest(IndexResultTest):
+    """
+    Base class for testing of dictionary return values with a toneless reading
+    index.
+    """
+    INDEX = 'READING_INDEX'
+
+    def testIndexUsed(self):
+        """Test if the reading search strategy uses the index."""
+        whereClause = self.dictionary.readingSearchStrategy.getWhereClause(
+            self.db.tables[self.table].c.Reading, u'zhidao',
+            toneMarkType='numbers')
+        self.assert_(self.indexTable in unicode(whereClause))
+
+
+class CEDICTReadingIndexResultTest(ReadingIndexResultTest,
+    CEDICTDictionaryResultTest):
+    ACCESS_RESULTS = CEDICTDictionaryResultTest.ACCESS_RESULTS + [
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'zhi dao', [0, 1, 2, 3, 4, 5])]),
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'zhi2 dao', [1, 2, 3])]),
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'zhi%', [0, 1, 2, 3, 4, 5, 6, 7])]),
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'zhi3dao%', [4, 6, 7])]),
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'zhidao_', [7])]),
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'%dao', [0, 1, 2, 3, 4, 5])]),
+        ('getForReading', (('toneMarkType', 'numbers'),),
+            [(u'Xi an', [9])]),
+        ('getForReading', (), [(u'zhídào', [3])]),
+        ]
+
+
+class HanDeDictReadingIndexResultTest(ReadingIndexResultTest,
+    HanDeDictDictionaryResultTest):
+    pass
+
+
+class CEDICTCacheResultTest(CEDICTDictionaryResultTest):
+    """Tests dictionary return values served from the result cache."""
+    DICTIONARY_OPTIONS = {'cacheSize': 2}
+
+    def setUp(self):
+        CEDICTDictionaryResultTest.setUp(self)
+
+        self.builder.build('Version')
+        self.versionTable = self.db.tables['Version']
+
+    def tearDown(self):
+        self.builder.remove('Version')
+        CEDICTDictionaryResultTest.tearDown(self)
+
+    def _setVersion(self, releaseDate):
+        self.db.execute(self.versionTable.delete())
+        self.db.execute(self.versionTable.insert().values(
+            TableName=self.table, ReleaseDate=releaseDate))
+
+    def testCacheStatistics(self):
+        """Test if repeated searches are counted as cache hits."""
+        results = list(self.dictionary.getForHeadword(u'知道'))
+        self.assertEquals(list(self.dictionary.getForHeadword(u'知道')),
+            results)
+        self.assertEquals(list(self.dictionary.getForHeadword(u'知道', limit=1)),
+            results[:1])
+
+        statistics = self.dictionary.getCacheStatistics()
+        self.assertEquals(statistics['hits'], 1)
+        self.assertEquals(statistics['misses'], 2)
+        self.assertEquals(statistics['size'], 2)
+        self.assertEquals(statistics['maxSize'], 2)
+        self.assertAlmostEquals(statistics['hitRate'], 1. / 3)
+
+    def testCacheEviction(self):
+        """Test if the least recently used search is dropped from the cache."""
+        self.dictionary.getForHeadword(u'知道')
+        self.dictionary.getForTranslation(u'to guide')
+        self.dictionary.getForHeadword(u'知道')
+        self.dictionary.getFor(u'to guide')
+        self.dictionary.getForHeadword(u'知道')
+        self.dictionary.getForTranslation(u'to guide')
+
+        statistics = self.dictionary.getCacheStatistics()
+        self.assertEquals(statistics['hits'], 2)
+        self.assertEquals(statistics['misses'], 4)
+        self.assertEquals(statistics['size'], 2)
+
+    def testCachePages(self):
+        """Test if pages are served from the cache."""
+        entries, cursor = self.dictionary.getPage(u'%', pageSize=2,
+            toneMarkType='numbers')
+        self.assertEquals(self.dictionary.getPage(u'%', pageSize=2,
+            toneMarkType='numbers'), (entries, cursor))
+        self.dictionary.getPage(u'%', cursor, pageSize=2,
+            toneMarkType='numbers')
+        self.dictionary.getPage(u'%', pageSize=2, sources=['Headword'],
+            toneMarkType='numbers')
+
+        statistics = self.dictionary.getCacheStatistics()
+        self.assertEquals(statistics['hits'], 1)
+        self.assertEquals(statistics['misses'], 3)
+
+    def testCacheVersionInterval(self):
+        """Test if the version is not read again for every search."""
+        from datetime import datetime
+        self._setVersion(datetime(2010, 1, 1))
+        self.dictionary.getForHeadword(u'知道')
+
+        self._setVersion(datetime(2010, 2, 1))
+        self.dictionary.getForHeadword(u'知道')
+
+        statistics = self.dictionary.getCacheStatistics()
+        self.assertEquals(statistics['hits'], 1)
+        self.assertEquals(statistics['misses'], 1)
+
+    def testCacheInvalidation(self):
+        """Test if cached searches are dropped on a new dictionary version."""
+        from datetime import datetime
+        self.dictionary.CACHE_VERSION_INTERVAL = 0
+        self._setVersion(datetime(2010, 1, 1))
+        self.dictionary.getForHeadword(u'知道')
+        self.dictionary.getForHeadword(u'知道')
+
+        self._setVersion(datetime(2010, 2, 1))
+        self.dictionary.getForHeadword(u'知道')
+
+        statistics = self.dictionary.getCacheStatistics()
+        self.assertEquals(statistics['hits'], 1)
+        self.assertEquals(statistics['misses'], 2)
+        self.assertEquals(statistics['size'], 1)
+
+
+class CEDICTPageTest(CEDICTDictionaryResultTest):
+    """Tests paginated dictionary searches."""
+    PAGE_REQUESTS = [u'zhi2 dao', u'to direct', u'%dao%', u'知道', u'xian',
+        u'%', u'to know', u'nothing']
+
+    SOURCE_METHODS = [('Headword', 'getForHeadword'),
+        ('Reading', 'getForReading'), ('Translation', 'getForTranslation')]
+
+    def _getAllPages(self, searchStr, pageSize, **options):
+        entries = []
+        cursor = None
+        while True:
+            page, cursor = self.dictionary.getPage(searchStr, cursor, pageSize,
+                **options)
+            self.assert_(len(page) <= pageSize)
+            entries.extend(page)
+            if cursor is None:
+                return entries
+
+    def testPages(self):
+        """Test if pages return the entries found by all sources once."""
+        for searchStr in self.PAGE_REQUESTS:
+            sourceEntries = []
+            for _, methodName in self.SOURCE_METHODS:
+                sourceEntries.append(set(getattr(self.dictionary, methodName)(
+                    searchStr, toneMarkType='numbers')))
+            targetEntries = set().union(*sourceEntries)
+
+            for pageSize in (1, 2, 3, 100):
+                entries = self._getAllPages(searchStr, pageSize,
+                    toneMarkType='numbers')
+                self.assertEquals(len(entries), len(set(entries)))
+                self.assertEquals(set(entries), targetEntries,
+                    "Mismatch for string %s and page size %d"
+                        % (repr(searchStr), pageSize))
+
+                # entries are grouped by source
+                start = 0
+                previousEntries = set()
+                for entrySet in sourceEntries:
+                    newEntries = entrySet - previousEntries
+                    self.assertEquals(
+                        set(entries[start:start + len(newEntries)]),
+                        newEntries)
+                    start += len(newEntries)
+                    previousEntries.update(newEntries)
+
+    def testSources(self):
+        """Test if only the given search sources are used."""
+        for source, methodName in self.SOURCE_METHODS:
+            for searchStr in self.PAGE_REQUESTS:
+                targetEntries = set(getattr(self.dictionary, methodName)(
+                    searchStr, toneMarkType='numbers'))
+                entries, cursor = self.dictionary.getPage(searchStr,
+                    pageSize=100, sources=[source], toneMarkType='numbers')
+                self.assertEquals(set(entries), targetEntries)
+                self.assertEquals(cursor, None)
+
+    def testCountEstimate(self):
+        """Test if the count estimate is not below the actual count."""
+        for searchStr in self.PAGE_REQUESTS:
+            entries = self._getAllPages(searchStr, 100, toneMarkType='numbers')
+            estimate = self.dictionary.getCountEstimate(searchStr,
+                toneMarkType='numbers')
+            self.assert_(estimate >= len(entries))
+
+    def testCountEstimateLimit(self):
+        """Test if the count estimate stops at the given limit."""
+        for searchStr in self.PAGE_REQUESTS:
+            estimate = self.dictionary.getCountEstimate(searchStr,
+                toneMarkType='numbers')
+            for limit in (1, 2, 100):
+                self.assertEquals(self.dictionary.getCountEstimate(searchStr,
+                    limit=limit, toneMarkType='numbers'),
+                    min(estimate, limit))
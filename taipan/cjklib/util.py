@@ -374,6 +374,24 @@ def crossDict(*args):
         ans = [joinDict(x, y) for x in ans for y in arg]
     return ans
 
+_wordRegex = re.compile(r'(?u)\w+')
+
+def getWordTokens(string):
+    """
+    Splits a string into lower case words, ignoring punctuation and white
+    space. Used for indexing and searching dictionary translations.
+
+    Example:
+        >>> getWordTokens(u'/(n) Tokyo (current capital of Japan)/(P)/')
+        [u'n', u'tokyo', u'current', u'capital', u'of', u'japan', u'p']
+
+    :type string: str
+    :param string: a string
+    :rtype: list of str
+    :return: list of words
+    """
+    return [word.lower() for word in _wordRegex.findall(string)]
+
 #{ Helper classes
 
 class CharacterRangeIterator(object):
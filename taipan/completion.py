@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Headword completion for the dictionary search box"""
+import os
+import bisect
+import heapq
+import cPickle
+
+class HeadwordIndex(object):
+    """Prefix index over the simplified and traditional headwords of a
+       dictionary, answering the first entries (in dictionary order) whose
+       headword starts with a given prefix without querying the database.
+
+       Headwords are kept in a sorted array, so the headwords starting with
+       a prefix are a contiguous range found by bisection. Short prefixes
+       match thousands of headwords, so the first entries of every prefix
+       matching more than SCAN_LIMIT headwords are computed beforehand.
+       Other prefixes only need to scan at most SCAN_LIMIT headwords."""
+
+    # maximum number of completions returned
+    MAX_COMPLETIONS = 20
+    # prefixes matching more headwords than that have precomputed results
+    SCAN_LIMIT = 256
+    # number of dictionary entries read at a time by iter_build()
+    BUILD_STEP = 2000
+    # increment whenever the persisted format changes
+    FORMAT_VERSION = 1
+
+    def __init__(self):
+        # (simplified, traditional, reading) of each entry, in dictionary
+        # order
+        self.entries = []
+        # sorted headwords and the entry of each of them
+        self._headwords = []
+        self._entry_ids = []
+        # entry ids of the prefixes matching many headwords
+        self._frequent = {}
+
+    @staticmethod
+    def get_key(dictionary):
+        """Identifies the dictionary data an index was built from, so that
+           the index is rebuilt whenever the dictionary is updated"""
+        return (HeadwordIndex.FORMAT_VERSION, dictionary.PROVIDES,
+                str(dictionary.version))
+
+    @classmethod
+    def load(cls, path, key):
+        """Load the index saved at path if it was built for key, otherwise
+           return None"""
+        try:
+            f = open(path, 'rb')
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+            return None
+
+        if not isinstance(data, dict) or data.get('key') != key:
+            return None
+
+        index = cls()
+        index.entries = data['entries']
+        index._headwords = data['headwords']
+        index._entry_ids = data['entry_ids']
+        index._frequent = data['frequent']
+        return index
+
+    def save(self, path, key):
+        """Save the index at path. The file is written next to path first,
+           so that a partly written index is never loaded."""
+        data = {'key': key,
+                'entries': self.entries,
+                'headwords': self._headwords,
+                'entry_ids': self._entry_ids,
+                'frequent': self._frequent}
+
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def iter_build(self, dictionary):
+        """Build the index from all the entries of dictionary. This is a
+           generator which yields after every BUILD_STEP entries, so that
+           the caller can build the index piecewise, e.g. from idle
+           callbacks."""
+        seen = set()
+        keys = []
+
+        for n, entry in enumerate(dictionary.getAll()):
+            item = (entry.HeadwordSimplified, entry.HeadwordTraditional,
+                    entry.Reading)
+            # entries only differing by their translation are completed
+            # once
+            if item not in seen:
+                seen.add(item)
+                entry_id = len(self.entries)
+                self.entries.append(item)
+                keys.append((entry.HeadwordSimplified, entry_id))
+                if entry.HeadwordTraditional != entry.HeadwordSimplified:
+                    keys.append((entry.HeadwordTraditional, entry_id))
+
+            if n % self.BUILD_STEP == self.BUILD_STEP - 1:
+                yield
+
+        keys.sort()
+        self._headwords = [headword for headword, entry_id in keys]
+        self._entry_ids = [entry_id for headword, entry_id in keys]
+        yield
+
+        self._frequent = {}
+        self._index_prefixes(0, len(self._headwords), 0)
+
+    def build(self, dictionary):
+        """Build the index from all the entries of dictionary at once"""
+        for step in self.iter_build(dictionary):
+            pass
+
+    def _index_prefixes(self, lo, hi, depth):
+        """Compute the results of the prefixes of headwords[lo:hi] which
+           are longer than depth and match more than SCAN_LIMIT headwords.
+           headwords[lo:hi] are the headwords which start with the same depth
+           characters."""
+        if hi - lo <= self.SCAN_LIMIT:
+            return
+
+        if depth > 0:
+            prefix = self._headwords[lo][:depth]
+            self._frequent[prefix] = heapq.nsmallest(self.MAX_COMPLETIONS,
+                set(self._entry_ids[lo:hi]))
+
+        # the headword equal to the prefix, if any, comes first
+        start = lo
+        while start < hi and len(self._headwords[start]) == depth:
+            start += 1
+
+        # ranges of headwords sharing one more character
+        while start < hi:
+            char = self._headwords[start][depth]
+            end = start + 1
+            while end < hi and self._headwords[end][depth] == char:
+                end += 1
+            self._index_prefixes(start, end, depth + 1)
+            start = end
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        """Return the (simplified, traditional, reading) of the first limit
+           entries, in dictionary order, with a headword starting with prefix.
+           limit can't be greater than MAX_COMPLETIONS."""
+        limit = min(limit, self.MAX_COMPLETIONS)
+
+        if not prefix:
+            return []
+
+        if prefix in self._frequent:
+            entry_ids = self._frequent[prefix][:limit]
+        else:
+            entry_ids = set()
+            i = bisect.bisect_left(self._headwords, prefix)
+            while (i < len(self._headwords)
+                   and self._headwords[i].startswith(prefix)):
+                entry_ids.add(self._entry_ids[i])
+                i += 1
+            entry_ids = heapq.nsmallest(limit, entry_ids)
+
+        return [self.entries[entry_id] for entry_id in entry_ids]
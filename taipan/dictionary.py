@@ -2,8 +2,8 @@
 # -*- coding: UTF-8 -*-
 import os
 import re
-import itertools
 import gtk
+import gobject
 import tegakigtk.recognizer
 import cjklib.dictionary
 import cjklib.dictionary.search
@@ -11,11 +11,23 @@ import cjklib.reading
 import cjklib.characterlookup
 import tagtable
 import sorder
+import completion
 
 MODULE_DIR = os.path.dirname(os.path.abspath( __file__ ))
 CJKLIB_OPTS = {'databaseUrl': 'sqlite:///' +
                os.path.join(MODULE_DIR, 'cjklib.db')}
 GLADE_FILE = os.path.join(MODULE_DIR, "taipan.glade")
+COMPLETION_FILE = os.path.join(MODULE_DIR, 'cjklib.completion')
+WILDCARDS = ('?', '*')
+# number of pages of search results kept in memory
+RESULT_CACHE_SIZE = 64
+# number of search results displayed at a time, further results are
+# displayed when scrolling to the end of the results
+RESULT_PAGE_SIZE = 30
+# display further results on scrolling instead of all results at once
+PAGED_RESULTS = True
+# number of search results above which the count isn't displayed exactly
+RESULT_COUNT_LIMIT = 1000
 
 class DictionaryWidget(gtk.Frame):
     """Custom widget encapsulating dictionary functions including handwriting
@@ -29,9 +41,14 @@ class DictionaryWidget(gtk.Frame):
         cjklib.dictionary.search.setDefaultWildcards(singleCharacter='?',
                                                      multipleCharacters='*')
         self.cjk = cjklib.characterlookup.CharacterLookup('T', **CJKLIB_OPTS)
-        self.dict = cjklib.dictionary.CEDICT(**CJKLIB_OPTS)
+        self.dict = cjklib.dictionary.CEDICT(cacheSize=RESULT_CACHE_SIZE,
+                                             **CJKLIB_OPTS)
         self.reading = cjklib.reading.ReadingFactory(**CJKLIB_OPTS)
 
+        # Headword completion index, None until loaded or built
+        self.completion = None
+        gobject.idle_add(self._load_completion().next)
+
         # Fire up GtkBuilder
         builder = gtk.Builder() 
         builder.add_from_file(GLADE_FILE)
@@ -77,6 +94,15 @@ class DictionaryWidget(gtk.Frame):
         result.connect("button_press_event", self._on_result_click)
         result.connect("populate_popup", self._on_result_popup)
 
+        # Display further results when scrolling to the end of the results
+        adj = builder.get_object("scw_result").get_vadjustment()
+        adj.connect("value-changed", self._on_result_scrolled)
+        adj.connect("changed", self._on_result_scrolled)
+        # Search whose results are displayed and the cursor of its next page
+        self.results_query = None
+        self.results_cursor = None
+        self.results_pending = False
+
         # Get expander and add recognizer to it
         self.recognizer = tegakigtk.recognizer.SimpleRecognizerWidget()
         self.recognizer.connect("commit-string", self._on_recognizer_commit)
@@ -93,26 +119,41 @@ class DictionaryWidget(gtk.Frame):
         if self.entry.get_text() == '':
             return
 
-        # search in characters (HeadWord)
-        res = self.dict.getForHeadword(unicode(self.entry.get_text()))
-
+        text = unicode(self.entry.get_text())
+        sources = ['Headword']
         # search in reading (Pinyin)
         if self.chk_reading.get_active():
-            res2 = self.dict.getForReading(unicode(self.entry.get_text()),
-                                           reading='Pinyin',
-                                           toneMarkType='numbers')
-            res = itertools.chain(res, res2)
-
+            sources.append('Reading')
         # search in translation
         if self.chk_translation.get_active():
-            res2 = self.dict.getForTranslation(unicode(self.entry.get_text()))
-            res = itertools.chain(res, res2)
+            sources.append('Translation')
 
-        # Display the result
+        # Display the first page of the result
         self.rbuf.set_text('\n')
-        num_results = 0
+        self.results_query = (text, sources)
+        self.results_cursor = None
+        num_results = self._add_result_page()
+
+        # Display an error message if the given expression was not found
+        if num_results == 0:
+            self.rbuf.set_text("\nExpression '" + text
+                               + "' was not found in the dictionary!")
+        elif not PAGED_RESULTS:
+            while self.results_cursor is not None:
+                self._add_result_page()
+        elif self.results_cursor is not None:
+            # Counting may take a while, so the first page is displayed first
+            gobject.idle_add(self._on_count_idle, self.results_query)
+
+    def _add_result_page(self):
+        """Display the next page of the result of the current search and
+           return the number of entries displayed"""
+        text, sources = self.results_query
+        res, self.results_cursor = self.dict.getPage(text,
+            self.results_cursor, RESULT_PAGE_SIZE, sources, reading='Pinyin',
+            toneMarkType='numbers')
+
         for r in res:
-            num_results += 1
             # Chinese
             self.rbuf.insert_with_tags_by_name(self.rbuf.get_end_iter(),
                                        r.HeadwordSimplified, "headword")
@@ -141,11 +182,42 @@ class DictionaryWidget(gtk.Frame):
             self._add_text_with_readings(extended)
             self.rbuf.insert(self.rbuf.get_end_iter(), "\n\n")
 
-        # Display an error message if the given expression was not found
-        if num_results == 0:
-            self.rbuf.set_text("\nExpression '" 
-                               + unicode(self.entry.get_text())
-                               + "' was not found in the dictionary!")
+        return len(res)
+
+    def _on_result_scrolled(self, adj):
+        """Display the next page of the result when less than a screen of
+           results is left below the visible ones"""
+        if self.results_cursor is None or self.results_pending:
+            return
+        if adj.get_value() + 2 * adj.get_page_size() >= adj.get_upper():
+            # The text view updates the adjustment once the page is laid out
+            self.results_pending = True
+            gobject.idle_add(self._on_result_page_idle)
+
+    def _on_result_page_idle(self):
+        """Display the next page of the result, if the search is still
+           displayed"""
+        self.results_pending = False
+        if self.results_cursor is not None:
+            self._add_result_page()
+        return False
+
+    def _on_count_idle(self, query):
+        """Display the estimated number of entries found by query, if its
+           result is still displayed"""
+        if query is self.results_query:
+            text, sources = query
+            # counting stops early for queries matching many entries
+            count = self.dict.getCountEstimate(text, sources,
+                                               limit=RESULT_COUNT_LIMIT + 1,
+                                               reading='Pinyin',
+                                               toneMarkType='numbers')
+            if count > RESULT_COUNT_LIMIT:
+                label = "More than %d entries\n" % RESULT_COUNT_LIMIT
+            else:
+                label = "About %d entries\n" % count
+            self.rbuf.insert(self.rbuf.get_start_iter(), label)
+        return False
 
     def _add_text_with_readings(self, text, tags=[]):
         """Find readings in the text and format them properly"""
@@ -200,21 +272,52 @@ class DictionaryWidget(gtk.Frame):
             self.search()
         return False
 
+    def _load_completion(self):
+        """Load the headword completion index, or build it from the
+           dictionary if it is missing or outdated. This is a generator run
+           from idle callbacks, so that the GUI stays responsive while the
+           index is built."""
+        key = completion.HeadwordIndex.get_key(self.dict)
+        index = completion.HeadwordIndex.load(COMPLETION_FILE, key)
+
+        if index is None:
+            index = completion.HeadwordIndex()
+            for step in index.iter_build(self.dict):
+                yield True
+            try:
+                index.save(COMPLETION_FILE, key)
+            except (IOError, OSError):
+                # the index will be built again next time
+                pass
+
+        self.completion = index
+        yield False
+
     def _on_entry_changed(self, widget):
         """Update popup completition whenever searchbox contents is changed"""
+        text = unicode(self.entry.get_text())
+
         # Wildcard search for empty string is evil
-        if len(self.entry.get_text()) == 0:
+        if len(text) == 0:
             return False
 
-        # Get matching items from dictionary and update the model
-        res = self.dict.getForHeadword(unicode(self.entry.get_text())+'*')
+        # Get matching items from the completion index, or from the
+        # dictionary when wildcards are used or the index isn't ready yet
+        limit = completion.HeadwordIndex.MAX_COMPLETIONS
+        if self.completion is not None and \
+           not [w for w in WILDCARDS if w in text]:
+            res = self.completion.complete(text, limit)
+        else:
+            res = [(r.HeadwordSimplified, r.HeadwordTraditional, r.Reading)
+                   for r in self.dict.getForHeadword(text + '*', limit=limit)]
+
         self.compl_model.clear()
-        for r in res:
-            s = r.HeadwordSimplified 
-            if r.HeadwordSimplified != r.HeadwordTraditional:
-                s += " (" + r.HeadwordTraditional + ")"
-            s += "  [" + r.Reading + "]"
-            self.compl_model.append([s, r.HeadwordSimplified])
+        for simplified, traditional, reading in res:
+            s = simplified
+            if simplified != traditional:
+                s += " (" + traditional + ")"
+            s += "  [" + reading + "]"
+            self.compl_model.append([s, simplified])
         return False
 
     def _on_compl_match_selected(self, completion, model, row):
@@ -26,7 +26,8 @@ try:
     import bz2 as bz2m
 except ImportError:
     pass
-from math import floor, atan, sin, cos, pi
+from math import floor, atan, sin, cos, pi, sqrt
+from array import array
 import os
 import hashlib
 
@@ -41,50 +42,17 @@ except ImportError:
 from tegaki.mathutils import euclidean_distance
 from tegaki.dictutils import SortedDict
 
-class Point(dict):
+class _PointBase(object):
     """
-    A point in a 2-dimensional space.
+    Methods shared by L{Point} and L{PointView}, which store the attributes
+    of a point differently.
     """
 
+    __slots__ = ()
+
     #: Attributes that a point can have.
     KEYS = ("x", "y", "pressure", "xtilt", "ytilt", "timestamp")
 
-    def __init__(self, x=None, y=None,
-                       pressure=None, xtilt=None, ytilt=None,
-                       timestamp=None):
-        """
-        @type x: int
-        @type y: int
-        @type pressure: float
-        @type xtilt: float
-        @type ytilt: float
-        @type timestamp: int
-        @param timestamp: ellapsed time since first point in milliseconds
-        """
-
-        dict.__init__(self)
-
-        self.x = x
-        self.y = y
-
-        self.pressure = pressure
-        self.xtilt = xtilt
-        self.ytilt = ytilt
-
-        self.timestamp = timestamp
-
-    def __getattr__(self, attr):
-        try:
-            return self[attr]
-        except KeyError:
-            raise AttributeError
-
-    def __setattr__(self, attr, value):
-        try:
-            self[attr] = value
-        except KeyError:
-            raise AttributeError
-
     def get_coordinates(self):
         """
         Return (x,y) coordinates.
@@ -155,7 +123,8 @@ class Point(dict):
         return "(%d %d)" % (self.x, self.y)
 
     def __eq__(self, othr):
-        if not othr.__class__.__name__ in ("Point", "PointProxy"):
+        if not othr.__class__.__name__ in ("Point", "PointProxy",
+                                           "PointView"):
             return False
 
         for key in self.KEYS:
@@ -167,6 +136,44 @@ class Point(dict):
     def __ne__(self, othr):
         return not(self == othr)
 
+    def __repr__(self):
+        return "<%s (%s, %s) (ref %d)>" % (self.__class__.__name__,
+                                           self.x, self.y, id(self))
+
+class Point(_PointBase, dict):
+    """
+    A point in a 2-dimensional space.
+    """
+
+    def __init__(self, x=None, y=None,
+                       pressure=None, xtilt=None, ytilt=None,
+                       timestamp=None):
+        """
+        @type x: int
+        @type y: int
+        @type pressure: float
+        @type xtilt: float
+        @type ytilt: float
+        @type timestamp: int
+        @param timestamp: ellapsed time since first point in milliseconds
+        """
+
+        dict.__init__(self, x=x, y=y,
+                      pressure=pressure, xtilt=xtilt, ytilt=ytilt,
+                      timestamp=timestamp)
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError
+
+    def __setattr__(self, attr, value):
+        try:
+            self[attr] = value
+        except KeyError:
+            raise AttributeError
+
     def copy_from(self, p):
         """
         Replace point with another point.
@@ -187,9 +194,6 @@ class Point(dict):
         """
         return Point(**self)
 
-    def __repr__(self):
-        return "<Point (%s, %s) (ref %d)>" % (self.x, self.y, id(self))
-
 class Stroke(list):
     """
     A sequence of L{Points<Point>}.
@@ -268,7 +272,8 @@ class Stroke(list):
         return "(" + "".join([p.to_sexp() for p in self]) + ")"
 
     def __eq__(self, othr):
-        if not othr.__class__.__name__ in ("Stroke", "StrokeProxy"):
+        if not othr.__class__.__name__ in ("Stroke", "StrokeProxy",
+                                           "CompactStroke"):
             return False
 
         if len(self) != len(othr):
@@ -301,10 +306,34 @@ class Stroke(list):
 
         @rtype: L{Stroke}
         """
-        c = Stroke()
+        c = self.__class__()
         c.copy_from(self)
         return c
 
+    def resize(self, xrate, yrate):
+        """
+        Scale stroke.
+
+        @type xrate: float
+        @param xrate: the x scaling factor
+        @type yrate: float
+        @param yrate: the y scaling factor
+        """
+        for point in self:
+            point.resize(xrate, yrate)
+
+    def move_rel(self, dx, dy):
+        """
+        Translate stroke.
+
+        @type dx: int
+        @param dx: relative distance from x
+        @type dy: int
+        @param yrate: relative distance from y
+        """
+        for point in self:
+            point.move_rel(dx, dy)
+
     def get_is_smoothed(self):
         """
         Return whether the stroke has been smoothed already or not.
@@ -473,6 +502,320 @@ class Stroke(list):
     def __repr__(self):
         return "<Stroke %d pts (ref %d)>" % (len(self), id(self))
 
+class PointView(_PointBase):
+    """
+    A point of a L{CompactStroke}.
+
+    A view behaves like a L{Point} but reads and writes the arrays of its
+    stroke. It refers to a position in the stroke, so it should not be used
+    anymore once points have been inserted or removed before it.
+    """
+
+    __slots__ = ("_stroke", "_index")
+
+    def __init__(self, stroke, index):
+        self._stroke = stroke
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._stroke._get_value(key, self._index)
+
+    def __setitem__(self, key, value):
+        self._stroke._set_value(key, self._index, value)
+
+    def keys(self):
+        return list(self.KEYS)
+
+    def copy_from(self, p):
+        """
+        Replace point with another point.
+
+        @type p: L{Point}
+        @param p: the point to copy from
+        """
+        for key in self.KEYS:
+            self[key] = _get_point_value(p, key)
+
+    def copy(self):
+        """
+        Return a copy of point.
+
+        @rtype: L{Point}
+        """
+        return Point(**dict([(key, self[key]) for key in self.KEYS]))
+
+def _point_view_property(key):
+    def getter(self):
+        return self._stroke._get_value(key, self._index)
+
+    def setter(self, value):
+        self._stroke._set_value(key, self._index, value)
+
+    return property(getter, setter)
+
+for _key in _PointBase.KEYS:
+    setattr(PointView, _key, _point_view_property(_key))
+
+def _get_point_value(point, key):
+    # Point objects may lack some keys
+    try:
+        return point[key]
+    except KeyError:
+        return None
+
+_NAN = float("nan")
+
+class CompactStroke(Stroke):
+    """
+    A L{Stroke} which stores the attributes of its points in parallel arrays.
+
+    Instead of one L{Point} per point, each attribute (x, y, timestamp...)
+    is kept in an array, which takes a fraction of the memory. Indexing or
+    iterating over the stroke returns L{PointView} objects, which can be used
+    like L{Point} objects. Transforms like L{resize} and L{move_rel} work on
+    the arrays directly.
+
+    x, y and timestamp are stored as integers. To use this storage mode for
+    all new writings, including those read from XML, set
+    L{Writing.STROKE_CLASS} to CompactStroke.
+    """
+
+    #: Attributes that are stored as integers.
+    INT_KEYS = ("x", "y", "timestamp")
+
+    def __init__(self):
+        Stroke.__init__(self)
+        self._n_points = 0
+        # an array of floats per attribute, NaN meaning None
+        # attributes which no point has don't have an array
+        self._arrays = {}
+
+    def _to_float(self, key, value):
+        if value is None:
+            return _NAN
+        elif key in self.INT_KEYS:
+            return float(int(value))
+        else:
+            return float(value)
+
+    def _get_value(self, key, i):
+        if not key in Point.KEYS:
+            raise KeyError, key
+
+        if not key in self._arrays:
+            return None
+
+        value = self._arrays[key][i]
+
+        if value != value: # NaN
+            return None
+        elif key in self.INT_KEYS:
+            return int(value)
+        else:
+            return value
+
+    def _set_value(self, key, i, value):
+        if not key in Point.KEYS:
+            raise KeyError, key
+
+        if not key in self._arrays:
+            if value is None:
+                return
+            self._arrays[key] = array("d", [_NAN]) * self._n_points
+
+        self._arrays[key][i] = self._to_float(key, value)
+
+    def _get_index(self, i):
+        if i < 0:
+            i += self._n_points
+        if i < 0 or i >= self._n_points:
+            raise IndexError, "stroke index out of range"
+        return i
+
+    def _take(self, indices):
+        for key in self._arrays.keys():
+            arr = self._arrays[key]
+            self._arrays[key] = array("d", [arr[i] for i in indices])
+        self._n_points = len(indices)
+
+    def __len__(self):
+        return self._n_points
+
+    def __iter__(self):
+        for i in xrange(self._n_points):
+            yield PointView(self, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [PointView(self, j) for j in range(*i.indices(len(self)))]
+        return PointView(self, self._get_index(i))
+
+    def __getslice__(self, i, j):
+        return self[slice(i, j)]
+
+    def __setitem__(self, i, point):
+        i = self._get_index(i)
+        for key in Point.KEYS:
+            self._set_value(key, i, _get_point_value(point, key))
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            n = len(range(*i.indices(len(self))))
+        else:
+            i = self._get_index(i)
+            n = 1
+
+        for arr in self._arrays.values():
+            del arr[i]
+
+        self._n_points -= n
+
+    def __delslice__(self, i, j):
+        del self[slice(i, j)]
+
+    def __reversed__(self):
+        for i in xrange(self._n_points - 1, -1, -1):
+            yield PointView(self, i)
+
+    def __contains__(self, point):
+        for p in self:
+            if p == point:
+                return True
+        return False
+
+    def insert(self, i, point):
+        i = max(min(i if i >= 0 else i + self._n_points, self._n_points), 0)
+
+        for key in Point.KEYS:
+            value = _get_point_value(point, key)
+            if key in self._arrays:
+                self._arrays[key].insert(i, self._to_float(key, value))
+            elif value is not None:
+                self._arrays[key] = array("d", [_NAN]) * self._n_points
+                self._arrays[key].insert(i, self._to_float(key, value))
+
+        self._n_points += 1
+
+    def append(self, point):
+        self.insert(self._n_points, point)
+
+    def extend(self, points):
+        for point in points:
+            self.append(point)
+
+    def pop(self, i=-1):
+        point = self[i].copy()
+        del self[i]
+        return point
+
+    def get_coordinates(self):
+        """
+        Return (x,y) coordinates.
+
+        @rtype: a list of tuples
+        """
+        if "x" in self._arrays and "y" in self._arrays:
+            try:
+                return zip(map(int, self._arrays["x"]),
+                           map(int, self._arrays["y"]))
+            except ValueError:
+                pass # some points don't have coordinates
+        return Stroke.get_coordinates(self)
+
+    def clear(self):
+        """
+        Remove all points from stroke.
+        """
+        self._arrays = {}
+        self._n_points = 0
+        self._is_smoothed = False
+
+    def copy_from(self, s):
+        """
+        Replace stroke with another stroke.
+
+        @type s: L{Stroke}
+        @param s: the stroke to copy from
+        """
+        is_smoothed = s.get_is_smoothed()
+
+        if not isinstance(s, CompactStroke):
+            # s may contain views of this stroke, e.g. when called from
+            # _upsample, so points are read before the stroke is cleared
+            c = CompactStroke()
+            for p in s:
+                c.append_point(p)
+            s = c
+
+        self.clear()
+        self._is_smoothed = is_smoothed
+
+        for key, arr in s._arrays.items():
+            self._arrays[key] = array("d", arr)
+        self._n_points = s._n_points
+
+    def resize(self, xrate, yrate):
+        """
+        Scale stroke.
+
+        @type xrate: float
+        @param xrate: the x scaling factor
+        @type yrate: float
+        @param yrate: the y scaling factor
+        """
+        for key, rate in (("x", xrate), ("y", yrate)):
+            if key in self._arrays:
+                self._arrays[key] = array("d", [float(int(v * rate))
+                                                for v in self._arrays[key]])
+
+    def move_rel(self, dx, dy):
+        """
+        Translate stroke.
+
+        @type dx: int
+        @param dx: relative distance from x
+        @type dy: int
+        @param yrate: relative distance from y
+        """
+        for key, delta in (("x", dx), ("y", dy)):
+            if key in self._arrays:
+                self._arrays[key] = array("d", [float(int(v + delta))
+                                                for v in self._arrays[key]])
+
+    def downsample(self, n):
+        """
+        Downsample by keeping only 1 sample every n samples.
+
+        @type n: int
+        """
+        self._take(range(0, self._n_points, n))
+
+    def downsample_threshold(self, threshold):
+        """
+        Downsample by removing consecutive samples for which
+        the euclidean distance is inferior to threshold.
+
+        @type threshod: int
+        """
+        if len(self) == 0:
+            return
+
+        xs, ys = zip(*self.get_coordinates())
+
+        indices = [0]
+        last = 0
+        for i in range(1, len(self) - 2):
+            if sqrt((xs[i] - xs[last]) ** 2 +
+                    (ys[i] - ys[last]) ** 2) > threshold:
+                indices.append(i)
+                last = i
+        indices.append(len(self) - 1)
+
+        self._take(indices)
+
+    def __repr__(self):
+        return "<CompactStroke %d pts (ref %d)>" % (len(self), id(self))
+
 class Writing(object):
     """
     A sequence of L{Strokes<Stroke>}.
@@ -488,6 +831,10 @@ class Writing(object):
     NORMALIZE_PROPORTION = 0.7 # percentage of the drawing area
     NORMALIZE_MIN_SIZE = 0.1 # don't nornalize if below that percentage
 
+    #: Class of the strokes created by move_to_point() and when reading XML.
+    #: Set to L{CompactStroke} to store points in arrays.
+    STROKE_CLASS = Stroke
+
     def __init__(self):
         self._width = Writing.WIDTH
         self._height = Writing.HEIGHT
@@ -547,7 +894,7 @@ class Writing(object):
 
         @type point: L{Point}
         """
-        stroke = Stroke()
+        stroke = self.STROKE_CLASS()
         stroke.append_point(point)
 
         self.append_stroke(stroke)
@@ -647,13 +994,7 @@ class Writing(object):
         @param yrate: the y scaling factor
         """
         for stroke in self._strokes:
-            if len(stroke) == 0:
-                continue
-
-            stroke[0].resize(xrate, yrate)
-
-            for point in stroke[1:]:
-                point.resize(xrate, yrate)
+            stroke.resize(xrate, yrate)
 
     def move_rel(self, dx, dy):
         """
@@ -665,13 +1006,7 @@ class Writing(object):
         @param yrate: relative distance from current position
         """
         for stroke in self._strokes:
-            if len(stroke) == 0:
-                continue
-
-            stroke[0].move_rel(dx, dy)
-
-            for point in stroke[1:]:
-                point.move_rel(dx, dy)
+            stroke.move_rel(dx, dy)
 
     def size(self):
         """
@@ -1428,24 +1763,23 @@ class Character(_XmlBase):
                 raise ValueError, "The very first tag should be <character>"
 
         if self._tag == "stroke":
-            self._stroke = Stroke()
+            self._stroke = self._writing.STROKE_CLASS()
 
         elif self._tag == "point":
-            point = Point()
+            values = []
 
-            for key in ("x", "y", "pressure", "xtilt", "ytilt", "timestamp"):
-                if attrs.has_key(key):
-                    value = attrs[key].encode("UTF-8")
+            for key in Point.KEYS:
+                value = attrs.get(key)
+                if value is not None:
                     if key in ("pressure", "xtilt", "ytilt"):
                         value = float(value)
                     else:
                         value = int(float(value))
-                else:
-                    value = None
 
-                setattr(point, key, value)
+                values.append(value)
 
-            self._stroke.append_point(point)
+            # Point.KEYS are in the order of the arguments of Point
+            self._stroke.append_point(Point(*values))
 
     def _end_element(self, name):
         if name == "character":
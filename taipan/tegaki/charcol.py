@@ -21,12 +21,18 @@
 
 import sqlite3
 import base64
+import struct
 import tempfile
 import re
 import os
+import time
+import itertools
+from array import array
+from contextlib import contextmanager
 
 from tegaki.dictutils import SortedDict
-from tegaki.character import _XmlBase, Point, Stroke, Writing, Character
+from tegaki.character import _XmlBase, Point, Stroke, Writing, Character, \
+                             PointView, CompactStroke
 
 def _dict_factory(cursor, row):
     d = {}
@@ -102,7 +108,7 @@ class StrokeProxy(ObjectProxy):
 
     WRITE_METHODS = ["append_point", "insert", "smooth", "clear",
                      "downsample", "downsample_threshold",
-                     "upsample", "upsample_threshod"]
+                     "upsample", "upsample_threshod", "resize", "move_rel"]
     READ_METHODS = []
 
     def __getitem__(self, i):
@@ -139,7 +145,9 @@ class CharacterProxy(ObjectProxy):
 OBJ_PROXY = {Character: CharacterProxy,
              Writing : WritingProxy,
              Stroke : StrokeProxy,
-             Point : PointProxy}
+             CompactStroke : StrokeProxy,
+             Point : PointProxy,
+             PointView : PointProxy}
 
 def _apply_proxy(charpool, obj, charobj):
     return _apply_proxy_rec(charpool, obj, charobj)
@@ -169,30 +177,203 @@ class _CharPool(dict):
     def add_char(self, char):
         self[char.charid] = char
 
-    def _update_character(self, char):
-        self._c.execute("""UPDATE characters
-SET utf8=?, n_strokes=?, data=?, sha1=?
-WHERE charid=?""", (char.get_utf8(), char.get_writing().get_n_strokes(),
-                    _adapt_character(char), char.hash(), char.charid))
-
     def clear_pool_threshold(self, threshold=100):
         if len(self) > threshold:
             self.clear_pool()
 
     def clear_pool(self):
-        for charid, char in self.items():
-            self._update_character(char)
+        if len(self) == 0:
+            return
+
+        self._c.executemany("""UPDATE characters
+SET utf8=?, n_strokes=?, data=?, sha1=?
+WHERE charid=?""", [(char.get_utf8(), char.get_writing().get_n_strokes(),
+                     _adapt_character(char), char.hash(), char.charid)
+                    for char in self.values()])
         self.clear()
 
+# Version of the db format, stored in the user_version pragma
+#   1: characters are stored as base64-encoded gzipped XML
+#   2: characters are stored as packed point arrays (see _adapt_character)
+_DB_VERSION = 2
+
+# base64 data never starts with a null byte
+_BLOB_MAGIC = "\0tgk"
+
+# magic, width, height, number of strokes, number of points and, for each
+# of Point.KEYS, the struct format of its array or a null byte if no point
+# has that attribute
+_BLOB_HEADER = struct.Struct("<4siiII%ds" % len(Point.KEYS))
+
+_INT_KEYS = ("x", "y", "timestamp")
+
+_NAN = float("nan")
+
+def _get_point_value(point, key):
+    # Point objects may lack some keys
+    try:
+        return point[key]
+    except KeyError:
+        return None
+
+def _pack_values(key, values):
+    # returns the struct format and the packed values of an attribute
+    if key in _INT_KEYS:
+        values = [None if v is None else int(v) for v in values]
+    else:
+        values = [None if v is None else float(v) for v in values]
+
+    present = [v for v in values if v is not None]
+
+    if len(present) == 0:
+        return "\0", ""
+
+    if len(present) < len(values):
+        # missing values are stored as NaN
+        values = [_NAN if v is None else float(v) for v in values]
+        fmt = "d"
+    elif key in _INT_KEYS:
+        lo, hi = min(values), max(values)
+        if -2**15 <= lo and hi < 2**15:
+            fmt = "h"
+        elif -2**31 <= lo and hi < 2**31:
+            fmt = "i"
+        elif -2**63 <= lo and hi < 2**63:
+            fmt = "q"
+        else:
+            fmt = "d"
+    elif array("f", values).tolist() == values:
+        # no precision is lost
+        fmt = "f"
+    else:
+        fmt = "d"
+
+    return fmt, struct.pack("<%d%s" % (len(values), fmt), *values)
+
+def _convert_xml_character(data):
+    # converts a BLOB in the version 1 format into an object
+    char = Character()
+    char.read_string(base64.b64decode(data), gzip=True)
+    return char
+
 def _convert_character(data):
     # converts a BLOB into an object
+    if data[:len(_BLOB_MAGIC)] != _BLOB_MAGIC:
+        return _convert_xml_character(data)
+
+    magic, width, height, n_strokes, n_points, formats = \
+        _BLOB_HEADER.unpack_from(data)
+    offset = _BLOB_HEADER.size
+
     char = Character()
-    char.read_string(base64.b64decode(data), gzip=True)
+
+    length, = struct.unpack_from("<H", data, offset)
+    offset += 2
+    if length != 0xFFFF:
+        char.set_utf8(str(data[offset:offset+length]))
+        offset += length
+
+    ends = struct.unpack_from("<%dI" % n_strokes, data, offset)
+    offset += n_strokes * 4
+
+    columns = []
+    for key, fmt in zip(Point.KEYS, formats):
+        if fmt == "\0":
+            columns.append((None,) * n_points)
+            continue
+
+        fmt = "<%d%s" % (n_points, fmt)
+        values = struct.unpack_from(fmt, data, offset)
+        offset += struct.calcsize(fmt)
+
+        if fmt[-1] == "d":
+            if key in _INT_KEYS:
+                values = [None if v != v else int(v) for v in values]
+            else:
+                values = [None if v != v else v for v in values]
+
+        columns.append(values)
+
+    # Point.KEYS are in the order of the arguments of Point
+    points = map(Point, *columns)
+
+    writing = char.get_writing()
+    writing.set_width(width)
+    writing.set_height(height)
+
+    start = 0
+    for end in ends:
+        stroke = writing.STROKE_CLASS()
+        stroke.append_points(points[start:end])
+        writing.append_stroke(stroke)
+        start = end
+
     return char
 
 def _adapt_character(char):
     # converts an object into a BLOB
-    return base64.b64encode(char.write_string(gzip=True))
+    # strokes are stored as one array per point attribute, followed by
+    # the index of the end of each stroke in these arrays
+    char = getattr(char, "_obj", char) # no need for proxies here
+    writing = char.get_writing()
+    strokes = writing.get_strokes(full=True)
+
+    points = []
+    ends = []
+    for stroke in strokes:
+        points.extend(stroke)
+        ends.append(len(points))
+
+    formats = ""
+    arrays = []
+    for key in Point.KEYS:
+        fmt, packed = _pack_values(key,
+                                   [_get_point_value(p, key) for p in points])
+        formats += fmt
+        arrays.append(packed)
+
+    utf8 = char.get_utf8()
+    if utf8 is None:
+        utf8 = ""
+        length = 0xFFFF
+    else:
+        length = len(utf8)
+
+    data = _BLOB_HEADER.pack(_BLOB_MAGIC,
+                             writing.get_width(), writing.get_height(),
+                             len(strokes), len(points), formats) + \
+           struct.pack("<H", length) + utf8 + \
+           struct.pack("<%dI" % len(ends), *ends) + \
+           "".join(arrays)
+
+    return sqlite3.Binary(data)
+
+def _read_character_file(path):
+    # parses a character file into a row, possibly in a worker process
+    char = Character()
+    gzip = path.endswith(".gz")
+    bz2 = path.endswith(".bz2")
+
+    try:
+        char.read(path, gzip=gzip, bz2=bz2)
+    except ValueError:
+        return None # ignore malformed XML files
+
+    # buffers can't be pickled
+    return {'utf8':char.get_utf8(),
+            'n_strokes':char.get_writing().get_n_strokes(),
+            'data':str(_adapt_character(char)),
+            'sha1':char.hash()}
+
+def _list_character_files(directory, regexp, recursive):
+    # depth-first, in the order of os.listdir
+    for name in os.listdir(directory):
+        full_path = os.path.join(directory, name)
+        if os.path.isdir(full_path) and recursive:
+            for path in _list_character_files(full_path, regexp, recursive):
+                yield path
+        elif regexp.search(full_path):
+            yield full_path
 
 def _gzipbz2(path):
    return (True if path.endswith(".gz") or path.endswith(".gzip") else False,
@@ -303,6 +484,18 @@ class CharacterCollection(_XmlBase):
     #: With AUTO_COMMIT set to true, data is immediately written to disk
     AUTO_COMMIT = property(get_auto_commit, set_auto_commit)
 
+    #: Number of rows that generators such as L{get_all_characters_gen}
+    #: fetch from the db at once.
+    BATCH_SIZE = 1000
+
+    #: Number of pages of the sqlite cache during L{bulk_load}.
+    BULK_CACHE_SIZE = 20000
+
+    #: With AUTO_MIGRATE set to True, .chardb files which store characters in
+    #: an older format are converted to the current format when they are
+    #: bound. Otherwise, they can be converted with L{migrate}.
+    AUTO_MIGRATE = True
+
     DTD = \
 """
 <!ELEMENT character-collection (set*)>
@@ -394,7 +587,7 @@ CREATE TABLE characters(
   setid      INTEGER REFERENCES character_sets,
   utf8       TEXT,
   n_strokes  INTEGER,
-  data       BLOB, -- gz xml
+  data       BLOB, -- packed points
   sha1       TEXT
 );
 
@@ -403,13 +596,62 @@ CREATE INDEX character_setid_index ON characters(setid);
 
     def get_character_from_row(self, row):
         # charid, setid, utf8, n_strokes, data, sha1
-        char = _convert_character(row['data'])
-        char.charid = row['charid']
+        return self._get_character_object(_convert_character(row['data']),
+                                          row['charid'])
+
+    def _get_character_object(self, char, charid):
+        char.charid = charid
         if self.WRITE_BACK:
             return CharacterProxy(self._charpool, char)
         else:
             return char
 
+    def _get_row_pages(self, where, args, limit, offset):
+        # Rows are fetched BATCH_SIZE at a time. Pages after the first one
+        # start after the last charid seen instead of using OFFSET, so that
+        # each page is an index lookup and that the cursor can be used by
+        # other queries between two pages.
+        limit = int(limit)
+        last_charid = None
+
+        while limit != 0:
+            n = self.BATCH_SIZE if limit < 0 else min(limit, self.BATCH_SIZE)
+
+            if last_charid is None:
+                rows = self._efa("""SELECT * FROM characters
+WHERE %s ORDER BY charid LIMIT ? OFFSET ?""" % where,
+                                 args + (n, int(offset)))
+            else:
+                rows = self._efa("""SELECT * FROM characters
+WHERE %s AND charid > ? ORDER BY charid LIMIT ?""" % where,
+                                 args + (last_charid, n))
+
+            if len(rows) == 0:
+                break
+
+            yield rows
+
+            if len(rows) < n:
+                break
+
+            last_charid = rows[-1]['charid']
+            if limit > 0:
+                limit -= len(rows)
+
+    def _get_characters_from_pages(self, pages, pool):
+        for rows in pages:
+            if pool is None:
+                chars = [self.get_character_from_row(r) for r in rows]
+            else:
+                # buffers can't be pickled
+                chars = pool.map(_convert_character,
+                                 [str(r['data']) for r in rows])
+                chars = [self._get_character_object(c, r['charid']) \
+                            for c, r in zip(chars, rows)]
+
+            for char in chars:
+                yield char
+
     def _update_set_ids(self):
         self._SETIDS = SortedDict()
         for row in self._efa("SELECT * FROM character_sets ORDER BY setid"):
@@ -443,13 +685,59 @@ CREATE INDEX character_setid_index ON characters(setid);
         self._con.row_factory = _dict_factory #sqlite3.Row
         self._c = self._con.cursor()
         self._charpool = _CharPool(self._c)
+        self._bulk_loading = False
 
         if not self._has_tables():
             self._create_tables()
+            self._set_db_version(_DB_VERSION)
+        elif self.AUTO_MIGRATE and self._get_db_version() < _DB_VERSION:
+            try:
+                self.migrate()
+            except sqlite3.OperationalError:
+                # e.g. read-only db, characters can be read in any format
+                self._con.rollback()
+
+        # sqlite3 commits the current transaction before DDL statements so
+        # temporary tables are created here rather than in the middle of a
+        # bulk load, where they would commit half of the changes
+        self._e("CREATE TEMP TABLE IF NOT EXISTS utf8_values(utf8 TEXT)")
 
         self._update_set_ids()
         self._dbpath = path
 
+    def _get_db_version(self):
+        return self._efo("PRAGMA user_version")[0]
+
+    def _set_db_version(self, version):
+        self._e("PRAGMA user_version=%d" % version)
+
+    def migrate(self, batch_size=1000):
+        """
+        Convert characters stored in an older format to the current format.
+
+        @type batch_size: int
+        @param batch_size: the number of characters converted at once
+
+        Characters can be read whatever their format but reading characters
+        in the current format is much faster.
+        """
+        last_charid = -1
+        while True:
+            rows = self._efa("""SELECT charid, data FROM characters
+WHERE charid > ? ORDER BY charid LIMIT ?""", (last_charid, batch_size))
+            if len(rows) == 0:
+                break
+            last_charid = rows[-1]['charid']
+
+            tupls = [(_adapt_character(_convert_character(r['data'])),
+                      r['charid'])
+                     for r in rows
+                     if str(r['data'][:len(_BLOB_MAGIC)]) != _BLOB_MAGIC]
+            self._em("UPDATE characters SET data=? WHERE charid=?", tupls)
+
+        self._set_db_version(_DB_VERSION)
+        self._con.commit()
+
     def get_db_filename(self):
         """
         Returns the db file which is internally used by the collection.
@@ -466,6 +754,57 @@ CREATE INDEX character_setid_index ON characters(setid);
         self._charpool.clear_pool()
         self._con.commit()
 
+    @contextmanager
+    def bulk_load(self):
+        """
+        Context manager to add, replace or remove many characters at once.
+
+        >>> with charcol.bulk_load():
+        ...     charcol.append_characters("my set", characters)
+
+        Changes made in the block are committed once at the end, or rolled
+        back if an exception is raised. The index on sets is only rebuilt
+        at the end, and sqlite is set up for writing speed rather than for
+        safety during the block: a file-based db uses a write-ahead log and
+        doesn't wait for data to reach the disk.
+        """
+        if self._bulk_loading:
+            yield
+            return
+
+        self.commit()
+
+        auto_commit = self.AUTO_COMMIT
+        pragmas = {}
+        for pragma in ("journal_mode", "synchronous", "cache_size"):
+            pragmas[pragma] = self._efo("PRAGMA %s" % pragma)[0]
+
+        if self.get_db_filename() is not None:
+            self._e("PRAGMA journal_mode=WAL")
+        self._e("PRAGMA synchronous=OFF")
+        self._e("PRAGMA cache_size=%d" % self.BULK_CACHE_SIZE)
+        self.AUTO_COMMIT = False
+        self._e("DROP INDEX IF EXISTS character_setid_index")
+        self._bulk_loading = True
+
+        try:
+            yield
+            self._charpool.clear_pool()
+        except:
+            self._charpool.clear()
+            self._con.rollback()
+            raise
+        finally:
+            self._bulk_loading = False
+            # this commits the changes made in the block
+            self._e("""CREATE INDEX IF NOT EXISTS character_setid_index
+ON characters(setid)""")
+            self._con.commit()
+
+            self.AUTO_COMMIT = auto_commit
+            for pragma, value in pragmas.items():
+                self._e("PRAGMA %s=%s" % (pragma, value))
+
     def save(self, path=None):
         """
         Save collection to a file.
@@ -541,37 +880,79 @@ CREATE INDEX character_setid_index ON characters(setid);
     def from_character_directory(directory,
                                  extensions=["xml", "bz2", "gz"],
                                  recursive=True,
-                                 check_duplicate=False):
+                                 check_duplicate=False,
+                                 n_processes=1,
+                                 progress_callback=None):
         """
         Creates a character collection from a directory containing
         individual character files.
+
+        @type n_processes: int
+        @param n_processes: the number of processes which parse files. The
+                            parsed characters are inserted by the calling
+                            process.
+
+        @type progress_callback: function
+        @param progress_callback: function called every L{BATCH_SIZE} files
+                                  and at the end with the number of files
+                                  read, the total number of files and the
+                                  number of files read per second
         """
         regexp = re.compile("\.(%s)$" % "|".join(extensions))
         charcol = CharacterCollection()
 
-        for name in os.listdir(directory):
-            full_path = os.path.join(directory, name)
-            if os.path.isdir(full_path) and recursive:
-                charcol += CharacterCollection.from_character_directory(
-                               full_path, extensions)
-            elif regexp.search(full_path):
-                char = Character()
-                gzip = False; bz2 = False
-                if full_path.endswith(".gz"): gzip = True
-                if full_path.endswith(".bz2"): bz2 = True
-
-                try:
-                    char.read(full_path, gzip=gzip, bz2=bz2)
-                except ValueError:
-                    continue # ignore malformed XML files
-
-                utf8 = char.get_utf8()
-                if utf8 is None: utf8 = "Unknown"
-
-                charcol.add_set(utf8)
-                if not check_duplicate or \
-                   not char in charcol.get_characters(utf8):
-                    charcol.append_character(utf8, char)
+        paths = list(_list_character_files(directory, regexp, recursive))
+
+        if n_processes > 1:
+            from multiprocessing import Pool
+            pool = Pool(n_processes)
+            rows = pool.imap(_read_character_file, paths, chunksize=16)
+        else:
+            pool = None
+            rows = itertools.imap(_read_character_file, paths)
+
+        # rows are inserted BATCH_SIZE at a time
+        pending = []
+        sha1s = {}
+        start_time = time.time()
+
+        def flush():
+            charcol._insert_rows(pending)
+            del pending[:]
+
+        try:
+            with charcol.bulk_load():
+                for i, row in enumerate(rows):
+                    if row is not None:
+                        utf8 = row['utf8']
+                        if utf8 is None: utf8 = "Unknown"
+
+                        if not utf8 in sha1s:
+                            charcol.add_set(utf8)
+                            sha1s[utf8] = set()
+
+                        if not check_duplicate or \
+                           not row['sha1'] in sha1s[utf8]:
+                            sha1s[utf8].add(row['sha1'])
+                            row['data'] = sqlite3.Binary(row['data'])
+                            pending.append((charcol._SETIDS[utf8], row))
+
+                    if (i + 1) % charcol.BATCH_SIZE == 0:
+                        flush()
+                        if progress_callback:
+                            progress_callback(i + 1, len(paths),
+                                (i + 1) / max(time.time() - start_time,
+                                              1e-6))
+
+                flush()
+        finally:
+            if pool:
+                pool.terminate()
+
+        if progress_callback:
+            progress_callback(len(paths), len(paths),
+                              len(paths) / max(time.time() - start_time,
+                                               1e-6))
 
         return charcol
 
@@ -595,7 +976,8 @@ CREATE INDEX character_setid_index ON characters(setid);
 
         try:
             # it's faster to delete the whole index and rewrite it afterwards
-            self._e("""DROP INDEX character_setid_index;""")
+            if not self._bulk_loading:
+                self._e("""DROP INDEX character_setid_index;""")
 
             for charcol in charcols:
                 for set_name in charcol.get_set_list():
@@ -611,7 +993,8 @@ CREATE INDEX character_setid_index ON characters(setid);
                         self.append_character_rows(set_name, chars)
 
         finally:
-            self._e("""CREATE INDEX character_setid_index
+            if not self._bulk_loading:
+                self._e("""CREATE INDEX character_setid_index
 ON characters(setid);""")
 
     def __add__(self, other):
@@ -687,12 +1070,19 @@ ON characters(setid);""")
         """
         return list(self.get_characters_gen(set_name, limit, offset))
 
-    def get_characters_gen(self, set_name, limit=-1, offset=0):
+    def get_characters_gen(self, set_name, limit=-1, offset=0, pool=None):
         """
         Return a generator to iterate over characters. See L{get_characters).
+
+        Only L{BATCH_SIZE} characters are kept in memory at once.
+
+        @type pool: multiprocessing.Pool
+        @param pool: if not None, characters are decoded by the workers of
+                     that pool
         """
-        rows = self.get_character_rows(set_name, limit, offset)
-        return (self.get_character_from_row(r) for r in rows)
+        pages = self._get_row_pages("setid=?", (self._SETIDS[set_name],),
+                                    limit, offset)
+        return self._get_characters_from_pages(pages, pool)
 
     def get_character_rows(self, set_name, limit=-1, offset=0):
         i = self._SETIDS[set_name]
@@ -709,14 +1099,28 @@ WHERE setid=? ORDER BY charid LIMIT ? OFFSET ?""", (i, int(limit), int(offset)))
         """
         return list(self.get_random_characters_gen(n))
 
-    def get_random_characters_gen(self, n):
+    def get_random_characters_gen(self, n, pool=None):
         """
         Return a generator to iterate over random characters. See \
         L{get_random_characters).
+
+        @type pool: multiprocessing.Pool
+        @param pool: see L{get_characters_gen}
         """
-        self._e("""SELECT DISTINCT * from characters
-ORDER BY RANDOM() LIMIT ?""", (int(n),))
-        return (self.get_character_from_row(r) for r in self._fa())
+        return self._get_characters_from_pages(self._get_random_pages(n),
+                                               pool)
+
+    def _get_random_pages(self, n):
+        # only the ids are drawn at once, rows are fetched page by page
+        charids = [r['charid'] for r in self._efa("""SELECT charid
+FROM characters ORDER BY RANDOM() LIMIT ?""", (int(n),))]
+
+        for i in range(0, len(charids), self.BATCH_SIZE):
+            ids = charids[i:i+self.BATCH_SIZE]
+            rows = self._efa("SELECT * FROM characters WHERE charid IN(%s)" \
+                             % ",".join([str(charid) for charid in ids]))
+            rows = dict([(r['charid'], r) for r in rows])
+            yield [rows[charid] for charid in ids]
 
     def get_n_characters(self, set_name):
         """
@@ -747,16 +1151,20 @@ WHERE setid=?""", (i,))[0]
 
         @rtype: list of L{Character}
         """
-        return list(self.get_all_characters_gen(limit=-1, offset=0))
+        return list(self.get_all_characters_gen(limit, offset))
 
-    def get_all_characters_gen(self, limit=-1, offset=0):
+    def get_all_characters_gen(self, limit=-1, offset=0, pool=None):
         """
         Return a generator to iterate over all characters. See \
         L{get_all_characters).
+
+        Only L{BATCH_SIZE} characters are kept in memory at once.
+
+        @type pool: multiprocessing.Pool
+        @param pool: see L{get_characters_gen}
         """
-        self._e("""SELECT * FROM characters
-ORDER BY charid LIMIT ? OFFSET ?""", (int(limit), int(offset)))
-        return (self.get_character_from_row(r) for r in self._fa())
+        pages = self._get_row_pages("1", (), limit, offset)
+        return self._get_characters_from_pages(pages, pool)
 
     def get_total_n_characters(self):
         """
@@ -793,8 +1201,7 @@ WHERE setid=?""", (i,))[0]
         """
         i = self._SETIDS[set_name]
         self._e("DELETE FROM characters WHERE setid=?", (i,))
-        for char in characters:
-            self.append_character(set_name, char)
+        self.append_characters(set_name, characters)
 
     def append_character(self, set_name, character):
         """
@@ -808,17 +1215,36 @@ WHERE setid=?""", (i,))[0]
         self.append_characters(set_name, [character])
 
     def append_characters(self, set_name, characters):
-        rows = [{'utf8':c.get_utf8(),
-                 'n_strokes':c.get_writing().get_n_strokes(),
-                 'data':_adapt_character(c),
-                 'sha1':c.hash()} for c in characters]
+        """
+        Append new characters to a set.
+
+        @type set_name: str
+        @param set_name: the set to which the characters need be added
 
-        self.append_character_rows(set_name, rows)
+        @type characters: iterable of L{Character}
+        @param characters: characters are inserted L{BATCH_SIZE} at a time
+        """
+        rows = []
+        for c in characters:
+            rows.append({'utf8':c.get_utf8(),
+                         'n_strokes':c.get_writing().get_n_strokes(),
+                         'data':_adapt_character(c),
+                         'sha1':c.hash()})
+            if len(rows) == self.BATCH_SIZE:
+                self.append_character_rows(set_name, rows)
+                rows = []
+
+        if len(rows) > 0:
+            self.append_character_rows(set_name, rows)
 
     def append_character_rows(self, set_name, rows):
         i = self._SETIDS[set_name]
+        self._insert_rows([(i, r) for r in rows])
+
+    def _insert_rows(self, rows):
+        # rows is a list of (setid, row) tuples
         tupls = [(i, r['utf8'], r['n_strokes'], r['data'], r['sha1']) \
-                  for r in rows]
+                  for i, r in rows]
 
         self._em("""INSERT INTO
 characters (setid, utf8, n_strokes, data, sha1)
@@ -913,6 +1339,16 @@ WHERE setid=? ORDER BY charid LIMIT 1 OFFSET ?""", (setid, i))[0]
             dic[c] = 1
         return dic
 
+    def _delete_characters_by_utf8(self, text, operator):
+        # the values are put in a temporary table rather than in the query
+        dic = self._get_dict_from_text(unicode(text, "utf8"))
+        self._e("DELETE FROM utf8_values")
+        self._em("INSERT INTO utf8_values(utf8) VALUES (?)",
+                 [(k.encode("utf8"),) for k in dic.keys()])
+        self._e("""DELETE FROM characters
+WHERE utf8 %s(SELECT utf8 FROM utf8_values)""" % operator)
+        self.remove_empty_sets()
+
     def include_characters_from_text(self, text):
         """
         Only keep characters found in a text.
@@ -921,10 +1357,7 @@ WHERE setid=? ORDER BY charid LIMIT 1 OFFSET ?""", (setid, i))[0]
 
         @type text: str
         """
-        dic = self._get_dict_from_text(unicode(text, "utf8"))
-        utf8values = ",".join(["'%s'" % k for k in dic.keys()])
-        self._e("DELETE FROM characters WHERE utf8 NOT IN(%s)" % utf8values)
-        self.remove_empty_sets()
+        self._delete_characters_by_utf8(text, "NOT IN")
 
     def include_characters_from_files(self, text_files):
         """
@@ -948,10 +1381,7 @@ WHERE setid=? ORDER BY charid LIMIT 1 OFFSET ?""", (setid, i))[0]
 
         @type text: str
         """
-        dic = self._get_dict_from_text(unicode(text, "utf8"))
-        utf8values = ",".join(["'%s'" % k for k in dic.keys()])
-        self._e("DELETE FROM characters WHERE utf8 IN(%s)" % utf8values)
-        self.remove_empty_sets()
+        self._delete_characters_by_utf8(text, "IN")
 
     def exclude_characters_from_files(self, text_files):
         """
@@ -1022,7 +1452,7 @@ FROM characters GROUP BY setid""")
         for set_name in self.get_set_list():
             s += "<set name=\"%s\">\n" % set_name
 
-            for character in self.get_characters(set_name):
+            for character in self.get_characters_gen(set_name):
                 s += "  <character>\n"
 
                 utf8 = character.get_utf8()
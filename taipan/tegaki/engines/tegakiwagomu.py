@@ -23,18 +23,37 @@ VERSION = '0.3.1'
 
 import os
 import struct
+import hashlib
+import cPickle
 from array import array
+from collections import deque
+from math import sqrt
 
-from tegaki.recognizer import Results, Recognizer, RecognizerError
+try:
+    # numpy is optional, it makes feature extraction faster
+    import numpy
+except ImportError:
+    numpy = None
+
+from tegaki.character import Writing
+from tegaki.recognizer import Results, Recognizer, RecognizerError, \
+                              RecognizerSession
 from tegaki.trainer import Trainer, TrainerError
-from tegaki.arrayutils import array_flatten
 from tegaki.dictutils import SortedDict
 from tegaki.mathutils import euclidean_distance
 
 VECTOR_DIMENSION_MAX = 4
 INT_SIZE = 4
 FLOAT_SIZE = 4
-MAGIC_NUMBER = 0x77778888
+# version 1 models started with 0x77778888 and were stored in the byte
+# order of the host, wagomu can still read them
+MAGIC_NUMBER = 0x77779999
+MODEL_VERSION = 2
+# see ModelHeader in wagomu.h
+MODEL_HEADER_SIZE = 16 * INT_SIZE
+# how templates are stored, see ModelHeader in wagomu.h
+TEMPLATE_FORMATS = ["float32", "int8"]
+FLT_MAX = struct.unpack("<f", "\xff\xff\x7f\x7f")[0]
 
 # Features
 
@@ -48,6 +67,22 @@ def get_xy_features(writing):
 
 get_xy_features.DIMENSION = 2
 
+def get_flat_xy_features(xs, ys):
+    """
+    Same as get_xy_features but for the x and y coordinates of all the points,
+    returned as a flat float array.
+    """
+    flat = array("f", [0.0]) * (4 * len(xs))
+    if numpy is not None:
+        flat[0::4] = array("f", xs.astype(numpy.float32).tostring())
+        flat[1::4] = array("f", ys.astype(numpy.float32).tostring())
+    else:
+        flat[0::4] = array("f", xs)
+        flat[1::4] = array("f", ys)
+    return flat
+
+get_xy_features.FLAT_FUNCTION = get_flat_xy_features
+
 def get_delta_features(writing):   
     """
     Returns (delta x, delta y) for each point.
@@ -69,14 +104,150 @@ def get_delta_features(writing):
 
 get_delta_features.DIMENSION = 2
 
+def get_flat_delta_features(xs, ys):
+    """
+    Same as get_delta_features but for the x and y coordinates of all the
+    points, returned as a flat float array.
+    """
+    n_vectors = max(len(xs) - 1, 0)
+    flat = array("f", [0.0]) * (4 * n_vectors)
+    if n_vectors == 0:
+        pass
+    elif numpy is not None:
+        dx = numpy.abs(numpy.diff(xs)).astype(numpy.float32)
+        dy = numpy.abs(numpy.diff(ys)).astype(numpy.float32)
+        flat[0::4] = array("f", dx.tostring())
+        flat[1::4] = array("f", dy.tostring())
+    else:
+        flat[0::4] = array("f", [abs(xs[i] - xs[i-1])
+                                 for i in range(1, len(xs))])
+        flat[1::4] = array("f", [abs(ys[i] - ys[i-1])
+                                 for i in range(1, len(ys))])
+    return flat
+
+get_delta_features.FLAT_FUNCTION = get_flat_delta_features
+
+# Feature extraction works on the coordinates of all the points of a writing,
+# stored in two flat arrays, rather than on Stroke and Point objects. The
+# following functions do the same as the corresponding Writing methods but
+# leave the writing untouched.
+
+def _get_coordinates(writing):
+    """
+    Returns the x and y coordinates of all the points and the number of points
+    of each stroke.
+    """
+    xs, ys, lengths = [], [], []
+    for stroke in writing.get_strokes(full=True):
+        coordinates = stroke.get_coordinates()
+        xs.extend([x for x, y in coordinates])
+        ys.extend([y for x, y in coordinates])
+        lengths.append(len(coordinates))
+
+    if numpy is not None:
+        xs = numpy.array(xs, dtype=numpy.float64)
+        ys = numpy.array(ys, dtype=numpy.float64)
+
+    return xs, ys, lengths
+
+def _get_bounds(coordinates):
+    if numpy is not None:
+        cmin, cmax = coordinates.min(), coordinates.max()
+    else:
+        cmin, cmax = min(coordinates), max(coordinates)
+
+    # same initial values as in Writing.size()
+    return min(4294967296, cmin), max(0, cmax)
+
+def _normalize_size(coordinates, size):
+    """
+    Same as Writing.normalize_size for one axis.
+    """
+    cmin, cmax = _get_bounds(coordinates)
+    
+    if float(cmax - cmin) / size > Writing.NORMALIZE_MIN_SIZE:
+        rate = size * Writing.NORMALIZE_PROPORTION / (cmax - cmin)
+    else:
+        rate = 1.0
+
+    if numpy is not None:
+        return numpy.trunc(coordinates * rate)
+    else:
+        return [int(c * rate) for c in coordinates]
+
+def _normalize_position(coordinates, size):
+    """
+    Same as Writing.normalize_position for one axis.
+    """
+    # coordinates are integers after _normalize_size
+    cmin, cmax = [int(c) for c in _get_bounds(coordinates)]
+
+    delta = (size - (cmax - cmin)) / 2 - cmin
+
+    if numpy is not None:
+        return coordinates + delta
+    else:
+        return [c + delta for c in coordinates]
+
+def _downsample_threshold(xs, ys, lengths, threshold):
+    """
+    Same as Writing.downsample_threshold. Returns the indices of the points to
+    keep.
+    """
+    if numpy is not None:
+        xs, ys = xs.tolist(), ys.tolist()
+
+    indices = []
+    start = 0
+    for length in lengths:
+        if length > 0:
+            indices.append(start)
+            last = start
+            for i in range(start + 1, start + length - 2):
+                if sqrt((xs[i] - xs[last]) ** 2 +
+                        (ys[i] - ys[last]) ** 2) > threshold:
+                    indices.append(i)
+                    last = i
+            indices.append(start + length - 1)
+        start += length
+
+    return indices
+
+def get_normalized_coordinates(writing, threshold):
+    """
+    Returns the x and y coordinates of all the points of writing, as if
+    writing.normalize() and writing.downsample_threshold(threshold) had been
+    called. The writing is not modified.
+
+    Coordinates are numpy arrays if numpy is available, lists otherwise.
+    """
+    xs, ys, lengths = _get_coordinates(writing)
+
+    if len(xs) == 0:
+        return xs, ys
+
+    width, height = writing.get_size()
+
+    xs = _normalize_position(_normalize_size(xs, width), width)
+    ys = _normalize_position(_normalize_size(ys, height), height)
+
+    indices = _downsample_threshold(xs, ys, lengths, threshold)
+
+    # coordinates are truncated to integers like in Writing.get_strokes()
+    if numpy is not None:
+        indices = numpy.array(indices, dtype=numpy.intp)
+        return numpy.trunc(xs[indices]), numpy.trunc(ys[indices])
+    else:
+        return [int(xs[i]) for i in indices], [int(ys[i]) for i in indices]
+
 # DTW
 
 class DtwMatrix:
     # we use 1d-vector V instead of a n*m 2d-matrix M
     # M[i,j] can be accessed by V[k], k = j*n + i
 
-    def __init__(self, n, m):
-        self.a = array("f", [0.0] * (n*m))
+    def __init__(self, n, m, value=0.0):
+        self.a = array("f", [value] * (n*m))
         self.n = n
         self.m = m
 
@@ -86,12 +257,14 @@ class DtwMatrix:
     def __setitem__(self, p, value):
         self.a[p[1] * self.n + p[0]] = value
 
-def dtw(s, t, d, f=euclidean_distance):
+def dtw(s, t, d, f=euclidean_distance, band_width=0):
     """
     s; first sequence
     t: second sequence
     d: vector dimension
     f: distance function
+    band_width: if non-zero, width of the Sakoe-Chiba band around the
+                diagonal to which the warping path is restricted
 
     s and t are flat sequences of feature vectors of dimension d, so 
     their length should be multiple of d
@@ -102,9 +275,17 @@ def dtw(s, t, d, f=euclidean_distance):
     n = len(s) / d
     m = len(t) / d
    
-    DTW = DtwMatrix(n, m)
-   
     infinity = 4294967296 # 2^32
+
+    if band_width > 0 and n > 1:
+        # same band as in wagomu.cpp: it must be at least as wide as the
+        # slope of the diagonal so that two consecutive columns overlap
+        w = max(band_width, (m + n - 3) / (n - 1))
+        # cells outside of the band are never computed
+        DTW = DtwMatrix(n, m, infinity)
+    else:
+        w = 0
+        DTW = DtwMatrix(n, m)
     
     for i in range(1, m):
         DTW[(0, i)] = infinity
@@ -118,7 +299,13 @@ def dtw(s, t, d, f=euclidean_distance):
         # retrieve 1st d-dimension vector
         v1 = s[i*d:i*d+d]
 
-        for j in range(1, m):
+        if w > 0:
+            center = i * (m - 1) / (n - 1)
+            cells = range(max(center - w, 1), min(center + w, m - 1) + 1)
+        else:
+            cells = range(1, m)
+
+        for j in cells:
             # retrieve 2nd d-dimension vector
             v2 = t[j*d:j*d+d]
             # distance function
@@ -130,6 +317,138 @@ def dtw(s, t, d, f=euclidean_distance):
        
     return DTW[(n-1, m-1)]
 
+def find_medoid(features, dimension, band_width=0, native=False):
+    """
+    features: list of flat feature arrays
+    dimension: vector dimension
+    band_width: see dtw()
+    native: if True, the distances are computed by the wagomu extension
+
+    Returns the index of the features which are, on average, the closest
+    to the other features. This is a module-level function so that it can
+    be run in a worker process.
+    """
+    if native:
+        import wagomu
+
+        n_vectors = [len(feat) / VECTOR_DIMENSION_MAX for feat in features]
+        batch = wagomu.CharacterBatch(len(features), sum(n_vectors))
+        points = array("f")
+        for i, feat in enumerate(features):
+            batch.set_character(i, n_vectors[i], 0)
+            points.extend(feat)
+        if not batch.set_points(points):
+            raise ValueError, "The features don't match the number of vectors"
+
+        recognizer = wagomu.Recognizer()
+        recognizer.set_band_width(band_width)
+
+        return recognizer.find_medoid(batch)
+
+    n_features = len(features)
+    sum_ = [0] * n_features
+
+    # dtw is a symmetric distance so d(i,j) = d(j,i)
+    # we only need to compute the values on the right side of the
+    # diagonale
+    for i in range(n_features):
+        for j in range (i+1, n_features):
+            distance = dtw(features[i], features[j], dimension,
+                           band_width=band_width)
+            sum_[i] += distance
+            sum_[j] += distance
+
+    return argmin(sum_)
+
+def get_template_bounds(feat):
+    """
+    feat: flat feature array of a template
+
+    Returns the minimum and then the maximum of each dimension over the
+    vectors of the template, as used by the pruning search of wagomu. The
+    first vector is left out since DTW never compares it.
+    """
+    vectors = [feat[i:i+VECTOR_DIMENSION_MAX]
+               for i in range(VECTOR_DIMENSION_MAX, len(feat),
+                              VECTOR_DIMENSION_MAX)]
+
+    if len(vectors) == 0:
+        return [-FLT_MAX] * VECTOR_DIMENSION_MAX + \
+               [FLT_MAX] * VECTOR_DIMENSION_MAX
+
+    return [min([v[d] for v in vectors])
+            for d in range(VECTOR_DIMENSION_MAX)] + \
+           [max([v[d] for v in vectors])
+            for d in range(VECTOR_DIMENSION_MAX)]
+
+def get_signature(feat, length):
+    """
+    feat: flat feature array
+    length: number of vectors of the signature
+
+    Returns the coarse signature of feat as a flat float array: the mean of
+    its vectors over length segments of about the same length, scaled by
+    the average length of a segment so that the signature also reflects
+    the length of feat. The first vector is left out as in DTW. wagomu
+    computes the signature of the input the same way.
+    """
+    vectors = [feat[i:i+VECTOR_DIMENSION_MAX]
+               for i in range(VECTOR_DIMENSION_MAX, len(feat),
+                              VECTOR_DIMENSION_MAX)]
+    n = len(vectors)
+    scale = float(n) / length
+
+    signature = []
+    for l in range(length):
+        if n == 0:
+            signature += [0.0] * VECTOR_DIMENSION_MAX
+            continue
+
+        start = l * n / length
+        end = max((l + 1) * n / length, start + 1)
+
+        signature += [sum([v[d] for v in vectors[start:end]]) /
+                      (end - start) * scale
+                      for d in range(VECTOR_DIMENSION_MAX)]
+
+    return signature
+
+def quantize_templates(templates, dimension):
+    """
+    templates: list of flat feature arrays
+    dimension: vector dimension
+
+    Returns the scale of each dimension and, for every template, its
+    values quantized to signed bytes and its values as wagomu decodes
+    them. Only the first dimension values of each vector are kept.
+    """
+    scales = []
+    for d in range(VECTOR_DIMENSION_MAX):
+        values = [abs(feat[i]) for feat in templates
+                  for i in range(d, len(feat), VECTOR_DIMENSION_MAX)]
+        if d >= dimension or len(values) == 0 or max(values) == 0:
+            scales.append(1.0)
+        else:
+            scales.append(max(values) / 127.0)
+    # the scales are stored as float32
+    scales = array("f", scales)
+
+    quantized = []
+    decoded = []
+    for feat in templates:
+        q = array("b")
+        dec = array("f", [0.0] * len(feat))
+        for i in range(0, len(feat), VECTOR_DIMENSION_MAX):
+            for d in range(dimension):
+                value = int(round(feat[i+d] / scales[d]))
+                value = max(-127, min(127, value))
+                q.append(value)
+                dec[i+d] = value * scales[d]
+        quantized.append(q)
+        decoded.append(dec)
+
+    return scales, quantized, decoded
+
 # Small utils
 
 def argmin(arr):
@@ -137,24 +456,26 @@ def argmin(arr):
 
 # File utils
 
+# models are stored in little-endian
+
 def read_uints(f, n):
-    return struct.unpack("@%dI" % n, f.read(n*4))
+    return struct.unpack("<%dI" % n, f.read(n*4))
 
 def read_uint(f):
     return read_uints(f, 1)[0]
 
 def write_uints(f, *args):
-    f.write(struct.pack("@%dI" % len(args), *args))
+    f.write(struct.pack("<%dI" % len(args), *args))
 write_uint = write_uints
 
 def read_floats(f, n):
-    return struct.unpack("@%df" % n, f.read(n*4))
+    return struct.unpack("<%df" % n, f.read(n*4))
 
 def read_float(f):
     return read_floats(f, 1)[0]
 
 def write_floats(f, *args):
-    f.write(struct.pack("@%df" % len(args), *args))
+    f.write(struct.pack("<%df" % len(args), *args))
 write_float = write_floats    
 
 def get_padded_offset(offset, align):
@@ -173,16 +494,25 @@ class _WagomuBase(object):
         self._feature_extraction_function = eval("get_delta_features")
         self._vector_dimension = self._feature_extraction_function.DIMENSION
 
+        # 0 means that DTW alignments are not constrained
+        self._band_width = 0
+
+        # 0 means that models have no coarse signatures
+        self._coarse_resolution = 0
+
         if isinstance(self, Recognizer):
             self._error = RecognizerError
         else:
             self._error = TrainerError
 
     def get_features(self, writing):
-        writing.normalize()
-        writing.downsample_threshold(self._downsample_threshold)
-        flat = array_flatten(self._feature_extraction_function(writing))
-        return [float(f) for f in flat]
+        """
+        Returns the features of writing as a flat float array. The writing
+        is not modified.
+        """
+        xs, ys = get_normalized_coordinates(writing,
+                                            self._downsample_threshold)
+        return self._feature_extraction_function.FLAT_FUNCTION(xs, ys)
 
     def set_options(self, opt):
         if "downsample_threshold" in opt:
@@ -209,6 +539,51 @@ class _WagomuBase(object):
                     self._recognizer.set_window_size(ws)
             except ValueError:
                 raise self._error, "window_size must be a positive integer"    
+
+        if "band_width" in opt:
+            try:
+                bw = int(opt["band_width"])
+                if bw < 0: raise ValueError
+                self._band_width = bw
+                if isinstance(self, Recognizer):
+                    self._recognizer.set_band_width(bw)
+            except ValueError:
+                raise self._error, "band_width must be a positive integer"
+
+        if "n_threads" in opt:
+            try:
+                nt = int(opt["n_threads"])
+                if nt < 1: raise ValueError
+                if isinstance(self, Recognizer):
+                    self._recognizer.set_n_threads(nt)
+            except ValueError:
+                raise self._error, "n_threads must be a positive integer"
+
+        if "pruning" in opt:
+            try:
+                pruning = bool(int(opt["pruning"]))
+                if isinstance(self, Recognizer):
+                    self._recognizer.set_pruning(pruning)
+            except ValueError:
+                raise self._error, "pruning must be 0 or 1"
+
+        if "coarse_resolution" in opt:
+            try:
+                cr = int(opt["coarse_resolution"])
+                if cr < 0: raise ValueError
+                self._coarse_resolution = cr
+            except ValueError:
+                raise self._error, \
+                    "coarse_resolution must be a positive integer"
+
+        if "n_candidates" in opt:
+            try:
+                nc = int(opt["n_candidates"])
+                if nc < 0: raise ValueError
+                if isinstance(self, Recognizer):
+                    self._recognizer.set_n_candidates(nc)
+            except ValueError:
+                raise self._error, "n_candidates must be a positive integer"
        
 
 # Recognizer
@@ -227,22 +602,78 @@ try:
             self._recognizer = wagomu.Recognizer()
 
         def open(self, path):
+            self.clear_cache()
             ret = self._recognizer.open(path)
             if not ret: 
                 raise RecognizerError, self._recognizer.get_error_message()
 
+        def set_options(self, opt):
+            _WagomuBase.set_options(self, opt)
+            self.clear_cache()
+
+        def recognize(self, writing, n=10):
+            ch, key = self._get_character(writing)
+
+            return self._recognize_with_cache(writing, n,
+                lambda writing, n: self._recognize_character(ch, n), key)
+
+        def _get_cache_key(self, writing):
+            return self._get_character(writing)[1]
+
         def _recognize(self, writing, n=10):
+            return self._recognize_character(self._get_character(writing)[0],
+                                             n)
+
+        def _recognize_character(self, ch, n):
+            return self._get_results(self._recognizer.recognize(ch, n))
+
+        def _get_character(self, writing):
+            """
+            Returns the wagomu character of writing and its cache key, which
+            are computed from the same features so that they are only
+            extracted once per recognition.
+            """
             n_strokes = writing.get_n_strokes()
             feat = self.get_features(writing)
             nfeat = len(feat) 
             nvectors = nfeat / VECTOR_DIMENSION_MAX
 
             ch = wagomu.Character(nvectors, n_strokes)
-            for i in range(nfeat):
-                ch.set_value(i, feat[i])
-
-            res = self._recognizer.recognize(ch, n)
-
+            if not ch.set_points(feat):
+                raise RecognizerError, \
+                      "The features don't match the number of vectors"
+
+            # writings which have the same features and number of strokes
+            # have the same results
+            key = "%d:%s" % (n_strokes,
+                             hashlib.sha1(feat.tostring()).hexdigest())
+
+            return ch, key
+
+        def _recognize_batch(self, writings, n=10):
+            n_vectors = []
+            n_strokes = []
+            points = array("f")
+            for writing in writings:
+                n_strokes.append(writing.get_n_strokes())
+                feat = self.get_features(writing)
+                n_vectors.append(len(feat) / VECTOR_DIMENSION_MAX)
+                points.extend(feat)
+
+            # all the features are copied to the native side at once
+            batch = wagomu.CharacterBatch(len(writings), sum(n_vectors))
+            for i in range(len(writings)):
+                batch.set_character(i, n_vectors[i], n_strokes[i])
+            if not batch.set_points(points):
+                raise RecognizerError, \
+                      "The features don't match the number of vectors"
+
+            res = self._recognizer.recognize_batch(batch, n)
+
+            return [self._get_results(res.get_results(i))
+                    for i in range(res.get_size())]
+
+        def _get_results(self, res):
             candidates = []
             for i in range(res.get_size()):
                 utf8 = unichr(res.get_unicode(i)).encode("utf8")
@@ -250,6 +681,40 @@ try:
 
             return Results(candidates)
 
+        def new_session(self):
+            return WagomuRecognizerSession(self)
+
+    class WagomuRecognizerSession(RecognizerSession):
+        """
+        Keeps the DTW computations of the previous strokes in wagomu. They
+        are only reused when the features of the previous writing are a
+        prefix of the new ones, i.e. when the new strokes didn't change the
+        normalization of the previous ones.
+        """
+
+        def __init__(self, recognizer):
+            RecognizerSession.__init__(self, recognizer)
+
+            self._session = wagomu.Session(recognizer._recognizer)
+
+        def reset(self):
+            self._session.reset()
+
+        def recognize(self, writing, n=10):
+            ch, key = self._recognizer._get_character(writing)
+
+            return self._recognizer._recognize_with_cache(writing, n,
+                lambda writing, n: self._recognize_character(ch, n), key)
+
+        def _recognize(self, writing, n=10):
+            return self._recognize_character(
+                self._recognizer._get_character(writing)[0], n)
+
+        def _recognize_character(self, ch, n):
+            res = self._session.recognize(ch, n)
+
+            return self._recognizer._get_results(res)
+
     RECOGNIZER_CLASS = WagomuRecognizer
 
 except ImportError:
@@ -266,6 +731,46 @@ class WagomuTrainer(_WagomuBase, Trainer):
         Trainer.__init__(self)
         _WagomuBase.__init__(self)
 
+        # 1 means that sets are processed in the current process
+        self._n_processes = 1
+        self._native_dtw = False
+        self._cache = False
+        self._template_format = "float32"
+
+    def set_options(self, opt):
+        _WagomuBase.set_options(self, opt)
+
+        if "n_processes" in opt:
+            try:
+                n = int(opt["n_processes"])
+                if n < 1: raise ValueError
+                self._n_processes = n
+            except ValueError:
+                raise TrainerError, "n_processes must be a positive integer"
+
+        if "native_dtw" in opt:
+            try:
+                self._native_dtw = bool(int(opt["native_dtw"]))
+            except ValueError:
+                raise TrainerError, "native_dtw must be 0 or 1"
+
+            if self._native_dtw:
+                try:
+                    import wagomu
+                except ImportError:
+                    raise TrainerError, "native_dtw requires wagomu"
+
+        if "cache" in opt:
+            try:
+                self._cache = bool(int(opt["cache"]))
+            except ValueError:
+                raise TrainerError, "cache must be 0 or 1"
+
+        if "template_format" in opt:
+            if not opt["template_format"] in TEMPLATE_FORMATS:
+                raise TrainerError, "The template format does not exist"
+            self._template_format = opt["template_format"]
+
     def train(self, charcol, meta, path=None):
         self._check_meta(meta)
 
@@ -288,74 +793,164 @@ class WagomuTrainer(_WagomuBase, Trainer):
         self._save_model_from_charcol(charcol, path)
         self._write_meta_file(meta, meta_file)
 
-    def _get_representative_writing(self, writings):
-        n_writings = len(writings)
-        sum_ = [0] * n_writings
-        features = [self.get_features(w) for w in writings]
-
-        # dtw is a symmetric distance so d(i,j) = d(j,i)
-        # we only need to compute the values on the right side of the
-        # diagonale
-        for i in range(n_writings):
-            for j in range (i+1, n_writings):
-                distance = dtw(features[i], features[j],
-                                self._vector_dimension)
-                sum_[i] += distance
-                sum_[j] += distance
-        
-        i = argmin(sum_)
-
-        return writings[i]
-
-    def _save_model_from_charcol(self, charcol, output_path):
-        chargroups = {} 
-
-        n_chars = 0
+    def _get_cache_key(self, rows):
+        # the template of a set only depends on its samples and on the
+        # options used to compute it
+        h = hashlib.sha1()
+        h.update(repr((self._downsample_threshold,
+                       self._feature_extraction_function.__name__,
+                       self._band_width,
+                       self._native_dtw)))
+        for row in rows:
+            if row['sha1']:
+                h.update(row['sha1'])
+            else:
+                h.update(hashlib.sha1(str(row['data'])).hexdigest())
+        return h.hexdigest()
 
-        # get non-empty set list
-        set_list = []
+    def _load_cache(self, path):
+        try:
+            f = open(path, "rb")
+            try:
+                return cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return {}
+
+    def _save_cache(self, path, cache):
+        f = open(path, "wb")
+        try:
+            cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def _get_template(self, writing, representative):
+        if representative:
+            # the representative is left in the state get_features used
+            # to leave it
+            writing.normalize()
+            writing.downsample_threshold(self._downsample_threshold)
+
+        # artificially increase the number of points
+        # this is useful when training data is made of straight lines
+        # and thus has very few points
+        writing.upsample_threshold(10)
+
+        return self.get_features(writing), writing.get_n_strokes()
+
+    def _get_set_templates(self, charcol, cache, pool):
+        """
+        Yields the cache key, the utf8 and the rows and representative
+        index of each set, one set at a time. The rows are None if the
+        template of the set is in the cache. The index is None if the first
+        row is the template and an asynchronous result if the index is
+        computed by pool.
+        """
         for set_name in charcol.get_set_list():
-            chars = charcol.get_characters(set_name)
-            if len(chars) == 0: continue # empty set
-
-            utf8 = chars[0].get_utf8()
-            if utf8 is None: continue
-
-            set_list.append(set_name)
-
-        # each set may contain more than 1 sample per character
-        # but we only need one ("the template") so we find the set
-        # representative,  which we define as the sample which is, on
-        # average, the closest to the other samples of that set
-        for set_name in set_list:
-            chars = charcol.get_characters(set_name)
-            if len(chars) == 0: continue # empty set
+            rows = charcol.get_character_rows(set_name)
+            if len(rows) == 0: continue # empty set
 
-            utf8 = chars[0].get_utf8()
+            utf8 = rows[0]['utf8']
             if utf8 is None: continue
 
-            if len(chars) == 1 or len(chars) == 2:
+            key = self._get_cache_key(rows)
+            if key in cache:
+                yield key, utf8, None, None
+            elif len(rows) == 1 or len(rows) == 2:
                 # take the first one if only 1 or 2 samples available
-                writing = chars[0].get_writing()
+                yield key, utf8, rows[:1], None
             else:
                 # we need to find the set representative
-                writings = [c.get_writing() for c in chars]
-                writing = self._get_representative_writing(writings)
-
-            # artificially increase the number of points
-            # this is useful when training data is made of straight lines
-            # and thus has very few points
-            writing.upsample_threshold(10)
+                writings = [charcol.get_character_from_row(r).get_writing()
+                            for r in rows]
+                features = [self.get_features(w) for w in writings]
+                args = (features, self._vector_dimension, self._band_width,
+                        self._native_dtw)
+                if pool:
+                    medoid = pool.apply_async(find_medoid, args)
+                else:
+                    medoid = find_medoid(*args)
+                yield key, utf8, rows, medoid
+
+    def _get_set_template(self, charcol, cache, key, rows, medoid):
+        if rows is None:
+            n_strokes, feat = cache[key]
+            return array("f", feat), n_strokes
+        elif medoid is None:
+            writing = charcol.get_character_from_row(rows[0]).get_writing()
+            return self._get_template(writing, False)
+        else:
+            if not isinstance(medoid, int): medoid = medoid.get()
+            writing = charcol.get_character_from_row(rows[medoid]) \
+                             .get_writing()
+            return self._get_template(writing, True)
 
-            feat = self.get_features(writing)
-            n_strokes = writing.get_n_strokes()
+    def _save_model_from_charcol(self, charcol, output_path):
+        chargroups = {} 
 
-            if not n_strokes in chargroups: chargroups[n_strokes] = []
-            chargroups[n_strokes].append((utf8, feat))
+        n_chars = 0
+        n_templates = len([set_name for set_name in charcol.get_set_list()
+                           if charcol.get_n_characters(set_name) > 0])
 
-            print "%s (%d/%d)" % (utf8, n_chars+1, len(set_list))
-            n_chars += 1
+        cache_path = os.path.splitext(output_path)[0] + ".cache"
+        if self._cache:
+            cache = self._load_cache(cache_path)
+        else:
+            cache = {}
+        new_cache = {}
+
+        if self._n_processes > 1:
+            from multiprocessing import Pool
+            pool = Pool(self._n_processes)
+            # sets are sent to the worker processes a few at a time so that
+            # the samples of the whole collection are never in memory
+            max_pending = 2 * self._n_processes
+        else:
+            pool = None
+            max_pending = 0
 
+        # each set may contain more than 1 sample per character
+        # but we only need one ("the template") so we find the set
+        # representative,  which we define as the sample which is, on
+        # average, the closest to the other samples of that set
+        pending = deque()
+        try:
+            sets = self._get_set_templates(charcol, cache, pool)
+            while True:
+                try:
+                    pending.append(sets.next())
+                    if len(pending) <= max_pending: continue
+                except StopIteration:
+                    if not pending: break
+
+                key, utf8, rows, medoid = pending.popleft()
+                feat, n_strokes = self._get_set_template(charcol, cache,
+                                                         key, rows, medoid)
+
+                new_cache[key] = (n_strokes, feat.tostring())
+
+                if not n_strokes in chargroups: chargroups[n_strokes] = []
+                chargroups[n_strokes].append((utf8, feat))
+
+                print "%s (%d/%d)" % (utf8, n_chars+1, n_templates)
+                n_chars += 1
+
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                # stops the worker processes after an error or an interrupt
+                pool.terminate()
+
+        if self._cache:
+            # sets that no longer exist are dropped from the cache
+            self._save_cache(cache_path, new_cache)
+
+        self._write_model(output_path, chargroups)
+
+    def _write_model(self, output_path, chargroups):
         stroke_counts = chargroups.keys()
         stroke_counts.sort()
 
@@ -363,76 +958,114 @@ class WagomuTrainer(_WagomuBase, Trainer):
         for sc in stroke_counts:
             chargroups[sc].sort(lambda x,y: cmp(len(x[1]),len(y[1])))
 
-        # save model in binary format
-        # this file is architecture dependent
-        f = open(output_path, "wb")
-
-        # magical number
-        write_uint(f, MAGIC_NUMBER)
-
-        # number of characters/templates
-        write_uint(f, n_chars)
-
-        # number of character groups
-        write_uint(f, len(chargroups))
-
-        # vector dimensionality
-        write_uint(f, self._vector_dimension)
-
-        # downsample threshold
-        write_uint(f, self._downsample_threshold)
-
-        strokedatasize = {}
-
-        # character information
+        templates = []
         for sc in stroke_counts:
-            strokedatasize[sc] = 0
-
-            for utf8, feat in chargroups[sc]:
-                # unicode integer
-                write_uint(f, ord(unicode(utf8, "utf-8")))
-                
-                # n_vectors
-                write_uint(f, len(feat) / VECTOR_DIMENSION_MAX)
+            templates += chargroups[sc]
+
+        n_chars = len(templates)
+        n_vectors = [len(feat) / VECTOR_DIMENSION_MAX
+                     for utf8, feat in templates]
+
+        features = [feat for utf8, feat in templates]
+        if self._template_format == "int8":
+            scales, data, features = \
+                quantize_templates(features, self._vector_dimension)
+            # templates are padded to a multiple of 4 bytes
+            data = [d.tostring() + "\0" * (get_padded_offset(len(d), 4) -
+                                           len(d))
+                    for d in data]
+            template_format = TEMPLATE_FORMATS.index("int8")
+        else:
+            data = [struct.pack("<%df" % len(feat), *feat)
+                    for feat in features]
+            template_format = TEMPLATE_FORMATS.index("float32")
+
+        # sections of the file, in that order
+        characters_offset = MODEL_HEADER_SIZE
+        groups_offset = characters_offset + n_chars * 2 * INT_SIZE
+        template_offsets_offset = groups_offset + \
+                                  len(chargroups) * 4 * INT_SIZE
+        scales_offset = template_offsets_offset + n_chars * INT_SIZE
+        if template_format == TEMPLATE_FORMATS.index("int8"):
+            bounds_offset = scales_offset + VECTOR_DIMENSION_MAX * FLOAT_SIZE
+        else:
+            bounds_offset = scales_offset
+        bounds_offset = get_padded_offset(bounds_offset,
+                                          VECTOR_DIMENSION_MAX * FLOAT_SIZE)
+        signatures_offset = bounds_offset + \
+                            n_chars * 2 * VECTOR_DIMENSION_MAX * FLOAT_SIZE
+        templates_offset = signatures_offset + n_chars * \
+                           self._coarse_resolution * \
+                           VECTOR_DIMENSION_MAX * FLOAT_SIZE
+
+        template_offsets = []
+        offset = templates_offset
+        for d in data:
+            template_offsets.append(offset)
+            offset += len(d)
 
-                strokedatasize[sc] += len(feat) * FLOAT_SIZE
+        # save model in binary format
+        f = open(output_path, "wb")
 
-        offset = 5 * INT_SIZE # header
-        offset += n_chars * 2 * INT_SIZE # character information 
-        offset += len(chargroups) * 4 * INT_SIZE # character group
-        poffset = get_padded_offset(offset, VECTOR_DIMENSION_MAX * FLOAT_SIZE)
-        pad = poffset - offset
+        # header
+        write_uints(f,
+                    MAGIC_NUMBER,
+                    MODEL_VERSION,
+                    n_chars,
+                    len(chargroups),
+                    self._vector_dimension,
+                    self._downsample_threshold,
+                    max(n_vectors + [0]),
+                    characters_offset,
+                    groups_offset,
+                    template_offsets_offset,
+                    bounds_offset,
+                    templates_offset,
+                    template_format,
+                    scales_offset if template_format else 0,
+                    self._coarse_resolution,
+                    signatures_offset if self._coarse_resolution else 0)
+
+        # character information: unicode integer and n_vectors
+        for (utf8, feat), n in zip(templates, n_vectors):
+            write_uints(f, ord(unicode(utf8, "utf-8")), n)
 
         # character group information
+        char_id = 0
         for sc in stroke_counts:
-            # number of strokes
-            write_uint(f, sc)
-    
-            # number of characters
-            write_uint(f, len(chargroups[sc]))
-
-            # offset from the start of the file
-            write_uint(f, poffset)
+            # number of strokes, number of characters, offset of the first
+            # template and padding
+            write_uints(f, sc, len(chargroups[sc]),
+                        template_offsets[char_id], 0)
+            char_id += len(chargroups[sc])
 
-            # padding
-            f.write("".join(["\0"] * 4))
+        # template index
+        write_uints(f, *template_offsets)
 
-            poffset += strokedatasize[sc] 
+        # scale factors of quantized templates
+        if template_format == TEMPLATE_FORMATS.index("int8"):
+            write_floats(f, *scales)
 
         # padding
-        if pad > 0:
-            f.write("".join(["\0"] * pad))
+        f.write("\0" * (bounds_offset - f.tell()))
 
-        assert(f.tell() % (VECTOR_DIMENSION_MAX * FLOAT_SIZE) == 0)
+        # bounds used by the pruning search, computed on the values that
+        # wagomu compares
+        for feat in features:
+            write_floats(f, *get_template_bounds(feat))
 
-        # stroke data
-        for sc in stroke_counts:
-            for utf8, feat in chargroups[sc]:
-                assert(f.tell() % (VECTOR_DIMENSION_MAX * FLOAT_SIZE) == 0)
+        # signatures used by the coarse pass
+        if self._coarse_resolution > 0:
+            for feat in features:
+                write_floats(f, *get_signature(feat,
+                                               self._coarse_resolution))
+
+        assert(f.tell() == templates_offset)
 
-                # stroke data as flat list of vectors
-                # e.g. [[x1, y1], [x2, y2]] is stored as [x1, y1, x2, y2]
-                write_floats(f, *feat)
+        # stroke data as flat list of vectors
+        # e.g. [[x1, y1], [x2, y2]] is stored as [x1, y1, x2, y2]
+        for d in data:
+            f.write(d)
 
         f.close()
             
@@ -22,6 +22,8 @@
 import glob
 import os
 import imp
+import hashlib
+import threading
 
 from tegaki.engine import Engine
 from tegaki.dictutils import SortedDict
@@ -54,6 +56,119 @@ class Results(list):
                     for c in cand]
         return Results(zip(cand, self.get_scores()))
 
+class RecognitionCache(object):
+    """
+    The results of the last recognized writings, by key. When the cache is
+    full, the least recently used results are evicted.
+
+    A cache can be used from several threads.
+    """
+
+    def __init__(self, size):
+        """
+        @type size: int
+        @param size: the maximum number of results, 0 disables the cache
+        """
+        self._size = size
+        # the least recently used key comes first
+        self._results = SortedDict()
+        self._lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get_size(self):
+        return self._size
+
+    def set_size(self, size):
+        self._lock.acquire()
+        try:
+            self._size = size
+            while len(self._results) > size:
+                self._results.pop(self._results.keyOrder[0])
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """
+        Returns the results of key, or None.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._results:
+                self.n_hits += 1
+                # the key becomes the most recently used one
+                results = self._results.pop(key)
+                self._results[key] = results
+                return results
+            else:
+                self.n_misses += 1
+                return None
+        finally:
+            self._lock.release()
+
+    def set(self, key, results):
+        self._lock.acquire()
+        try:
+            if self._size == 0:
+                return
+
+            self._results.pop(key, None)
+
+            if len(self._results) >= self._size:
+                self._results.pop(self._results.keyOrder[0])
+
+            self._results[key] = results
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._results = SortedDict()
+        finally:
+            self._lock.release()
+
+class RecognizerSession(object):
+    """
+    Recognizes a writing which grows stroke by stroke, e.g. while it is
+    being drawn.
+
+    Sessions are created with L{Recognizer.new_session}. The writing passed
+    to L{recognize} is usually the writing of the previous call with one
+    more stroke. Recognizers which support it then reuse the work done for
+    the previous strokes, so that the time taken by each call doesn't grow
+    with the number of strokes. Results are the same as those of
+    L{Recognizer.recognize}.
+    """
+
+    def __init__(self, recognizer):
+        self._recognizer = recognizer
+
+    def recognize(self, writing, n=10):
+        """
+        Recognizes handwriting.
+
+        @type writing: L{Writing}
+        @param writing: the handwriting to recognize
+
+        @type n: int
+        @param n: the number of candidates to return
+
+        @rtype: list
+        @return: a list of tuple (label, probability/distance)
+        """
+        return self._recognizer._recognize_with_cache(writing, n,
+                                                      self._recognize)
+
+    def reset(self):
+        """
+        Forgets the previous writing, e.g. when a new character is started.
+        """
+        pass
+
+    def _recognize(self, writing, n=10):
+        return self._recognizer._recognize(writing, n)
+
 class RecognizerError(Exception):
     """
     Raised when something went wrong in a Recognizer.
@@ -75,11 +190,19 @@ class Recognizer(Engine):
     recognizers.
 
     Recognizers usually have a corresponding L{Trainer}.
+
+    The results of the last recognized writings are kept in a
+    L{RecognitionCache}, so that writings which are recognized again, e.g.
+    after a stroke was undone, are not searched again.
     """
 
+    #: number of results kept by the recognition cache, 0 disables it
+    CACHE_SIZE = 100
+
     def __init__(self):
         self._model = None
         self._lang = None
+        self._cache = RecognitionCache(self.CACHE_SIZE)
    
     @classmethod
     def get_available_recognizers(cls):
@@ -222,6 +345,8 @@ class Recognizer(Engine):
 
         self._model = model_name
 
+        self.clear_cache()
+
         meta = self.__class__.get_available_models()[model_name]
 
         self.set_options(meta)
@@ -246,17 +371,108 @@ class Recognizer(Engine):
         
         A model must be loaded with open or set_model() beforehand.
         """
+        return self._recognize_with_cache(writing, n, self._recognize)
+
+    def _recognize_with_cache(self, writing, n, recognize, key=None):
+        """
+        Returns recognize(writing, n), from the cache if possible.
+
+        key is the cache key of writing if the caller already computed it,
+        e.g. from features which recognize then uses.
+        """
         is_small = False
         if self._lang == "ja":
             is_small = writing.is_small()
 
-        results = self._recognize(writing, n)
+        if self._cache.get_size() > 0:
+            if key is None:
+                key = self._get_cache_key(writing)
+            key = (key, n)
+            results = self._cache.get(key)
+
+            if results is None:
+                results = recognize(writing, n)
+                self._cache.set(key, results)
+
+            # callers may modify the results
+            results = Results(results)
+        else:
+            results = recognize(writing, n)
 
         if is_small:
             return results.to_small_kana()
         else:
             return results
 
+    def _get_cache_key(self, writing):
+        """
+        Returns a string which identifies the writings that the model can't
+        tell apart from writing. Recognizers which normalize writings should
+        rather hash the normalized writing.
+        """
+        return hashlib.sha1(writing.to_xml()).hexdigest()
+
+    def get_cache(self):
+        """
+        Returns the recognition cache, which also counts hits and misses.
+
+        @rtype: L{RecognitionCache}
+        """
+        return self._cache
+
+    def clear_cache(self):
+        """
+        Empties the recognition cache. Must be called whenever the results
+        of a writing may change, e.g. when the model or the options change.
+        """
+        self._cache.clear()
+
+    def recognize_batch(self, writings, n=10):
+        """
+        Recognizes several handwritings at once.
+
+        @type writings: list of L{Writing}
+        @param writings: the handwritings to recognize
+
+        @type n: int
+        @param n: the number of candidates to return for each writing
+
+        @rtype: list
+        @return: a list containing, for each writing, the list of tuples \
+                 (label, probability/distance) that L{recognize} returns
+
+        Recognizers that support it score all the writings in a single call,
+        which is much faster than calling L{recognize} for each writing.
+        """
+        writings = list(writings)
+
+        if self._lang == "ja":
+            is_small = [writing.is_small() for writing in writings]
+        else:
+            is_small = [False] * len(writings)
+
+        batch = self._recognize_batch(writings, n)
+
+        for i in range(len(batch)):
+            if is_small[i]:
+                batch[i] = batch[i].to_small_kana()
+
+        return batch
+
+    def _recognize_batch(self, writings, n=10):
+        return [self._recognize(writing, n) for writing in writings]
+
+    def new_session(self):
+        """
+        Creates a session to recognize a writing stroke by stroke.
+
+        @rtype: L{RecognizerSession}
+
+        The session uses the model of the recognizer, which must be loaded
+        beforehand.
+        """
+        return RecognizerSession(self)
+
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2008-2009 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""
+Unit tests for the compact storage of strokes.
+"""
+
+import random
+import unittest
+
+from tegaki.character import Character, CompactStroke, Point, PointView
+from tegaki.character import Stroke, Writing
+
+class CompactStrokeTest(unittest.TestCase):
+    """
+    Tests that a L{CompactStroke} behaves like a dict-backed L{Stroke}.
+    """
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.points = []
+        for i in range(20):
+            point = Point(x=rand.randint(0, 1000), y=rand.randint(0, 1000))
+            # optional attributes are only set on some points
+            if i % 2 == 0:
+                point.pressure = rand.randint(0, 4) / 4.0
+            if i % 3 == 0:
+                point.xtilt = rand.randint(-4, 4) / 4.0
+                point.ytilt = rand.randint(-4, 4) / 4.0
+            if i > 5:
+                point.timestamp = i * 10
+            self.points.append(point)
+
+    def _get_strokes(self):
+        stroke = Stroke()
+        compact = CompactStroke()
+        for point in self.points:
+            stroke.append_point(point.copy())
+            compact.append_point(point)
+        return stroke, compact
+
+    def testOptionalAttributes(self):
+        """Test that missing attributes are read back as None."""
+        stroke, compact = self._get_strokes()
+        self.assertEquals(len(compact), len(stroke))
+        for point, view in zip(stroke, compact):
+            self.assert_(isinstance(view, PointView))
+            for key in Point.KEYS:
+                self.assertEquals(view[key], point[key])
+                self.assertEquals(getattr(view, key), point[key])
+        self.assertEquals(compact[0].timestamp, None)
+        self.assertEquals(compact[1].pressure, None)
+
+        # setting and unsetting an attribute through a view
+        compact[1].pressure = 0.5
+        self.assertEquals(compact[1].pressure, 0.5)
+        compact[1].pressure = None
+        self.assertEquals(compact[1].pressure, None)
+
+        # an attribute that no point has yet
+        compact = CompactStroke()
+        compact.append_point(Point(x=1, y=2))
+        compact.append_point(Point(x=3, y=4))
+        self.assertEquals(compact[0].timestamp, None)
+        compact[1].timestamp = 42
+        self.assertEquals(compact[0].timestamp, None)
+        self.assertEquals(compact[1].timestamp, 42)
+
+    def testResize(self):
+        """Test that scaling gives the same points as a Stroke."""
+        stroke, compact = self._get_strokes()
+        stroke.resize(0.37, 1.5)
+        compact.resize(0.37, 1.5)
+        self.assertEquals(compact, stroke)
+        self.assertEquals(compact.get_coordinates(), stroke.get_coordinates())
+
+    def testMoveRel(self):
+        """Test that translating gives the same points as a Stroke."""
+        stroke, compact = self._get_strokes()
+        stroke.move_rel(-15, 40)
+        compact.move_rel(-15, 40)
+        self.assertEquals(compact, stroke)
+        self.assertEquals(compact.get_coordinates(), stroke.get_coordinates())
+
+    def testCopy(self):
+        """Test that copies don't share their points."""
+        stroke, compact = self._get_strokes()
+
+        c = compact.copy()
+        self.assert_(isinstance(c, CompactStroke))
+        self.assertEquals(c, compact)
+        c.move_rel(1, 1)
+        c[0].pressure = 0.75
+        self.assertEquals(compact, stroke)
+        self.assertNotEqual(c, compact)
+
+        # copying from a dict-backed stroke
+        c = CompactStroke()
+        c.copy_from(stroke)
+        self.assertEquals(c, stroke)
+
+        # copying a point from a view
+        point = compact[2].copy()
+        self.assert_(isinstance(point, Point))
+        self.assertEquals(point, stroke[2])
+        point.x += 1
+        self.assertEquals(compact[2], stroke[2])
+
+    def testXmlRoundTrip(self):
+        """Test that characters read from XML are equal with both storage
+        modes."""
+        char = Character()
+        char.set_utf8("a")
+        writing = char.get_writing()
+        for i in range(0, len(self.points), 5):
+            writing.append_stroke(Stroke())
+            for point in self.points[i:i+5]:
+                writing.get_strokes(full=True)[-1].append_point(point)
+        xml = char.to_xml()
+
+        try:
+            Writing.STROKE_CLASS = CompactStroke
+            compact_char = Character()
+            compact_char.read_string(xml)
+        finally:
+            Writing.STROKE_CLASS = Stroke
+
+        strokes = compact_char.get_writing().get_strokes(full=True)
+        self.assertEquals(len(strokes), 4)
+        for stroke in strokes:
+            self.assert_(isinstance(stroke, CompactStroke))
+        self.assertEquals(compact_char, char)
+        self.assertEquals(compact_char.to_xml(), xml)
+
+        dict_char = Character()
+        dict_char.read_string(xml)
+        self.assertEquals(compact_char, dict_char)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2008-2009 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""
+Unit tests for character collections.
+"""
+
+import base64
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from tegaki.character import Character, Point, Stroke, Writing
+from tegaki.charcol import CharacterCollection, _BLOB_MAGIC, _DB_VERSION
+
+class BulkLoadTest(unittest.TestCase):
+    """
+    Tests that the changes made during a bulk load are either all committed
+    or all rolled back.
+    """
+
+    def setUp(self):
+        self._charcol = CharacterCollection()
+        self._charcol.add_set("set")
+        self._charcol.append_characters("set",
+                                        [self._get_character(utf8)
+                                         for utf8 in ("a", "b", "c")])
+        self._charcol.commit()
+
+    def _get_character(self, utf8):
+        char = Character()
+        char.set_utf8(utf8)
+        return char
+
+    def _get_utf8(self):
+        return [char.get_utf8()
+                for char in self._charcol.get_all_characters()]
+
+    def _bulk_load(self, change, fail):
+        try:
+            with self._charcol.bulk_load():
+                self._charcol.append_characters("set",
+                                                [self._get_character("d")])
+                change()
+                if fail:
+                    raise ValueError
+        except ValueError:
+            pass
+
+    def testRollback(self):
+        """Test changes rolled back after an exception."""
+        self._bulk_load(lambda: None, True)
+        self.assertEquals(self._get_utf8(), ["a", "b", "c"])
+
+    def testExcludeRollback(self):
+        """Test characters excluded then rolled back."""
+        self._bulk_load(lambda: \
+                        self._charcol.exclude_characters_from_text("a"), True)
+        self.assertEquals(self._get_utf8(), ["a", "b", "c"])
+
+    def testIncludeRollback(self):
+        """Test characters included then rolled back."""
+        self._bulk_load(lambda: \
+                        self._charcol.include_characters_from_text("ad"), True)
+        self.assertEquals(self._get_utf8(), ["a", "b", "c"])
+
+    def testExcludeCommit(self):
+        """Test characters excluded then committed."""
+        self._bulk_load(lambda: \
+                        self._charcol.exclude_characters_from_text("a"), False)
+        self.assertEquals(self._get_utf8(), ["b", "c", "d"])
+
+    def testIncludeCommit(self):
+        """Test characters included then committed."""
+        self._bulk_load(lambda: \
+                        self._charcol.include_characters_from_text("ad"), False)
+        self.assertEquals(self._get_utf8(), ["a", "d"])
+
+class PagingTest(unittest.TestCase):
+    """
+    Tests that characters read page by page are those of a single query.
+    """
+
+    N_CHARACTERS = 23
+
+    def setUp(self):
+        self._charcol = CharacterCollection()
+        for set_name in ("set1", "set2"):
+            self._charcol.add_set(set_name)
+        for i in range(self.N_CHARACTERS):
+            char = Character()
+            char.set_utf8(unichr(0x4e00 + i).encode("utf8"))
+            char.get_writing().move_to(i, i)
+            # sets are interleaved so that their characters aren't
+            # consecutive
+            self._charcol.append_character("set%d" % (i % 2 + 1), char)
+        self._charcol.commit()
+
+        self._utf8 = [unichr(0x4e00 + i).encode("utf8")
+                      for i in range(self.N_CHARACTERS)]
+        # pages smaller than the sets
+        self._charcol.BATCH_SIZE = 4
+
+    def _get_utf8(self, chars):
+        return [char.get_utf8() for char in chars]
+
+    def testLimitOffset(self):
+        """Test limits and offsets within and across pages."""
+        for limit in (-1, 0, 1, 3, 4, 5, 8, 9, 30):
+            for offset in (0, 1, 3, 4, 5, 8, 22, 23, 30):
+                expected = self._utf8[offset:]
+                expected_set2 = self._utf8[1::2][offset:]
+                if limit >= 0:
+                    expected = expected[:limit]
+                    expected_set2 = expected_set2[:limit]
+
+                chars = self._charcol.get_all_characters(limit, offset)
+                self.assertEquals(self._get_utf8(chars), expected)
+                chars = self._charcol.get_characters("set2", limit, offset)
+                self.assertEquals(self._get_utf8(chars), expected_set2)
+
+    def _assertGenerators(self, pool):
+        self.assertEquals(
+            self._get_utf8(self._charcol.get_all_characters_gen(pool=pool)),
+            self._utf8)
+        self.assertEquals(
+            self._get_utf8(self._charcol.get_characters_gen("set1",
+                                                            pool=pool)),
+            self._utf8[::2])
+        self.assertEquals(
+            self._get_utf8(self._charcol.get_all_characters_gen(9, 2,
+                                                                pool=pool)),
+            self._utf8[2:11])
+
+    def testGenerators(self):
+        """Test generators over several pages."""
+        self._assertGenerators(None)
+
+    def testGeneratorsWithPool(self):
+        """Test generators over several pages decoded by a pool."""
+        pool = multiprocessing.Pool(2)
+        try:
+            self._assertGenerators(pool)
+            chars = list(self._charcol.get_all_characters_gen(pool=pool))
+            self.assertEquals(chars, self._charcol.get_all_characters())
+        finally:
+            pool.terminate()
+
+class DbFormatTest(unittest.TestCase):
+    """
+    Tests that characters are stored in .chardb files without losing any
+    attribute, and that files in the previous format are converted.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, "test.chardb")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _get_character(self, utf8, points_list, width=1000, height=1000):
+        char = Character()
+        char.set_utf8(utf8)
+        writing = Writing()
+        writing.set_width(width)
+        writing.set_height(height)
+        for points in points_list:
+            stroke = Stroke()
+            for point in points:
+                stroke.append_point(point)
+            writing.append_stroke(stroke)
+        char.set_writing(writing)
+        return char
+
+    def _get_characters(self):
+        return [
+            # coordinates only
+            self._get_character("a", [[Point(1, 2), Point(3, 4)],
+                                      [Point(-5, 70000)]]),
+            # all the attributes, floats which aren't exact in float32
+            # and timestamps which don't fit in 32 bits
+            self._get_character("b", [[Point(1, 2, 0.1, 0.2, 0.3, 0),
+                                       Point(3, 4, 0.5, 0.25, 0.125,
+                                             2**40)]],
+                                width=500, height=300),
+            # attributes which only some points have
+            self._get_character("c", [[Point(1, 2, pressure=0.5),
+                                       Point(3, 4, timestamp=10),
+                                       Point(5, 6, xtilt=1.5, ytilt=-1.5)]]),
+            # empty strokes
+            self._get_character("d", [[], [Point(1, 2)], []]),
+            # no strokes and no utf8
+            self._get_character(None, []),
+        ]
+
+    def _assertCharactersEqual(self, chars, other_chars):
+        self.assertEquals(len(chars), len(other_chars))
+        for char, other_char in zip(chars, other_chars):
+            self.assertEquals(char.get_utf8(), other_char.get_utf8())
+            self.assertEquals(char.get_writing(), other_char.get_writing())
+            self.assertEquals(
+                [len(s) for s in char.get_writing().get_strokes(True)],
+                [len(s) for s in other_char.get_writing().get_strokes(True)])
+
+    def testRoundTrip(self):
+        """Test characters written to and read from a .chardb file."""
+        chars = self._get_characters()
+        charcol = CharacterCollection(self._path)
+        charcol.add_set("set")
+        charcol.append_characters("set", chars)
+        charcol.commit()
+
+        for row in charcol.get_character_rows("set"):
+            self.assertEquals(str(row['data'][:len(_BLOB_MAGIC)]),
+                              _BLOB_MAGIC)
+
+        charcol = CharacterCollection(self._path)
+        self._assertCharactersEqual(charcol.get_all_characters(), chars)
+
+    def testDbVersion(self):
+        """Test the format version of a new .chardb file."""
+        CharacterCollection(self._path).commit()
+        con = sqlite3.connect(self._path)
+        self.assertEquals(con.execute("PRAGMA user_version").fetchone()[0],
+                          _DB_VERSION)
+        con.close()
+
+    def _write_version_1(self, chars):
+        # characters were stored as base64-encoded gzipped XML
+        charcol = CharacterCollection(self._path)
+        charcol.add_set("set")
+        charcol.commit()
+        del charcol
+
+        con = sqlite3.connect(self._path)
+        con.executemany("""INSERT INTO characters(setid, utf8, n_strokes, data)
+VALUES (1, ?, ?, ?)""", [(char.get_utf8(),
+                          char.get_writing().get_n_strokes(),
+                          base64.b64encode(char.write_string(gzip=True)))
+                         for char in chars])
+        con.execute("PRAGMA user_version=1")
+        con.commit()
+        con.close()
+
+    def _get_data_formats(self, charcol):
+        return [str(row['data'][:len(_BLOB_MAGIC)]) == _BLOB_MAGIC
+                for row in charcol.get_character_rows("set")]
+
+    def _get_xml_characters(self):
+        # empty strokes are dropped by the XML parser
+        return [char for char in self._get_characters()
+                if not char.get_utf8() == "d"]
+
+    def testMigrate(self):
+        """Test a .chardb file in the previous format converted on bind."""
+        chars = self._get_xml_characters()
+        self._write_version_1(chars)
+
+        charcol = CharacterCollection(self._path)
+        self.assertEquals(self._get_data_formats(charcol),
+                          [True] * len(chars))
+        self._assertCharactersEqual(charcol.get_all_characters(), chars)
+
+        con = sqlite3.connect(self._path)
+        self.assertEquals(con.execute("PRAGMA user_version").fetchone()[0],
+                          _DB_VERSION)
+        con.close()
+
+    def testNoAutoMigrate(self):
+        """Test a .chardb file in the previous format read as it is."""
+        chars = self._get_xml_characters()
+        self._write_version_1(chars)
+
+        class Collection(CharacterCollection):
+            AUTO_MIGRATE = False
+
+        charcol = Collection(self._path)
+        self.assertEquals(self._get_data_formats(charcol),
+                          [False] * len(chars))
+        self._assertCharactersEqual(charcol.get_all_characters(), chars)
+
+        charcol.migrate()
+        self.assertEquals(self._get_data_formats(charcol),
+                          [True] * len(chars))
+        self._assertCharactersEqual(charcol.get_all_characters(), chars)
+
+if __name__ == "__main__":
+    unittest.main()
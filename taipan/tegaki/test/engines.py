@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2008-2009 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Unit tests for the recognition engines.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from tegaki.character import Character, Writing
+from tegaki.charcol import CharacterCollection
+from tegaki.engines import tegakiwagomu
+
+class WagomuSessionTest(unittest.TestCase):
+    """
+    Tests that wagomu sessions give the results of the recognizer whatever
+    the writings they are given.
+    """
+
+    N_CHARACTERS = 200
+    N_TRIALS = 40
+
+    def setUp(self):
+        self._random = random.Random(0)
+
+        charcol = CharacterCollection()
+        for i in range(self.N_CHARACTERS):
+            utf8 = unichr(0x4e00 + i).encode("utf8")
+            charcol.add_set(utf8)
+            char = Character()
+            char.set_utf8(utf8)
+            char.set_writing(self._get_writing(self._random.randint(1, 14)))
+            charcol.append_character(utf8, char)
+
+        self._dir = tempfile.mkdtemp()
+        path = os.path.join(self._dir, "test.model")
+        trainer = tegakiwagomu.WagomuTrainer()
+        # the trainer prints its progress
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            # the model has signatures for the coarse pass
+            trainer.train(charcol, {"name": "test", "shortname": "t",
+                                    "coarse_resolution": "8"}, path)
+        finally:
+            sys.stdout = stdout
+
+        self._recognizer = tegakiwagomu.WagomuRecognizer()
+        self._recognizer.open(path)
+        # sessions share the cache of the recognizer, which would return
+        # the results of the session instead of those of the recognizer
+        self._recognizer.get_cache().set_size(0)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _get_writing(self, n_strokes):
+        """
+        Returns a random writing whose first stroke spans the whole writing,
+        so that the features of its first strokes don't depend on the
+        following ones.
+        """
+        writing = Writing()
+        writing.move_to(0, 0)
+        writing.line_to(1000, 1000)
+        for i in range(n_strokes - 1):
+            x = self._random.randint(0, 1000)
+            y = self._random.randint(0, 1000)
+            writing.move_to(x, y)
+            for j in range(self._random.randint(1, 25)):
+                x = min(1000, max(0, x + self._random.randint(-60, 60)))
+                y = min(1000, max(0, y + self._random.randint(-60, 60)))
+                writing.line_to(x, y)
+        return writing
+
+    def _get_prefix(self, writing, n_strokes):
+        prefix = writing.copy()
+        while prefix.get_n_strokes() > n_strokes:
+            prefix.remove_last_stroke()
+        return prefix
+
+    def testStrokeByStroke(self):
+        """Test writings recognized as they are drawn."""
+        session = self._recognizer.new_session()
+        for i in range(self.N_TRIALS):
+            writing = self._get_writing(self._random.randint(1, 14))
+            session.reset()
+            for n_strokes in range(1, writing.get_n_strokes() + 1):
+                prefix = self._get_prefix(writing, n_strokes)
+                self.assertEquals(session.recognize(prefix),
+                                  self._recognizer.recognize(prefix))
+
+    def testShorterPrefix(self):
+        """
+        Test a writing recognized after a longer writing of which it is a
+        prefix, itself recognized after another writing.
+        """
+        session = self._recognizer.new_session()
+        for i in range(self.N_TRIALS):
+            n_strokes = self._random.randint(1, 6)
+
+            # a writing with as many strokes as the prefix but fewer points,
+            # whose templates aren't compared with the longer writing, which
+            # has many more strokes
+            other = Writing()
+            for j in range(n_strokes):
+                other.move_to(self._random.randint(0, 1000),
+                              self._random.randint(0, 1000))
+                other.line_to(self._random.randint(0, 1000),
+                              self._random.randint(0, 1000))
+            longer = self._get_writing(self._random.randint(n_strokes + 8,
+                                                            n_strokes + 10))
+            shorter = self._get_prefix(longer, n_strokes)
+
+            # the features of the prefix are those of the longer writing
+            longer_feat = self._recognizer.get_features(longer).tolist()
+            shorter_feat = self._recognizer.get_features(shorter).tolist()
+            self.assertEquals(longer_feat[:len(shorter_feat)], shorter_feat)
+
+            session.recognize(other)
+            session.recognize(longer)
+            self.assertEquals(session.recognize(shorter),
+                              self._recognizer.recognize(shorter))
+
+    def testCoarsePass(self):
+        """Test writings recognized with a coarse pass."""
+        self._recognizer.set_options({"n_candidates": "20"})
+        session = self._recognizer.new_session()
+        for i in range(self.N_TRIALS):
+            writing = self._get_writing(self._random.randint(1, 14))
+            session.reset()
+            for n_strokes in range(1, writing.get_n_strokes() + 1):
+                prefix = self._get_prefix(writing, n_strokes)
+                self.assertEquals(session.recognize(prefix),
+                                  self._recognizer.recognize(prefix))
+
+if not hasattr(tegakiwagomu, "WagomuRecognizer"):
+    # the wagomu extension is not built
+    del WagomuSessionTest
+
+if __name__ == "__main__":
+    unittest.main()
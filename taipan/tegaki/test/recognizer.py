@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2008-2009 The Tegaki project contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""
+Unit tests for the recognizer base classes.
+"""
+
+import unittest
+
+from tegaki.character import Writing
+from tegaki.recognizer import Recognizer, RecognitionCache, Results
+
+class RecognitionCacheTest(unittest.TestCase):
+    """
+    Tests that the cache keeps the most recently used results.
+    """
+
+    def testEviction(self):
+        """Test that the least recently used results are evicted."""
+        cache = RecognitionCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # "a" becomes more recently used than "b"
+        self.assertEquals(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.get("a"), 1)
+        self.assertEquals(cache.get("c"), 3)
+
+        # setting a key again makes it the most recently used one
+        cache.set("a", 4)
+        cache.set("d", 5)
+        self.assertEquals(cache.get("c"), None)
+        self.assertEquals(cache.get("a"), 4)
+
+    def testCounters(self):
+        """Test hit and miss counters."""
+        cache = RecognitionCache(2)
+        cache.get("a")
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        self.assertEquals((cache.n_hits, cache.n_misses), (2, 2))
+
+    def testSize(self):
+        """Test that shrinking the cache evicts the oldest results."""
+        cache = RecognitionCache(3)
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        cache.set_size(1)
+        self.assertEquals(cache.get_size(), 1)
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.get("c"), "c")
+
+        cache.set_size(0)
+        cache.set("d", "d")
+        self.assertEquals(cache.get("c"), None)
+        self.assertEquals(cache.get("d"), None)
+
+    def testClear(self):
+        """Test that clearing the cache drops all results."""
+        cache = RecognitionCache(2)
+        cache.set("a", 1)
+        cache.clear()
+        self.assertEquals(cache.get("a"), None)
+
+class CountingRecognizer(Recognizer):
+
+    def __init__(self):
+        Recognizer.__init__(self)
+        self.n_calls = 0
+
+    def _recognize(self, writing, n=10):
+        self.n_calls += 1
+        return Results([("a", 1.0), ("b", 2.0)][:n])
+
+class RecognizerCacheTest(unittest.TestCase):
+    """
+    Tests that recognizers only search writings which aren't in their cache.
+    """
+
+    def setUp(self):
+        self._recognizer = CountingRecognizer()
+        self._writing = Writing()
+        self._writing.move_to(0, 0)
+        self._writing.line_to(100, 100)
+
+    def testHit(self):
+        """Test a writing recognized twice."""
+        results = self._recognizer.recognize(self._writing)
+        self.assertEquals(self._recognizer.recognize(self._writing.copy()),
+                          results)
+        self.assertEquals(self._recognizer.n_calls, 1)
+
+        cache = self._recognizer.get_cache()
+        self.assertEquals((cache.n_hits, cache.n_misses), (1, 1))
+
+    def testKey(self):
+        """Test writings and numbers of candidates which differ."""
+        self._recognizer.recognize(self._writing)
+        self._recognizer.recognize(self._writing, 1)
+
+        writing = self._writing.copy()
+        writing.line_to(200, 100)
+        self._recognizer.recognize(writing)
+        self.assertEquals(self._recognizer.n_calls, 3)
+
+    def testCopies(self):
+        """Test that callers can modify the results."""
+        results = self._recognizer.recognize(self._writing)
+        results.append(("c", 3.0))
+        results = self._recognizer.recognize(self._writing)
+        del results[0]
+        self.assertEquals(self._recognizer.recognize(self._writing),
+                          [("a", 1.0), ("b", 2.0)])
+
+    def testDisabled(self):
+        """Test a recognizer whose cache is disabled."""
+        cache = self._recognizer.get_cache()
+        cache.set_size(0)
+        self._recognizer.recognize(self._writing)
+        self._recognizer.recognize(self._writing)
+        self.assertEquals(self._recognizer.n_calls, 2)
+        self.assertEquals((cache.n_hits, cache.n_misses), (0, 0))
+
+    def testClear(self):
+        """Test a writing recognized again after the cache is cleared."""
+        self._recognizer.recognize(self._writing)
+        self._recognizer.clear_cache()
+        self._recognizer.recognize(self._writing)
+        self.assertEquals(self._recognizer.n_calls, 2)
+
+    def testSession(self):
+        """Test that sessions share the cache of their recognizer."""
+        self._recognizer.recognize(self._writing)
+        self._recognizer.new_session().recognize(self._writing)
+        self.assertEquals(self._recognizer.n_calls, 1)
+
+if __name__ == "__main__":
+    unittest.main()
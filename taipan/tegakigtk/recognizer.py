@@ -20,6 +20,8 @@
 # - Mathieu Blondel
 
 import os
+import time
+import threading
 from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
 
 import gtk
@@ -46,8 +48,14 @@ class RecognizerWidgetBase(gtk.HBox):
         gtk.HBox.__init__(self)
 
         self._recognizer = None
+        # recognition sessions of the canvases, see _get_session
+        self._sessions = {}
         self._search_on_stroke = True
 
+        # the canvas stays responsive while writings are recognized
+        self._worker = RecognitionWorker()
+        self.connect("destroy", self._on_destroy)
+
         self._create_ui()
         self.clear_canvas()
         self.clear_characters()
@@ -204,6 +212,9 @@ class RecognizerWidgetBase(gtk.HBox):
     def _on_clear(self, button):
         self.clear_canvas()
 
+    def _on_destroy(self, widget):
+        self._worker.stop()
+
     def clear_all(self):
         self.clear_characters()
         self.clear_canvas()
@@ -227,6 +238,7 @@ class RecognizerWidgetBase(gtk.HBox):
             klass = Recognizer.get_available_recognizers()[r_name]
             self._recognizer = klass()
             self._recognizer.set_model(meta["name"])
+            self._sessions = {}
             self._models_button.set_label(meta["shortname"])
             # a hack to retain the model id the button
             self._models_button.selected_model = i
@@ -238,6 +250,39 @@ class RecognizerWidgetBase(gtk.HBox):
     def get_toolbar_vbox(self):
         return self._toolbar
 
+    def get_latency(self):
+        """
+        Returns the time, in milliseconds, between the last writing being
+        submitted for recognition and its candidates being displayed, or
+        None if no candidates were displayed yet.
+        """
+        return self._worker.get_latency()
+
+    def get_mean_latency(self):
+        """
+        Returns the mean of the latencies that L{get_latency} returned so far,
+        or None.
+        """
+        return self._worker.get_mean_latency()
+
+    def _get_session(self, canvas):
+        """
+        Returns the recognition session of canvas. Since the writing of a
+        canvas grows stroke by stroke, the session only has to compare the
+        last strokes with the model when search on stroke is enabled.
+        """
+        if not canvas in self._sessions:
+            self._sessions[canvas] = self._recognizer.new_session()
+        return self._sessions[canvas]
+
+    def _reset_session(self, canvas):
+        """
+        Makes the session of canvas forget its writing, once the canvas is
+        cleared for a new character.
+        """
+        if canvas in self._sessions:
+            self._worker.reset(self._sessions[canvas])
+
 class SimpleRecognizerWidget(RecognizerWidgetBase):
 
     def __init__(self):
@@ -287,6 +332,8 @@ class SimpleRecognizerWidget(RecognizerWidgetBase):
         self.emit("commit-string", chars[selected])
 
     def clear_canvas(self):
+        self._worker.cancel("_canvas")
+        self._reset_session("_canvas")
         self._canvas.clear()
         self.clear_characters()
 
@@ -318,14 +365,20 @@ class SimpleRecognizerWidget(RecognizerWidgetBase):
         writing = self._canvas.get_writing().copy()
 
         if writing.get_n_strokes() > 0:
-            candidates = self._recognizer.recognize(writing, n=9)
-            candidates = [char for char, prob in candidates]
-            self._chartable.set_characters(candidates)
+            self._worker.submit("_canvas", self._get_session("_canvas"),
+                                writing, 9, self._on_candidates_found)
+        else:
+            self._worker.cancel("_canvas")
+
+    def _on_candidates_found(self, writing, candidates):
+        candidates = [char for char, prob in candidates]
+        self._chartable.set_characters(candidates)
 
     def get_writing(self):
         self._canvas.get_writing()
 
     def set_writing(self, writing):
+        self._reset_session("_canvas")
         self._canvas.set_writing(writing)
 
 class SmartRecognizerWidget(RecognizerWidgetBase):
@@ -334,6 +387,12 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
     CURR_CANVAS_COLOR =  map(lambda x: x * 256, (255, 235, 235))
 
     def __init__(self):
+        # requests are made by character rather than by canvas, since the
+        # previous character of a canvas may still be being recognized when
+        # a new one is started on it
+        self._char_ids = {}
+        self._next_char_id = 0
+
         RecognizerWidgetBase.__init__(self)
 
     def _create_toolbar(self):
@@ -391,14 +450,27 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
             return
 
         writing = writing.copy()
-        candidates = self._recognizer.recognize(writing)
+
+        if not canvas in self._char_ids:
+            self._char_ids[canvas] = self._next_char_id
+            self._next_char_id += 1
+        char_id = self._char_ids[canvas]
+        self._last_submitted_canvas = canvas
+
+        def callback(writing, candidates):
+            self._on_candidates_found(char_id, writing, candidates)
+
+        self._worker.submit((canvas, char_id), self._get_session(canvas),
+                            writing, 10, callback)
+
+    def _on_candidates_found(self, char_id, writing, candidates):
         candidates = [char for char, prob in candidates]     
         
         if candidates:
             candidate_list = CandidateList(candidates)
 
-            if canvas == self._last_completed_canvas:
-                # update the current character if the same canvas was used
+            if char_id == self._last_completed_char:
+                # update the current character if it was found again
                 last = len(self.get_characters()) - 1
                 self.replace_character(last, candidate_list)
                 self._writings[last] = writing
@@ -407,7 +479,7 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
                 self.add_character(candidate_list)
                 self._writings.append(writing)
 
-        self._last_completed_canvas = canvas
+        self._last_completed_char = char_id
 
     def _other_canvas(self, canvas):
         if canvas == "_canvas1":
@@ -430,10 +502,14 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
         othr_canv = self._other_canvas(curr_canv)
 
         if self._focused_canvas == othr_canv:
+            # a new character is started, the results of the previous
+            # character of the canvas are still added when they are found
+            self._char_ids.pop(curr_canv, None)
+            self._reset_session(curr_canv)
             getattr(self, curr_canv).clear()
 
             if getattr(self, othr_canv).get_writing().get_n_strokes() > 0 and \
-               self._last_completed_canvas != othr_canv and \
+               self._last_submitted_canvas != othr_canv and \
                not self._search_on_stroke:
 
                 self._find(othr_canv)
@@ -513,13 +589,19 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
         self._chartable.unselect()
 
     def clear_canvas(self):
+        for canvas, char_id in self._char_ids.items():
+            self._worker.cancel((canvas, char_id))
+        self._char_ids = {}
+        self._last_submitted_canvas = None
+        self._reset_session("_canvas1")
+        self._reset_session("_canvas2")
         self._canvas1.clear()
             
         if self._canvas2:
             self._canvas2.clear()
         
         self._set_canvas_focus("_canvas1")
-        self._last_completed_canvas = None
+        self._last_completed_char = None
 
     def delete_character(self):
         try:
@@ -581,6 +663,175 @@ class SmartRecognizerWidget(RecognizerWidgetBase):
         if self._focused_canvas:
             self._find(self._focused_canvas)
 
+class RecognitionWorker(object):
+    """
+    Recognizes writings in a background thread, so that the main loop isn't
+    blocked while the model is searched.
+
+    Requests have a key, e.g. the name of a canvas. A request replaces the
+    pending request with the same key, if any, and the results of a request
+    which was superseded or cancelled in the meantime are dropped. Results
+    are passed to the callback of their request in the main loop.
+    """
+
+    def __init__(self):
+        # needed for Python threads to run along the main loop
+        gobject.threads_init()
+
+        self._cond = threading.Condition()
+        # pending requests by key and their keys in submission order
+        self._pending = {}
+        self._keys = []
+        # the results of a request are only used if the generation of its
+        # key didn't change since it was submitted
+        self._generations = {}
+        # sessions to reset before their next request
+        self._resets = set()
+        self._stopped = False
+
+        self._latency = None
+        self._total_latency = 0.0
+        self._n_latencies = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def submit(self, key, session, writing, n, callback):
+        """
+        Requests the recognition of a writing.
+
+        @param key: requests with the same key supersede each other, any \
+                    hashable value
+        @type session: L{RecognizerSession}
+        @param session: the session which recognizes the writing
+        @type writing: L{Writing}
+        @param writing: the writing, which must not be modified afterwards
+        @type n: int
+        @param n: the number of candidates
+        @param callback: called as callback(writing, candidates) in the \
+                         main loop
+        """
+        self._cond.acquire()
+        try:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+
+            if not key in self._pending:
+                self._keys.append(key)
+            self._pending[key] = (generation, session, writing, n, callback,
+                                  time.time())
+
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def cancel(self, key):
+        """
+        Drops the pending request with that key and the results of the
+        requests with that key which are being processed.
+        """
+        self._cond.acquire()
+        try:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+            if key in self._pending:
+                del self._pending[key]
+                self._keys.remove(key)
+        finally:
+            self._cond.release()
+
+    def reset(self, session):
+        """
+        Resets the session before it recognizes its next writing. Sessions
+        aren't reset by the caller, since they may be recognizing a writing
+        in the thread at the same time.
+
+        @type session: L{RecognizerSession}
+        """
+        self._cond.acquire()
+        try:
+            self._resets.add(session)
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """
+        Stops the thread once the current request is processed.
+        """
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def get_latency(self):
+        """
+        Returns the time, in milliseconds, between the submission of the last
+        request whose results were delivered and the return of its callback,
+        or None.
+        """
+        return self._latency
+
+    def get_mean_latency(self):
+        if self._n_latencies == 0:
+            return None
+        else:
+            return self._total_latency / self._n_latencies
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._keys and not self._stopped:
+                    self._cond.wait()
+
+                if self._stopped:
+                    return
+
+                key = self._keys.pop(0)
+                request = self._pending.pop(key)
+                generation, session, writing, n, callback, start = request
+
+                reset = session in self._resets
+                self._resets.discard(session)
+            finally:
+                self._cond.release()
+
+            try:
+                if reset:
+                    session.reset()
+                candidates = session.recognize(writing, n)
+                error = None
+            except Exception, e:
+                candidates = None
+                error = e
+
+            gobject.idle_add(self._deliver, key, generation, writing,
+                             candidates, error, callback, start)
+
+    def _deliver(self, key, generation, writing, candidates, error, callback,
+                 start):
+        self._cond.acquire()
+        try:
+            superseded = self._generations.get(key) != generation
+        finally:
+            self._cond.release()
+
+        if not superseded:
+            if error is not None:
+                raise error
+
+            callback(writing, candidates)
+
+            self._latency = (time.time() - start) * 1000
+            self._total_latency += self._latency
+            self._n_latencies += 1
+
+        # called only once
+        return False
+
 class CandidatePopup(gtk.Window):
 
     __gsignals__ = {
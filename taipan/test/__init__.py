@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Unit tests for the taipan modules, run from the taipan directory with
+   python -m unittest test.<module>"""
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Unit tests for the headword completion index"""
+from __future__ import absolute_import
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import cPickle
+
+from completion import HeadwordIndex
+
+class Entry(object):
+    def __init__(self, simplified, traditional, reading):
+        self.HeadwordSimplified = simplified
+        self.HeadwordTraditional = traditional
+        self.Reading = reading
+
+class Dictionary(object):
+    PROVIDES = 'Test'
+
+    def __init__(self, entries, version='2010-01-01'):
+        self.entries = entries
+        self.version = version
+
+    def getAll(self):
+        return iter(self.entries)
+
+class SmallIndex(HeadwordIndex):
+    """An index whose precomputed prefixes are reached by small
+       dictionaries"""
+    MAX_COMPLETIONS = 5
+    SCAN_LIMIT = 4
+    BUILD_STEP = 7
+
+class HeadwordIndexTest(unittest.TestCase):
+    """Tests completions against a linear scan of the dictionary"""
+
+    def setUp(self):
+        rand = random.Random(0)
+        entries = []
+        for i in range(300):
+            simplified = u''.join(rand.choice(u'中国人大学')
+                                  for j in range(rand.randint(1, 4)))
+            if rand.random() < 0.3:
+                # traditional headwords use other characters
+                traditional = u''.join(rand.choice(u'國學') + char[1:]
+                                       for char in simplified)
+            else:
+                traditional = simplified
+            entries.append(Entry(simplified, traditional,
+                                 u'r%d' % rand.randint(0, 3)))
+            if rand.random() < 0.1:
+                # entries only differing by their translation
+                entries.append(entries[-1])
+        self.dictionary = Dictionary(entries)
+
+        self.index = SmallIndex()
+        self.index.build(self.dictionary)
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.completion')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _scan(self, prefix, limit):
+        results = []
+        for entry in self.dictionary.entries:
+            item = (entry.HeadwordSimplified, entry.HeadwordTraditional,
+                    entry.Reading)
+            if item in results:
+                continue
+            if (entry.HeadwordSimplified.startswith(prefix)
+                or entry.HeadwordTraditional.startswith(prefix)):
+                results.append(item)
+        return results[:limit]
+
+    def _get_prefixes(self):
+        prefixes = set()
+        for entry in self.dictionary.entries:
+            for headword in (entry.HeadwordSimplified,
+                             entry.HeadwordTraditional):
+                for i in range(1, len(headword) + 1):
+                    prefixes.add(headword[:i])
+        return sorted(prefixes) + [u'x', u'中x']
+
+    def testComplete(self):
+        """Test completions of precomputed and scanned prefixes"""
+        n_frequent = 0
+        for prefix in self._get_prefixes():
+            if prefix in self.index._frequent:
+                n_frequent += 1
+            for limit in (1, 3, 5, 10):
+                self.assertEquals(self.index.complete(prefix, limit),
+                                  self._scan(prefix, min(limit, 5)))
+
+        # both ways of completing a prefix are tested
+        self.assert_(0 < n_frequent < len(self._get_prefixes()))
+
+    def testTraditional(self):
+        """Test prefixes only found in traditional headwords"""
+        prefixes = [prefix for prefix in self._get_prefixes()
+                    if prefix.startswith(u'國') or prefix.startswith(u'學')]
+        self.assert_(prefixes)
+        for prefix in prefixes:
+            results = self.index.complete(prefix)
+            self.assert_(results)
+            self.assertEquals(results, self._scan(prefix, 5))
+
+    def testEmptyPrefix(self):
+        """Test that an empty prefix has no completions"""
+        self.assertEquals(self.index.complete(u''), [])
+
+    def testSaveLoad(self):
+        """Test an index loaded with the key it was saved with"""
+        key = HeadwordIndex.get_key(self.dictionary)
+        self.index.save(self.path, key)
+        index = SmallIndex.load(self.path, key)
+        for prefix in self._get_prefixes():
+            self.assertEquals(index.complete(prefix),
+                              self.index.complete(prefix))
+
+    def testStaleKey(self):
+        """Test an index saved for another dictionary version"""
+        self.index.save(self.path, HeadwordIndex.get_key(self.dictionary))
+        key = HeadwordIndex.get_key(Dictionary([], version='2010-02-01'))
+        self.assertEquals(SmallIndex.load(self.path, key), None)
+
+    def testCorruptFile(self):
+        """Test files which don't hold an index"""
+        key = HeadwordIndex.get_key(self.dictionary)
+        self.assertEquals(SmallIndex.load(self.path, key), None)
+
+        self.index.save(self.path, key)
+        data = open(self.path, 'rb').read()
+        for contents in (data[:len(data) / 2], 'garbage',
+                         cPickle.dumps(['not', 'an', 'index'])):
+            f = open(self.path, 'wb')
+            f.write(contents)
+            f.close()
+            self.assertEquals(SmallIndex.load(self.path, key), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,8 +35,11 @@
 
 #include "wagomu.h"
 
+/* version 1 models are stored in the byte order of the host */
 #define MAGIC_NUMBER 0x77778888
-#define VEC_DIM_MAX 4
+/* version 2 models are stored in little-endian */
+#define MAGIC_NUMBER_V2 0x77779999
+#define MODEL_VERSION 2
 
 #undef MIN
 #define MIN(a,b) ((a) < (b) ? (a) : (b))
@@ -103,8 +106,19 @@ void Character::set_value(unsigned int i, float value) {
     points[i] = value;
 }
 
+bool Character::set_points(char *buffer, int length) {
+    if ((unsigned int) length != n_vectors * VEC_DIM_MAX * sizeof(float))
+        return false;
+
+    if (n_vectors > 0)
+        memcpy(points, buffer, length);
+
+    return true;
+}
+
 Results::Results(unsigned int s) {
     size = s;
+    n_pruned = 0;
     if (size > 0) {
         unicode = (unsigned int*) malloc(size * sizeof(unsigned int));
         dist = (float *) malloc(size * sizeof(float));
@@ -135,15 +149,122 @@ unsigned int Results::get_size() {
     return size;
 }
 
+void Results::set_n_pruned(unsigned int n) {
+    n_pruned = n;
+}
+
+CharacterBatch::CharacterBatch(unsigned int n_chars, unsigned int n_vecs) {
+    n_characters = n_chars;
+    total_n_vectors = n_vecs;
+    points = (float *) memalign(16, MAX(n_vecs, 1) * VEC_DIM_MAX *
+                                    sizeof(float));
+    offsets = (unsigned int *) calloc(MAX(n_chars, 1), sizeof(unsigned int));
+    n_vectors = (unsigned int *) calloc(MAX(n_chars, 1),
+                                        sizeof(unsigned int));
+    n_strokes = (unsigned int *) calloc(MAX(n_chars, 1),
+                                        sizeof(unsigned int));
+}
+
+CharacterBatch::~CharacterBatch() {
+    free(points);
+    free(offsets);
+    free(n_vectors);
+    free(n_strokes);
+}
+
+void CharacterBatch::set_character(unsigned int i,
+                                   unsigned int n_vecs,
+                                   unsigned int n_stro) {
+    /* the vectors of a character follow those of the previous one */
+    offsets[i] = i == 0 ? 0 : offsets[i-1] + n_vectors[i-1] * VEC_DIM_MAX;
+    n_vectors[i] = n_vecs;
+    n_strokes[i] = n_stro;
+}
+
+bool CharacterBatch::set_points(char *buffer, int length) {
+    if ((unsigned int) length !=
+        total_n_vectors * VEC_DIM_MAX * sizeof(float))
+        return false;
+
+    memcpy(points, buffer, length);
+
+    return true;
+}
+
+unsigned int CharacterBatch::get_n_characters() {
+    return n_characters;
+}
+
+float *CharacterBatch::get_points(unsigned int i) {
+    return points + offsets[i];
+}
+
+unsigned int CharacterBatch::get_n_vectors(unsigned int i) {
+    return n_vectors[i];
+}
+
+unsigned int CharacterBatch::get_n_strokes(unsigned int i) {
+    return n_strokes[i];
+}
+
+ResultsBatch::ResultsBatch(unsigned int s) {
+    size = s;
+    results = (Results **) calloc(MAX(size, 1), sizeof(Results *));
+}
+
+ResultsBatch::~ResultsBatch() {
+    unsigned int i;
+
+    for (i=0; i < size; i++)
+        if (results[i]) delete results[i];
+
+    free(results);
+}
+
+void ResultsBatch::set(unsigned int i, Results *r) {
+    results[i] = r;
+}
+
+Results *ResultsBatch::get_results(unsigned int i) {
+    return results[i];
+}
+
+unsigned int ResultsBatch::get_size() {
+    return size;
+}
+
+unsigned int Results::get_n_pruned() {
+    return n_pruned;
+}
+
 Recognizer::Recognizer() {
+#if !GLIB_CHECK_VERSION(2,32,0)
+    if (!g_thread_supported()) g_thread_init(NULL);
+#endif
+    file = NULL;
+    swapped_data = NULL;
+    template_offsets = NULL;
+    template_bounds = NULL;
+    owns_index = false;
+    error_msg = NULL;
+    workspace_pool = g_async_queue_new();
+    max_n_vectors = 0;
+    /* features are padded with zeros, so this is right for any model
+       until one is opened */
+    dimension = VEC_DIM_MAX;
     window_size = 3;
+    band_width = 0;
+    n_threads = 1;
+    pruning = false;
+    n_candidates = 0;
+    signature_length = 0;
+    model_serial = 0;
 }
 
 Recognizer::~Recognizer() {
-    if (file) g_mapped_file_free(file);
-    if (distm) free(distm);
-    if (dtw1) free(dtw1);
-    if (dtw2) free(dtw2);
+    free_workspaces();
+    g_async_queue_unref(workspace_pool);
+    close_model();
 }
 
 unsigned int Recognizer::get_window_size() {
@@ -154,10 +275,130 @@ void Recognizer::set_window_size(unsigned int size) {
     window_size = size;
 }
 
+unsigned int Recognizer::get_band_width() {
+    return band_width;
+}
+
+void Recognizer::set_band_width(unsigned int width) {
+    band_width = width;
+}
+
+unsigned int Recognizer::get_n_threads() {
+    return n_threads;
+}
+
+void Recognizer::set_n_threads(unsigned int n) {
+    n_threads = MAX(n, 1);
+}
+
+bool Recognizer::get_pruning() {
+    return pruning;
+}
+
+void Recognizer::set_pruning(bool enabled) {
+    pruning = enabled;
+}
+
+unsigned int Recognizer::get_n_candidates() {
+    return n_candidates;
+}
+
+void Recognizer::set_n_candidates(unsigned int n) {
+    n_candidates = n;
+}
+
+unsigned int Recognizer::get_signature_length() {
+    return signature_length;
+}
+
+Workspace *Recognizer::new_workspace(unsigned int max_n_vectors) {
+    Workspace *ws = (Workspace *) malloc(sizeof(Workspace));
+    unsigned int i, size = max_n_vectors * VEC_DIM_MAX * sizeof(float);
+
+    for (i=0; i < 4; i++) {
+        ws->templates[i] = (float *) memalign(16, MAX(size, 16));
+        /* the padding of decoded vectors is never written afterwards */
+        memset(ws->templates[i], 0, MAX(size, 16));
+    }
+
+#ifdef __SSE__
+    ws->dtw1v = (wg_v4sf *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+                                         sizeof(wg_v4sf));
+    ws->dtw2v = (wg_v4sf *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+                                         sizeof(wg_v4sf));
+    ws->dtw1 = (float *) ws->dtw1v;
+    ws->dtw2 = (float *) ws->dtw2v;
+#else
+    ws->dtw1 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+                                      sizeof(float));
+    ws->dtw2 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+                                      sizeof(float));
+#endif
+
+    return ws;
+}
+
+void Recognizer::free_workspace(Workspace *ws) {
+    unsigned int i;
+
+    for (i=0; i < 4; i++)
+        free(ws->templates[i]);
+    free(ws->dtw1);
+    free(ws->dtw2);
+    free(ws);
+}
+
+/* Workspaces are taken from the pool for the duration of a recognize()
+   call, so that concurrent calls never share scratch buffers. The pool
+   grows up to the largest number of workspaces ever used at once. */
+Workspace *Recognizer::acquire_workspace() {
+    Workspace *ws = (Workspace *) g_async_queue_try_pop(workspace_pool);
+
+    if (!ws)
+        ws = new_workspace(max_n_vectors);
+
+    return ws;
+}
+
+void Recognizer::release_workspace(Workspace *ws) {
+    g_async_queue_push(workspace_pool, ws);
+}
+
+void Recognizer::free_workspaces() {
+    Workspace *ws;
+
+    while ((ws = (Workspace *) g_async_queue_try_pop(workspace_pool)))
+        free_workspace(ws);
+}
+
+void Recognizer::close_model() {
+    if (owns_index) {
+        free(template_offsets);
+        free(template_bounds);
+    }
+    template_offsets = NULL;
+    template_bounds = NULL;
+    owns_index = false;
+
+    if (swapped_data) {
+        free(swapped_data);
+        swapped_data = NULL;
+    }
+
+    if (file) {
+        g_mapped_file_free(file);
+        file = NULL;
+    }
+}
+
 bool Recognizer::open(char *path) {
     unsigned int *header;
-    char *cursor;
-    unsigned int max_n_vectors;
+    gsize length;
+    bool ret;
+
+    close_model();
+
+    model_serial++;
 
     file = g_mapped_file_new(path, FALSE, NULL);
 
@@ -167,14 +408,140 @@ bool Recognizer::open(char *path) {
     }
 
     data = g_mapped_file_get_contents(file);
+    length = g_mapped_file_get_length(file);
 
     header = (unsigned int *)data;
 
-    if (header[0] != MAGIC_NUMBER) {
+    if (length >= sizeof(ModelHeader) &&
+        GUINT32_FROM_LE(header[0]) == MAGIC_NUMBER_V2) {
+        ret = open_v2(length);
+    }
+    else if (length >= 5 * sizeof(unsigned int) &&
+             header[0] == MAGIC_NUMBER) {
+        ret = open_v1();
+    }
+    else {
         error_msg = (char *) "Not a valid file";
+        ret = false;
+    }
+
+    if (!ret) {
+        close_model();
+        return false;
+    }
+
+    free_workspaces();
+
+    return true;
+}
+
+/* The whole model is read from the file: it can be shared by all the
+   processes which open it. */
+bool Recognizer::open_v2(gsize length) {
+    ModelHeader *header;
+
+#if G_BYTE_ORDER == G_BIG_ENDIAN
+    gsize i, n_words;
+
+    /* Every word of the file is 32-bit but quantized templates, which
+       are kept as they are */
+    header = (ModelHeader *)data;
+    if (GUINT32_FROM_LE(header->template_format) == TEMPLATE_FLOAT32)
+        n_words = length / sizeof(guint32);
+    else
+        n_words = MIN(GUINT32_FROM_LE(header->templates_offset), length) /
+                  sizeof(guint32);
+
+    swapped_data = (char *) memalign(16, length);
+    memcpy(swapped_data, data, length);
+    for (i=0; i < n_words; i++)
+        ((guint32 *) swapped_data)[i] =
+            GUINT32_SWAP_LE_BE(((guint32 *) data)[i]);
+    data = swapped_data;
+#endif
+
+    header = (ModelHeader *)data;
+
+    if (header->version != MODEL_VERSION) {
+        error_msg = (char *) "Unsupported model version";
+        return false;
+    }
+
+    n_characters = header->n_characters;
+    n_groups = header->n_groups;
+    dimension = header->dimension;
+    downsample_threshold = header->downsample_threshold;
+    max_n_vectors = header->max_n_vectors;
+
+    if (n_characters == 0 || n_groups == 0) {
+        error_msg = (char *) "No characters in this model";
         return false;
     }
 
+    if (header->characters_offset +
+            (gsize) n_characters * sizeof(CharacterInfo) > length ||
+        header->groups_offset +
+            (gsize) n_groups * sizeof(CharacterGroup) > length ||
+        header->template_offsets_offset +
+            (gsize) n_characters * sizeof(unsigned int) > length ||
+        header->template_bounds_offset +
+            (gsize) n_characters * sizeof(TemplateBounds) > length ||
+        header->templates_offset > length ||
+        header->template_bounds_offset % 16 != 0 ||
+        header->templates_offset % 16 != 0 ||
+        dimension > VEC_DIM_MAX) {
+        error_msg = (char *) "Corrupted model";
+        return false;
+    }
+
+    template_format = header->template_format;
+
+    if (template_format == TEMPLATE_INT8) {
+        if (header->template_scales_offset +
+                VEC_DIM_MAX * sizeof(float) > length) {
+            error_msg = (char *) "Corrupted model";
+            return false;
+        }
+        template_scales = (float *) (data + header->template_scales_offset);
+    }
+    else if (template_format != TEMPLATE_FLOAT32) {
+        error_msg = (char *) "Unsupported template format";
+        return false;
+    }
+
+    signature_length = header->signature_length;
+
+    if (signature_length > 0) {
+        if (header->signatures_offset % 16 != 0 ||
+            header->signatures_offset + (gsize) n_characters *
+                signature_length * VEC_DIM_MAX * sizeof(float) > length) {
+            error_msg = (char *) "Corrupted model";
+            return false;
+        }
+        signatures = (float *) (data + header->signatures_offset);
+    }
+
+    characters = (CharacterInfo *) (data + header->characters_offset);
+    groups = (CharacterGroup *) (data + header->groups_offset);
+    template_offsets = (unsigned int *) (data +
+                                         header->template_offsets_offset);
+    template_bounds = (TemplateBounds *) (data +
+                                          header->template_bounds_offset);
+    strokedata = (float *) (data + header->templates_offset);
+
+    return true;
+}
+
+bool Recognizer::open_v1() {
+    unsigned int *header;
+    char *cursor;
+    unsigned int group_id, char_id, i, offset;
+
+    header = (unsigned int *)data;
+
+    template_format = TEMPLATE_FLOAT32;
+    signature_length = 0;
+
     n_characters =  header[1];
     n_groups = header[2];
     dimension = header[3];
@@ -193,23 +560,23 @@ bool Recognizer::open(char *path) {
 
     strokedata = (float *)(data + groups[0].offset);
 
-    distm = (CharDist *) malloc(n_characters * sizeof(CharDist));
+    owns_index = true;
+    template_offsets = (unsigned int *) malloc(n_characters *
+                                               sizeof(unsigned int));
 
-    max_n_vectors = get_max_n_vectors();
+    for (group_id=0, char_id=0; group_id < n_groups; group_id++) {
+        offset = groups[group_id].offset;
 
-#ifdef __SSE__
-    dtw1v = (wg_v4sf *) memalign(16, max_n_vectors * VEC_DIM_MAX *
-                                     sizeof(wg_v4sf));
-    dtw2v = (wg_v4sf *) memalign(16, max_n_vectors * VEC_DIM_MAX *
-                                     sizeof(wg_v4sf));
-    dtw1 = (float *) dtw1v;
-    dtw2 = (float *) dtw2v;
-#else
-    dtw1 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
-                                  sizeof(float));
-    dtw2 = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
-                                  sizeof(float));
-#endif
+        for (i=0; i < groups[group_id].n_chars; i++, char_id++) {
+            template_offsets[char_id] = offset;
+            offset += characters[char_id].n_vectors * VEC_DIM_MAX *
+                      sizeof(float);
+        }
+    }
+
+    compute_template_bounds();
+
+    max_n_vectors = get_max_n_vectors();
 
     return true;
 }
@@ -224,6 +591,40 @@ unsigned int Recognizer::get_max_n_vectors() {
     return max_n_vectors;
 }
 
+void Recognizer::compute_template_bounds() {
+    unsigned int char_id, i, d;
+    float *t;
+    TemplateBounds *b;
+
+    template_bounds = (TemplateBounds *) malloc(n_characters *
+                                                sizeof(TemplateBounds));
+
+    for (char_id=0; char_id < n_characters; char_id++) {
+        b = &template_bounds[char_id];
+        t = (float *) (data + template_offsets[char_id]);
+
+        /* The first vector of a template is never compared (see dtw) */
+        for (d=0; d < VEC_DIM_MAX; d++) {
+            if (characters[char_id].n_vectors > 1) {
+                b->min[d] = FLT_MAX;
+                b->max[d] = -FLT_MAX;
+            }
+            else {
+                b->min[d] = -FLT_MAX;
+                b->max[d] = FLT_MAX;
+            }
+        }
+
+        for (i=1; i < characters[char_id].n_vectors; i++) {
+            t += VEC_DIM_MAX;
+            for (d=0; d < VEC_DIM_MAX; d++) {
+                b->min[d] = MIN(b->min[d], t[d]);
+                b->max[d] = MAX(b->max[d], t[d]);
+            }
+        }
+    }
+}
+
 unsigned int Recognizer::get_n_characters() {
     return n_characters;
 }
@@ -253,6 +654,52 @@ inline float Recognizer::local_distance(float *v1, float *v2) {
     return sum;
 }
 
+/*
+Every column of the DTW matrix contains at least one cell of the warping
+path, so the distance between s and t is at least the sum, for every
+vector of s, of the distance between that vector and the closest vector
+of t. The distance to the bounding box of t is used as a cheap
+approximation of the latter.
+*/
+
+inline float Recognizer::lower_bound(float *s, unsigned int n,
+                                     TemplateBounds *b) {
+    unsigned int i, d;
+    float sum = 0;
+
+    for (i=1; i < n; i++) {
+        s += VEC_DIM_MAX;
+        for (d=0; d < dimension; d++) {
+            if (s[d] < b->min[d])
+                sum += b->min[d] - s[d];
+            else if (s[d] > b->max[d])
+                sum += s[d] - b->max[d];
+        }
+    }
+
+    return sum;
+}
+
+/* Returns the vectors of a template. Quantized templates are decoded into
+   buf, which holds max_n_vectors vectors. */
+
+inline float *Recognizer::get_template(unsigned int char_id, float *buf) {
+    unsigned int i, d, n_vectors;
+    signed char *q;
+
+    if (template_format == TEMPLATE_FLOAT32)
+        return (float *) (data + template_offsets[char_id]);
+
+    q = (signed char *) (data + template_offsets[char_id]);
+    n_vectors = characters[char_id].n_vectors;
+
+    for (i=0; i < n_vectors; i++, q += dimension)
+        for (d=0; d < dimension; d++)
+            buf[i * VEC_DIM_MAX + d] = q[d] * template_scales[d];
+
+    return buf;
+}
+
 /*
 
 m [X][ ][ ][ ][ ][r]
@@ -284,10 +731,24 @@ A cell can thus be calculated as follows:
 
     dtw2(j) = local_distance(i,j) + MIN3(dtw2(j-1), dtw1(j), dtw1(j-1))
 
+When band_width is non-zero, the warping path is restricted to a
+Sakoe-Chiba band around the diagonal going from the bottom-left to the
+top-right cell: in column i, only the cells j such that
+|j - i * (m-1) / (n-1)| <= w are computed, the others being infinity.
+w is band_width, widened if necessary so that the band stays connected
+when the two sequences have very different lengths. Each comparison then
+costs O(n*w) instead of O(n*m).
+
+Since local distances are positive, the minimum of a column can only grow
+from one column to the next. The computation is therefore abandoned
+and FLT_MAX is returned as soon as a column minimum exceeds threshold.
+
 */
 
-inline float Recognizer::dtw(float *s, unsigned int n, 
-                             float *t, unsigned int m) {
+inline float Recognizer::dtw(Workspace *ws,
+                             float *s, unsigned int n, 
+                             float *t, unsigned int m,
+                             float threshold) {
     /*
     Compare an input sequence with a reference sequence.
 
@@ -296,10 +757,14 @@ inline float Recognizer::dtw(float *s, unsigned int n,
 
     t: reference sequence
     m: number of vectors in t
+
+    threshold: maximum distance of interest
     */
-    unsigned int i, j;
-    float cost;
+    unsigned int i, j, lo, hi, center, w = 0;
+    float cost, colmin;
     float *t_start, *tmp;
+    float *dtw1 = ws->dtw1;
+    float *dtw2 = ws->dtw2;
 
     t_start = t;
 
@@ -310,21 +775,46 @@ inline float Recognizer::dtw(float *s, unsigned int n,
     dtw1[0] = 0;
     dtw2[0] = FLT_MAX;
 
+    if (band_width > 0 && n > 1) {
+        /* cells outside of the band are never computed */
+        for (i=1; i < m; i++)
+            dtw2[i] = FLT_MAX;
+
+        /* the band must be at least as wide as the slope of the diagonal,
+           otherwise two consecutive columns may not overlap */
+        w = MAX(band_width, (m + n - 3) / (n - 1));
+    }
+
+    lo = 1;
+    hi = m - 1;
+
     s += VEC_DIM_MAX;
    
     /* Iterate over columns */
     for (i=1; i < n; i++) {
-        t = t_start + VEC_DIM_MAX;
+        if (w > 0) {
+            center = i * (m - 1) / (n - 1);
+            lo = MAX(center > w ? center - w : 0, 1);
+            hi = MIN(center + w, m - 1);
+            dtw2[lo-1] = FLT_MAX;
+        }
+
+        t = t_start + lo * VEC_DIM_MAX;
+        colmin = FLT_MAX;
 
         /* Iterate over cells of that column */
-        for (j=1; j < m; j++) {
+        for (j=lo; j <= hi; j++) {
             cost = local_distance(s, t);
             /* Inductive step */
             dtw2[j] = cost + MIN3(dtw2[j-1],dtw1[j],dtw1[j-1]);
+            colmin = MIN(colmin, dtw2[j]);
 
             t += VEC_DIM_MAX;
         }
 
+        if (colmin > threshold)
+            return FLT_MAX;
+
         SWAP(dtw1,dtw2,tmp);
         *dtw2 = FLT_MAX;
 
@@ -365,15 +855,18 @@ do { \
         dtw2v[j].s[n] = costf + MIN3(dtw2v[j-1].s[n], \
                                      dtw1v[j].s[n], \
                                      dtw1v[j-1].s[n]); \
+        colmin.s[n] = MIN(colmin.s[n], dtw2v[j].s[n]); \
         t += VEC_DIM_MAX; \
     } \
 } while(0)
 
-inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n, 
+inline wg_v4sf Recognizer::dtw4(Workspace *ws,
+                                float *s, unsigned int n, 
                                 float *t0, unsigned int m0,
                                 float *t1, unsigned int m1,
                                 float *t2, unsigned int m2,
-                                float *t3, unsigned int m3) {
+                                float *t3, unsigned int m3,
+                                float threshold) {
     /*
     Compare an input sequence with 4 reference sequences.
 
@@ -386,13 +879,18 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
 
     t0..t3: reference sequences
     m0..m3: number of vectors in the sequence
+
+    threshold: maximum distance of interest. The computation is abandoned
+    only when the 4 sequences exceed it.
     */
     unsigned int i, j, common;
-    wg_v4sf cost;
+    wg_v4sf cost, colmin;
     float costf;
     float *t_start0, *t_start1, *t_start2, *t_start3;
     wg_v4sf *tmp;
     wg_v4sf res;
+    wg_v4sf *dtw1v = ws->dtw1v;
+    wg_v4sf *dtw2v = ws->dtw2v;
 
     t_start0 = t0; t_start1 = t1; t_start2 = t2; t_start3 = t3;
 
@@ -411,6 +909,7 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
     for (i=1; i < n; i++) {
         t0 = t_start0 + VEC_DIM_MAX; t1 = t_start1 + VEC_DIM_MAX;
         t2 = t_start2 + VEC_DIM_MAX; t3 = t_start3 + VEC_DIM_MAX;
+        colmin.v = _mm_set_ps1(FLT_MAX);
 
         /* Iterate over cells of that column */
         /* Process 4 cells at a time in parallel */
@@ -419,6 +918,7 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
             /* Inductive step */
             dtw2v[j].v = _mm_add_ps(cost.v,
                                 MIN3VEC(dtw2v[j-1].v,dtw1v[j].v,dtw1v[j-1].v));
+            colmin.v = _mm_min_ps(colmin.v, dtw2v[j].v);
 
             t0 += VEC_DIM_MAX; t1 += VEC_DIM_MAX;
             t2 += VEC_DIM_MAX; t3 += VEC_DIM_MAX;
@@ -430,6 +930,12 @@ inline wg_v4sf Recognizer::dtw4(float *s, unsigned int n,
         DTW4_PROCESS_REMAINING(2, m2, t2);
         DTW4_PROCESS_REMAINING(3, m3, t3);
 
+        if (colmin.s[0] > threshold && colmin.s[1] > threshold &&
+            colmin.s[2] > threshold && colmin.s[3] > threshold) {
+            res.v = _mm_set_ps1(FLT_MAX);
+            return res;
+        }
+
         SWAP(dtw1v,dtw2v,tmp);
         dtw2v[0].v = _mm_set_ps1(FLT_MAX);
 
@@ -457,22 +963,17 @@ static void assert_aligned16(char *p) {
 }
 #endif
 
-Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
-
-    unsigned int group_id, i, size, n_chars, char_id, n_group_chars;
-    unsigned int n_vectors, n_strokes;
-    float *cursor = strokedata;
-    float *input;
-
-    n_vectors = ch->get_n_vectors();
-    n_strokes = ch->get_n_strokes();
-    input = ch->get_points();
+void Recognizer::get_template_range(unsigned int n_strokes,
+                                    unsigned int *first,
+                                    unsigned int *last) {
+    /* Templates are sorted by number of strokes, so the templates to
+       compare with the input form a contiguous range */
+    unsigned int group_id, char_id;
 
-    #if 0
-    assert_aligned16((char *) input);
-    #endif
+    *first = 0;
+    *last = 0;
 
-    for (group_id=0, n_chars=0, char_id=0; group_id < n_groups; group_id++) {
+    for (group_id=0, char_id=0; group_id < n_groups; group_id++) {
         /* Only compare the input with templates which have
            +- window_size the same number of strokes as the input */
         if (n_strokes > window_size) {
@@ -481,74 +982,317 @@ Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
 
             if (groups[group_id].n_strokes < (n_strokes - window_size)) {
                 char_id += groups[group_id].n_chars;
+                *first = char_id;
                 continue;
             }
         }
 
-        cursor = (float *) (data + groups[group_id].offset);
+        char_id += groups[group_id].n_chars;
+        *last = char_id;
+    }
+
+    if (*last < *first)
+        *last = *first;
+}
+
+/* heap is a max-heap containing the n_heap best candidates seen so far,
+   the root being the worst of them. Once size candidates are in the heap,
+   a new one only gets in by replacing the root. */
+static void char_dist_heap_add(CharDist *heap, unsigned int *n_heap,
+                               unsigned int size,
+                               unsigned int unicode, float dist) {
+    unsigned int i, child;
+
+    if (*n_heap < size) {
+        /* sift up */
+        for (i = (*n_heap)++; i > 0 && heap[(i-1)/2].dist < dist; i = (i-1)/2)
+            heap[i] = heap[(i-1)/2];
+    }
+    else if (size > 0 && dist < heap[0].dist) {
+        /* replace the root and sift down */
+        for (i = 0; (child = 2*i+1) < size; i = child) {
+            if (child + 1 < size && heap[child+1].dist > heap[child].dist)
+                child++;
+            if (heap[child].dist <= dist)
+                break;
+            heap[i] = heap[child];
+        }
+    }
+    else
+        return;
+
+    heap[i].unicode = unicode;
+    heap[i].dist = dist;
+}
+
+void Recognizer::score_templates(ScoringTask *task) {
+    unsigned int pos, char_id;
+    float threshold = FLT_MAX;
+    bool prune = pruning && task->n_results > 0;
 
 #ifdef __SSE__
-        float *ref1, *ref2, *ref3, *ref4;
-        unsigned int size1, size2, size3, size4;
-        wg_v4sf dtwres4;
-
-        /* Process 4 reference characters at a time */
-        for (i=0; i < (groups[group_id].n_chars / 4); i++) {
-            distm[n_chars].unicode = characters[char_id].unicode;
-            ref1 = cursor;
-            size1 = characters[char_id].n_vectors;
-            ref2 = ref1 + characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-
-            distm[n_chars+1].unicode = characters[char_id].unicode;
-            size2 = characters[char_id].n_vectors;
-            ref3 = ref2 + characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-
-            distm[n_chars+2].unicode = characters[char_id].unicode;
-            size3 = characters[char_id].n_vectors;
-            ref4 = ref3 + characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-
-            distm[n_chars+3].unicode = characters[char_id].unicode;            
-            size4 = characters[char_id].n_vectors;
-            cursor = ref4 + characters[char_id].n_vectors *
-                     VEC_DIM_MAX;
-            char_id++;
-
-            dtwres4 = dtw4(input, n_vectors, 
-                           ref1, size1, 
-                           ref2, size2, 
-                           ref3, size3, 
-                           ref4, size4);
-
-            distm[n_chars++].dist = dtwres4.s[0];
-            distm[n_chars++].dist = dtwres4.s[1];
-            distm[n_chars++].dist = dtwres4.s[2];
-            distm[n_chars++].dist = dtwres4.s[3];
+    unsigned int k, n_pending = 0;
+    unsigned int pending[4];
+    float *pending_templates[4];
+    wg_v4sf dtwres4;
+#endif
+
+    task->n_best = 0;
+
+/* In pruning mode, the worst of the n_results best candidates is the
+   threshold above which templates are not of interest anymore */
+#define SCORING_TASK_ADD(char_id, d) \
+do { \
+    if ((d) == FLT_MAX && threshold < FLT_MAX) \
+        task->n_pruned++; \
+    char_dist_heap_add(task->best, &task->n_best, task->n_results, \
+                       characters[(char_id)].unicode, (d)); \
+    if (prune && task->n_best == task->n_results) \
+        threshold = task->best[0].dist; \
+} while(0)
+
+    for (pos = task->first; pos < task->last; pos++) {
+        char_id = task->ids ? task->ids[pos] : pos;
+
+        if (threshold < FLT_MAX &&
+            lower_bound(task->input, task->n_vectors,
+                        &template_bounds[char_id]) > threshold) {
+            /* this template can't make it to the n_results best */
+            task->n_pruned++;
+            continue;
         }
 
-        /* Process the remaining of references */
-        n_group_chars = (groups[group_id].n_chars % 4);
+#ifdef __SSE__
+        /* Process 4 reference characters at a time (the band-constrained
+           comparison is only implemented by the scalar version) */
+        if (band_width == 0) {
+            pending_templates[n_pending] =
+                get_template(char_id, task->ws->templates[n_pending]);
+            pending[n_pending++] = char_id;
+
+            if (n_pending < 4)
+                continue;
+
+            dtwres4 = dtw4(task->ws, task->input, task->n_vectors,
+                           pending_templates[0],
+                           characters[pending[0]].n_vectors,
+                           pending_templates[1],
+                           characters[pending[1]].n_vectors,
+                           pending_templates[2],
+                           characters[pending[2]].n_vectors,
+                           pending_templates[3],
+                           characters[pending[3]].n_vectors,
+                           threshold);
+
+            for (k=0; k < 4; k++)
+                SCORING_TASK_ADD(pending[k], dtwres4.s[k]);
+
+            n_pending = 0;
+            continue;
+        }
+#endif
+        SCORING_TASK_ADD(char_id,
+                         dtw(task->ws, task->input, task->n_vectors,
+                             get_template(char_id, task->ws->templates[0]),
+                             characters[char_id].n_vectors,
+                             threshold));
+    }
+
+#ifdef __SSE__
+    /* Process the remaining of references */
+    for (k=0; k < n_pending; k++) {
+        char_id = pending[k];
+        SCORING_TASK_ADD(char_id,
+                         dtw(task->ws, task->input, task->n_vectors,
+                             pending_templates[k],
+                             characters[char_id].n_vectors,
+                             threshold));
+    }
+#endif
+
+#undef SCORING_TASK_ADD
+}
+
+/* The coarse signature of a sequence is the mean of its vectors over
+   signature_length segments of about the same length, scaled by the
+   average length of a segment so that the signature also reflects the
+   length of the sequence. The first vector is left out as in dtw(). The
+   trainer computes the signatures of the templates the same way (see
+   get_signature in tegakiwagomu.py). */
+
+void Recognizer::compute_signature(float *points, unsigned int n_vectors,
+                                   float *signature) {
+    unsigned int l, i, d, start, end;
+    unsigned int n = n_vectors > 0 ? n_vectors - 1 : 0;
+    float *v = points + VEC_DIM_MAX;
+    float *s, scale = (float) n / signature_length;
+
+    for (l=0; l < signature_length; l++) {
+        s = signature + l * VEC_DIM_MAX;
+
+        for (d=0; d < VEC_DIM_MAX; d++)
+            s[d] = 0;
+
+        if (n == 0)
+            continue;
+
+        start = l * n / signature_length;
+        end = MAX((l + 1) * n / signature_length, start + 1);
+
+        for (i=start; i < end; i++)
+            for (d=0; d < VEC_DIM_MAX; d++)
+                s[d] += v[i * VEC_DIM_MAX + d];
+
+        for (d=0; d < VEC_DIM_MAX; d++)
+            s[d] = s[d] / (end - start) * scale;
+    }
+}
+
+static int uint_cmp(unsigned int *a, unsigned int *b) {
+    return (*a > *b) - (*a < *b);
+}
+
+/* Returns the ids, in increasing order, of the n_candidates templates of
+   the range whose signatures are the closest to that of the input */
+unsigned int *Recognizer::select_candidates(float *points,
+                                            unsigned int n_vectors,
+                                            unsigned int first,
+                                            unsigned int last,
+                                            unsigned int *n_ids) {
+    unsigned int char_id, l, i, n_heap = 0;
+    unsigned int *ids;
+    float dist, *signature, *t;
+    CharDist *heap;
+
+    signature = (float *) memalign(16, signature_length * VEC_DIM_MAX *
+                                       sizeof(float));
+    heap = (CharDist *) malloc(n_candidates * sizeof(CharDist));
+
+    compute_signature(points, n_vectors, signature);
+
+    for (char_id=first; char_id < last; char_id++) {
+        t = signatures + (gsize) char_id * signature_length * VEC_DIM_MAX;
+
+        for (l=0, dist=0; l < signature_length; l++)
+            dist += local_distance(signature + l * VEC_DIM_MAX,
+                                   t + l * VEC_DIM_MAX);
+
+        /* the entries of this heap hold template ids, not characters */
+        char_dist_heap_add(heap, &n_heap, n_candidates, char_id, dist);
+    }
+
+    ids = (unsigned int *) malloc(MAX(n_heap, 1) * sizeof(unsigned int));
+    for (i=0; i < n_heap; i++)
+        ids[i] = heap[i].unicode;
+
+    /* templates are still compared in the order of the model */
+    qsort((void *) ids,
+          (size_t) n_heap,
+          sizeof (unsigned int),
+          (int (*) (const void *, const void*)) uint_cmp);
+
+    free(heap);
+    free(signature);
+
+    *n_ids = n_heap;
+
+    return ids;
+}
+
+gpointer Recognizer::score_templates_thread(gpointer data) {
+    ScoringTask *task = (ScoringTask *) data;
+    task->recognizer->score_templates(task);
+    return NULL;
+}
+
+Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
+    return recognize_points(ch->get_points(),
+                            ch->get_n_vectors(),
+                            ch->get_n_strokes(),
+                            n_results,
+                            n_threads);
+}
+
+Results *Recognizer::recognize_points(float *points,
+                                      unsigned int n_vectors,
+                                      unsigned int n_strokes,
+                                      unsigned int n_results,
+                                      unsigned int max_workers) {
+
+    unsigned int i, k, size, n_chars, n_workers, first, last, n_best;
+    unsigned int n_pruned;
+    unsigned int *ids = NULL;
+    CharDist *best;
+    ScoringTask *tasks;
+    GThread **threads;
+
+    get_template_range(n_strokes, &first, &last);
+
+    /* Coarse pass: only the most promising templates of the range are
+       compared with DTW */
+    if (n_candidates > 0 && signature_length > 0 &&
+        last - first > n_candidates) {
+        ids = select_candidates(points, n_vectors, first, last, &last);
+        first = 0;
+    }
+
+    n_chars = last - first;
+    n_workers = MAX(MIN(max_workers, n_chars), 1);
+
+    #if 0
+    assert_aligned16((char *) points);
+    #endif
+
+    /* Split the templates into n_workers ranges of about the same size.
+       Each worker selects the n_results best templates of its range. */
+    tasks = (ScoringTask *) malloc(n_workers * sizeof(ScoringTask));
+    threads = (GThread **) malloc(n_workers * sizeof(GThread *));
+    best = (CharDist *) malloc(MAX(n_workers * n_results, 1) *
+                               sizeof(CharDist));
+
+    for (k=0; k < n_workers; k++) {
+        tasks[k].recognizer = this;
+        tasks[k].ws = acquire_workspace();
+        tasks[k].input = points;
+        tasks[k].n_vectors = n_vectors;
+        tasks[k].ids = ids;
+        tasks[k].first = first + (unsigned int)
+                                 ((unsigned long) n_chars * k / n_workers);
+        tasks[k].last = first + (unsigned int)
+                                ((unsigned long) n_chars * (k+1) / n_workers);
+        tasks[k].best = best + k * n_results;
+        tasks[k].n_best = 0;
+        tasks[k].n_results = n_results;
+        tasks[k].n_pruned = 0;
+    }
+
+    for (k=1; k < n_workers; k++) {
+#if GLIB_CHECK_VERSION(2,32,0)
+        threads[k] = g_thread_new("wagomu", score_templates_thread, &tasks[k]);
 #else
-        /* SSE not available, we need to process references sequentially */
-        n_group_chars = groups[group_id].n_chars;
+        threads[k] = g_thread_create(score_templates_thread, &tasks[k],
+                                     TRUE, NULL);
 #endif
+    }
 
-        for (i=0; i < n_group_chars; i++) {
-            distm[n_chars].unicode = characters[char_id].unicode;
-            distm[n_chars].dist = dtw(input, n_vectors, 
-                                      cursor, characters[char_id].n_vectors);
-            cursor += characters[char_id].n_vectors * VEC_DIM_MAX;
-            char_id++;
-            n_chars++;
-        }
+    /* The calling thread takes care of the first range */
+    if (n_chars > 0)
+        score_templates(&tasks[0]);
+
+    for (k=1; k < n_workers; k++)
+        g_thread_join(threads[k]);
 
+    /* Only the n_results best candidates of each range need to be sorted
+       to find the overall best ones */
+    for (k=0, n_best=0, n_pruned=0; k < n_workers; k++) {
+        memmove(best + n_best, tasks[k].best,
+                tasks[k].n_best * sizeof(CharDist));
+        n_best += tasks[k].n_best;
+        n_pruned += tasks[k].n_pruned;
     }
 
-    /* sort the results with glibc's quicksort */
-    qsort ((void *) distm, 
-           (size_t) n_chars, 
+    qsort ((void *) best, 
+           (size_t) n_best, 
            sizeof (CharDist), 
            (int (*) (const void *, const void*)) char_dist_cmp);
 
@@ -556,8 +1300,354 @@ Results *Recognizer::recognize(Character *ch, unsigned int n_results) {
 
     Results *results = new Results(size);
 
-    for(i=0; i < size; i++)
-        results->add(i, distm[i].unicode, distm[i].dist);
+    results->set_n_pruned(n_pruned);
+
+    for (k=0; k < n_workers; k++)
+        release_workspace(tasks[k].ws);
+
+    for (i=0; i < size; i++)
+        results->add(i, best[i].unicode, best[i].dist);
+
+    free(ids);
+    free(best);
+    free(threads);
+    free(tasks);
+
+    return results;
+}
+
+void Recognizer::recognize_batch_part(BatchTask *task) {
+    unsigned int i;
+    CharacterBatch *batch = task->batch;
+
+    /* the characters of the batch are already processed in parallel,
+       so each of them is processed by a single thread */
+    for (i=task->first; i < batch->get_n_characters(); i += task->step)
+        task->results->set(i, recognize_points(batch->get_points(i),
+                                               batch->get_n_vectors(i),
+                                               batch->get_n_strokes(i),
+                                               task->n_results,
+                                               1));
+}
+
+gpointer Recognizer::recognize_batch_thread(gpointer data) {
+    BatchTask *task = (BatchTask *) data;
+    task->recognizer->recognize_batch_part(task);
+    return NULL;
+}
+
+ResultsBatch *Recognizer::recognize_batch(CharacterBatch *batch,
+                                          unsigned int n_results) {
+    unsigned int k, n_workers;
+    BatchTask *tasks;
+    GThread **threads;
+    ResultsBatch *results = new ResultsBatch(batch->get_n_characters());
+
+    n_workers = MAX(MIN(n_threads, batch->get_n_characters()), 1);
+
+    tasks = (BatchTask *) malloc(n_workers * sizeof(BatchTask));
+    threads = (GThread **) malloc(n_workers * sizeof(GThread *));
+
+    for (k=0; k < n_workers; k++) {
+        tasks[k].recognizer = this;
+        tasks[k].batch = batch;
+        tasks[k].results = results;
+        tasks[k].n_results = n_results;
+        tasks[k].first = k;
+        tasks[k].step = n_workers;
+    }
+
+    for (k=1; k < n_workers; k++) {
+#if GLIB_CHECK_VERSION(2,32,0)
+        threads[k] = g_thread_new("wagomu", recognize_batch_thread, &tasks[k]);
+#else
+        threads[k] = g_thread_create(recognize_batch_thread, &tasks[k],
+                                     TRUE, NULL);
+#endif
+    }
+
+    recognize_batch_part(&tasks[0]);
+
+    for (k=1; k < n_workers; k++)
+        g_thread_join(threads[k]);
+
+    free(threads);
+    free(tasks);
+
+    return results;
+}
+
+unsigned int Recognizer::find_medoid(CharacterBatch *batch) {
+    unsigned int i, j, n, best, max_n_vectors = 0;
+    float dist;
+    double *sums;
+    Workspace *ws;
+
+    n = batch->get_n_characters();
+
+    for (i=0; i < n; i++)
+        max_n_vectors = MAX(max_n_vectors, batch->get_n_vectors(i));
+
+    ws = new_workspace(max_n_vectors);
+    sums = (double *) calloc(MAX(n, 1), sizeof(double));
+
+    /* dtw is a symmetric distance so only the pairs i < j are compared */
+    for (i=0; i < n; i++) {
+        for (j=i+1; j < n; j++) {
+            if (batch->get_n_vectors(i) == 0 || batch->get_n_vectors(j) == 0)
+                dist = FLT_MAX;
+            else
+                dist = dtw(ws, batch->get_points(i), batch->get_n_vectors(i),
+                           batch->get_points(j), batch->get_n_vectors(j),
+                           FLT_MAX);
+            sums[i] += dist;
+            sums[j] += dist;
+        }
+    }
+
+    for (i=1, best=0; i < n; i++)
+        if (sums[i] < sums[best])
+            best = i;
+
+    free(sums);
+    free_workspace(ws);
+
+    return best;
+}
+
+Session::Session(Recognizer *r) {
+    recognizer = r;
+    model_serial = 0;
+    input = NULL;
+    n_vectors = 0;
+    max_n_vectors = 0;
+    columns = NULL;
+    column_offsets = NULL;
+    n_done = NULL;
+    template_buf = NULL;
+}
+
+Session::~Session() {
+    free_columns();
+    if (input) free(input);
+}
+
+void Session::free_columns() {
+    if (columns) free(columns);
+    if (column_offsets) free(column_offsets);
+    if (n_done) free(n_done);
+    if (template_buf) free(template_buf);
+    columns = NULL;
+    column_offsets = NULL;
+    n_done = NULL;
+    template_buf = NULL;
+}
+
+void Session::init_columns() {
+    unsigned int q, k, m, size, n_quads;
+    Recognizer *r = recognizer;
+
+    free_columns();
+
+    n_quads = (r->n_characters + 3) / 4;
+
+    column_offsets = (unsigned int *) malloc(MAX(n_quads, 1) *
+                                             sizeof(unsigned int));
+    n_done = (unsigned int *) calloc(MAX(n_quads, 1), sizeof(unsigned int));
+
+    for (q=0, size=0; q < n_quads; q++) {
+        column_offsets[q] = size;
+        for (k=0, m=1; k < 4 && q * 4 + k < r->n_characters; k++)
+            m = MAX(m, r->characters[q * 4 + k].n_vectors);
+        size += m * 4;
+    }
+
+    columns = (float *) memalign(16, MAX(size, 4) * sizeof(float));
+
+    size = 4 * MAX(r->max_n_vectors, 1) * VEC_DIM_MAX * sizeof(float);
+    template_buf = (float *) memalign(16, size);
+    /* the padding of decoded vectors is never written afterwards */
+    memset(template_buf, 0, size);
+
+    model_serial = r->model_serial;
+}
+
+void Session::reset() {
+    n_vectors = 0;
+}
+
+/*
+The columns of the 4 templates of a quad are interleaved: cell j of the
+column of template k is columns[column_offsets[quad] + j * 4 + k]. When
+the quad holds fewer than 4 templates, the last one is repeated.
+
+A column is extended with vector i of the input like in dtw(), except that
+it is updated in place: before cell j is overwritten, it holds dtw1(j),
+which is the diagonal neighbour of cell j+1. As in dtw4(), the first cells
+of the 4 columns are computed at once and the remaining ones sequentially.
+*/
+
+void Session::extend_columns(unsigned int quad) {
+    unsigned int i, j, k, p, j0, max_m, char_id[4], m[4];
+    float *t[4], *col, *s, up, diag[4];
+    Recognizer *r = recognizer;
+#ifdef __SSE__
+    unsigned int common;
+    wg_v4sf *colv, diagv, upv, cost;
+#endif
+
+    col = columns + column_offsets[quad];
+
+    for (k=0; k < 4; k++) {
+        char_id[k] = MIN(quad * 4 + k, r->n_characters - 1);
+        m[k] = r->characters[char_id[k]].n_vectors;
+    }
+
+    max_m = MAX(MAX(m[0], m[1]), MAX(m[2], m[3]));
+
+    p = n_done[quad];
+
+    if (p == 0) {
+        /* the initial column is that of the first vector */
+        for (j=0; j < 4; j++)
+            col[j] = 0;
+        for (j=4; j < max_m * 4; j++)
+            col[j] = FLT_MAX;
+        p = 1;
+    }
+
+    n_done[quad] = n_vectors;
+
+    if (p >= n_vectors)
+        return;
+
+    for (k=0; k < 4; k++)
+        t[k] = r->get_template(char_id[k], template_buf +
+                               k * r->max_n_vectors * VEC_DIM_MAX);
+
+    for (i=p, s=input + p * VEC_DIM_MAX; i < n_vectors;
+         i++, s += VEC_DIM_MAX) {
+#ifdef __SSE__
+        common = MIN4(m[0], m[1], m[2], m[3]);
+        colv = (wg_v4sf *) col;
+        diagv = colv[0];
+        colv[0].v = _mm_set_ps1(FLT_MAX);
+
+        for (j=1; j < common; j++) {
+            upv = colv[j];
+            cost = r->local_distance4(s,
+                                      t[0] + j * VEC_DIM_MAX,
+                                      t[1] + j * VEC_DIM_MAX,
+                                      t[2] + j * VEC_DIM_MAX,
+                                      t[3] + j * VEC_DIM_MAX);
+            colv[j].v = _mm_add_ps(cost.v,
+                                   MIN3VEC(colv[j-1].v, upv.v, diagv.v));
+            diagv = upv;
+        }
+
+        for (k=0; k < 4; k++)
+            diag[k] = diagv.s[k];
+
+        j0 = MAX(common, 1);
+#else
+        for (k=0; k < 4; k++) {
+            diag[k] = col[k];
+            col[k] = FLT_MAX;
+        }
+
+        j0 = 1;
+#endif
+        for (k=0; k < 4; k++) {
+            for (j=j0; j < m[k]; j++) {
+                up = col[j * 4 + k];
+                col[j * 4 + k] = r->local_distance(s,
+                                                   t[k] + j * VEC_DIM_MAX) +
+                                 MIN3(col[(j-1) * 4 + k], up, diag[k]);
+                diag[k] = up;
+            }
+        }
+    }
+}
+
+Results *Session::recognize(Character *ch, unsigned int n_results) {
+    unsigned int i, m, q, size, char_id, n_common, n_best;
+    unsigned int first, last, next_first, next_last;
+    float *points, dist;
+    CharDist *best;
+    Recognizer *r = recognizer;
+
+    /* the band and the coarse pass depend on the whole writing */
+    if (r->band_width > 0 || (r->n_candidates > 0 && r->signature_length > 0))
+        return r->recognize(ch, n_results);
+
+    if (model_serial != r->model_serial) {
+        init_columns();
+        n_vectors = 0;
+    }
+
+    /* the columns computed for at most n_common vectors are still valid */
+    points = ch->get_points();
+    for (n_common=0; n_common < MIN(n_vectors, ch->get_n_vectors());
+         n_common++) {
+        if (memcmp(input + n_common * VEC_DIM_MAX,
+                   points + n_common * VEC_DIM_MAX,
+                   VEC_DIM_MAX * sizeof(float)) != 0)
+            break;
+    }
+
+    /* Columns computed for more vectors than that belong to another
+       writing, which may be older than the previous one if the quad
+       wasn't extended since */
+    for (q=0; q < (r->n_characters + 3) / 4; q++) {
+        if (n_done[q] > n_common)
+            n_done[q] = 0;
+    }
+
+    if (ch->get_n_vectors() > max_n_vectors) {
+        /* the previous input was already compared with the new one */
+        if (input) free(input);
+        max_n_vectors = ch->get_n_vectors();
+        input = (float *) memalign(16, max_n_vectors * VEC_DIM_MAX *
+                                       sizeof(float));
+    }
+
+    n_vectors = ch->get_n_vectors();
+    memcpy(input, points, n_vectors * VEC_DIM_MAX * sizeof(float));
+
+    r->get_template_range(ch->get_n_strokes(), &first, &last);
+
+    /* The columns of the templates which will be compared with the writing
+       once it has one more stroke are kept up to date as well, so that
+       they are ready when that stroke is added */
+    r->get_template_range(ch->get_n_strokes() + 1, &next_first, &next_last);
+
+    for (q=first / 4; q < (MAX(last, next_last) + 3) / 4; q++)
+        extend_columns(q);
+
+    best = (CharDist *) malloc(MAX(n_results, 1) * sizeof(CharDist));
+    n_best = 0;
+
+    for (char_id=first; char_id < last; char_id++) {
+        m = r->characters[char_id].n_vectors;
+        dist = m > 0 ? columns[column_offsets[char_id / 4] +
+                               (m - 1) * 4 + char_id % 4] : FLT_MAX;
+        char_dist_heap_add(best, &n_best, n_results,
+                           r->characters[char_id].unicode, dist);
+    }
+
+    qsort ((void *) best,
+           (size_t) n_best,
+           sizeof (CharDist),
+           (int (*) (const void *, const void*)) char_dist_cmp);
+
+    size = MIN(last - first, n_results);
+
+    Results *results = new Results(size);
+
+    for (i=0; i < size; i++)
+        results->add(i, best[i].unicode, best[i].dist);
+
+    free(best);
 
     return results;
 }
@@ -43,6 +43,9 @@ public:
     unsigned int get_n_vectors();
     unsigned int get_n_strokes();
     void set_value(unsigned int i, float value);
+    /* Returns false, leaving the points unset, if buffer doesn't hold
+       exactly n_vectors * VEC_DIM_MAX floats */
+    bool set_points(char *buffer, int length);
 
 private:
     float *points;
@@ -59,18 +62,79 @@ public:
 #ifndef SWIG
     /* This method is public but is not meant to be called from Python */ 
     void add(unsigned i, unsigned int unicode, float dist);
+#endif
+#ifndef SWIG
+    void set_n_pruned(unsigned int n);
 #endif
     unsigned int get_unicode(unsigned int i);
     float get_distance(unsigned int i);
     unsigned int get_size();
+    /* Number of templates that were discarded by the pruning search
+       before their DTW distance was fully computed */
+    unsigned int get_n_pruned();
 
 private:
     unsigned int *unicode;
     float *dist;
     unsigned int size;
+    unsigned int n_pruned;
+};
+
+/* Several characters whose vectors are stored one after the other in a
+   single buffer, so that they can be filled with one call. Characters must
+   be declared in order with set_character() before set_points() is
+   called. */
+class CharacterBatch {
+
+public:
+    CharacterBatch(unsigned int n_characters, unsigned int n_vectors);
+    ~CharacterBatch();
+
+    void set_character(unsigned int i,
+                       unsigned int n_vectors,
+                       unsigned int n_strokes);
+    /* Returns false, leaving the points unset, if buffer doesn't hold
+       exactly VEC_DIM_MAX floats for each of the n_vectors given to the
+       constructor */
+    bool set_points(char *buffer, int length);
+    unsigned int get_n_characters();
+#ifndef SWIG
+    float *get_points(unsigned int i);
+    unsigned int get_n_vectors(unsigned int i);
+    unsigned int get_n_strokes(unsigned int i);
+#endif
+
+private:
+    float *points;
+    unsigned int *offsets;
+    unsigned int *n_vectors;
+    unsigned int *n_strokes;
+    unsigned int n_characters;
+    unsigned int total_n_vectors;
+};
+
+/* The results of each character of a CharacterBatch. Results objects
+   belong to the batch. */
+class ResultsBatch {
+
+public:
+    ResultsBatch(unsigned int size);
+    ~ResultsBatch();
+
+#ifndef SWIG
+    void set(unsigned int i, Results *results);
+#endif
+    Results *get_results(unsigned int i);
+    unsigned int get_size();
+
+private:
+    Results **results;
+    unsigned int size;
 };
 
 #ifndef SWIG
+#define VEC_DIM_MAX 4
+
 typedef struct {
     unsigned int unicode;
     float dist;
@@ -88,6 +152,52 @@ typedef struct {
     char pad[4];
 } CharacterGroup;
 
+/* Header of the version 2 model format. Offsets are counted from the start
+   of the file. Every word of a version 2 model, header included, is a 32-bit
+   little-endian integer or float, so that on little-endian hosts the model
+   is used as it is mapped, without parsing. */
+typedef struct {
+    unsigned int magic;
+    unsigned int version;
+    unsigned int n_characters;
+    unsigned int n_groups;
+    unsigned int dimension;
+    unsigned int downsample_threshold;
+    unsigned int max_n_vectors;
+    /* CharacterInfo[n_characters] */
+    unsigned int characters_offset;
+    /* CharacterGroup[n_groups] */
+    unsigned int groups_offset;
+    /* offset of each template, unsigned int[n_characters] */
+    unsigned int template_offsets_offset;
+    /* TemplateBounds[n_characters], 16-byte aligned */
+    unsigned int template_bounds_offset;
+    /* templates, 16-byte aligned */
+    unsigned int templates_offset;
+    /* TEMPLATE_FLOAT32: vectors of VEC_DIM_MAX floats
+       TEMPLATE_INT8: vectors of dimension signed chars, each template
+       padded to a multiple of 4 bytes */
+    unsigned int template_format;
+    /* TEMPLATE_INT8 only, float[VEC_DIM_MAX]: a template value is its
+       quantized value times the scale of its dimension */
+    unsigned int template_scales_offset;
+    /* number of vectors of the coarse signature of each template,
+       0 if the model has no signatures */
+    unsigned int signature_length;
+    /* float[n_characters][signature_length][VEC_DIM_MAX], 16-byte aligned */
+    unsigned int signatures_offset;
+} ModelHeader;
+
+#define TEMPLATE_FLOAT32 0
+#define TEMPLATE_INT8 1
+
+/* Bounding box of the vectors of a template, used to compute a lower
+   bound of the DTW distance between the input and that template */
+typedef struct {
+    float min[VEC_DIM_MAX];
+    float max[VEC_DIM_MAX];
+} TemplateBounds;
+
 #ifdef __SSE__
 typedef union {
     __m128 v;
@@ -95,8 +205,57 @@ typedef union {
 } wg_v4sf;
 #endif
 
+/* DTW scratch buffers. Each worker thread owns one so that templates can
+   be compared with the input concurrently. */
+typedef struct {
+#ifdef __SSE__
+    wg_v4sf *dtw1v;
+    wg_v4sf *dtw2v;
+#endif
+    float *dtw1;
+    float *dtw2;
+    /* quantized templates are decoded here before being compared */
+    float *templates[4];
+} Workspace;
+
+class Recognizer;
+
+/* A contiguous range of templates to be compared with the input.
+   The n_results best templates of the range are kept in best, which is a
+   max-heap of n_best entries. */
+typedef struct {
+    Recognizer *recognizer;
+    Workspace *ws;
+    float *input;
+    unsigned int n_vectors;
+    /* if ids is not NULL, the templates are ids[first] to ids[last-1] */
+    unsigned int *ids;
+    unsigned int first;
+    unsigned int last;
+    CharDist *best;
+    unsigned int n_best;
+    unsigned int n_results;
+    unsigned int n_pruned;
+} ScoringTask;
+
+/* The characters first, first + step, first + 2*step... of a batch */
+typedef struct {
+    Recognizer *recognizer;
+    CharacterBatch *batch;
+    ResultsBatch *results;
+    unsigned int n_results;
+    unsigned int first;
+    unsigned int step;
+} BatchTask;
+
 #endif /* SWIG */
 
+class Session;
+
+/* Once a model is opened, the mapped model is only read, and each call to
+   recognize() uses its own scratch buffers. Therefore, recognize() can be
+   called from several threads at once. open() and the setters must not be
+   called concurrently with recognize(). */
 class Recognizer {
 
 public:
@@ -105,15 +264,37 @@ public:
 
     bool open(char *path);
     Results *recognize(Character *ch, unsigned int n_results);
+    ResultsBatch *recognize_batch(CharacterBatch *batch,
+                                  unsigned int n_results);
+    /* Index of the character of batch whose DTW distances to the other
+       characters have the smallest sum. Used by the trainer to choose
+       the template of a set of samples, no model needs be opened. */
+    unsigned int find_medoid(CharacterBatch *batch);
     unsigned int get_n_characters();
     unsigned int get_dimension();
     unsigned int get_window_size();
     void set_window_size(unsigned int size);
+    unsigned int get_band_width();
+    void set_band_width(unsigned int width);
+    unsigned int get_n_threads();
+    void set_n_threads(unsigned int n);
+    bool get_pruning();
+    void set_pruning(bool enabled);
+    /* With n > 0 and a model which has coarse signatures, only the n
+       templates whose signatures are the closest to that of the input are
+       compared with DTW */
+    unsigned int get_n_candidates();
+    void set_n_candidates(unsigned int n);
+    unsigned int get_signature_length();
     char *get_error_message();
 
 private:
+    friend class Session;
+
     GMappedFile *file;
     char *data;
+    /* byte-swapped copy of a version 2 model on big-endian hosts */
+    char *swapped_data;
 
     unsigned int n_characters;
     unsigned int n_groups;
@@ -126,26 +307,79 @@ private:
     CharacterInfo *characters;
     CharacterGroup *groups;
     float *strokedata;
+    unsigned int template_format;
+    float *template_scales;
+    unsigned int signature_length;
+    float *signatures;
+
+    /* offset of each template from the start of the file */
+    unsigned int *template_offsets;
+    TemplateBounds *template_bounds;
+    /* true if the two arrays above were computed when the model was
+       opened rather than read from it */
+    bool owns_index;
 
-#ifdef __SSE__
-    wg_v4sf *dtw1v;
-    wg_v4sf *dtw2v;
-#endif
+    char *error_msg;
 
-    float *dtw1;
-    float *dtw2;
+    unsigned int window_size;
+    unsigned int band_width;
+    unsigned int n_threads;
+    bool pruning;
+    unsigned int n_candidates;
 
-    char *error_msg;
+    unsigned int max_n_vectors;
+    GAsyncQueue *workspace_pool;
 
-    CharDist *distm;
+    /* incremented every time a model is opened */
+    unsigned int model_serial;
 
-    unsigned int window_size;
+    bool open_v1();
+    bool open_v2(gsize length);
+    void close_model();
 
     unsigned int get_max_n_vectors();
 
+    Workspace *new_workspace(unsigned int max_n_vectors);
+    void free_workspace(Workspace *ws);
+    Workspace *acquire_workspace();
+    void release_workspace(Workspace *ws);
+    void free_workspaces();
+
+    void get_template_range(unsigned int n_strokes,
+                            unsigned int *first,
+                            unsigned int *last);
+
+    void compute_template_bounds();
+
+    inline float lower_bound(float *s, unsigned int n, TemplateBounds *b);
+
+    inline float *get_template(unsigned int char_id, float *buf);
+
+    void compute_signature(float *points, unsigned int n_vectors,
+                           float *signature);
+    unsigned int *select_candidates(float *points,
+                                    unsigned int n_vectors,
+                                    unsigned int first,
+                                    unsigned int last,
+                                    unsigned int *n_ids);
+
+    void score_templates(ScoringTask *task);
+    static gpointer score_templates_thread(gpointer data);
+
+    Results *recognize_points(float *points,
+                              unsigned int n_vectors,
+                              unsigned int n_strokes,
+                              unsigned int n_results,
+                              unsigned int max_workers);
+
+    void recognize_batch_part(BatchTask *task);
+    static gpointer recognize_batch_thread(gpointer data);
+
     inline float local_distance(float *v1, float *v2);
 
-    inline float dtw(float *s, unsigned int n, float *t, unsigned int m);
+    inline float dtw(Workspace *ws,
+                     float *s, unsigned int n, float *t, unsigned int m,
+                     float threshold);
 
 #ifdef __SSE__
     inline wg_v4sf local_distance4(float *s,
@@ -154,15 +388,64 @@ private:
                                    float *t2,
                                    float *t3);
 
-    inline wg_v4sf dtw4(float *s, unsigned int n, 
+    inline wg_v4sf dtw4(Workspace *ws,
+                        float *s, unsigned int n, 
                         float *t0, unsigned int m0,
                         float *t1, unsigned int m1,
                         float *t2, unsigned int m2,
-                        float *t3, unsigned int m3);
+                        float *t3, unsigned int m3,
+                        float threshold);
 #endif
 
 };
 
+/* Recognizes a writing which grows stroke by stroke, e.g. while it is being
+   drawn. The session keeps the last DTW column of every template that it
+   compared with the writing. When the features of the writing start with
+   those of a previous call, only the new vectors are compared with these
+   templates, so that the time taken by each new stroke doesn't depend on
+   the number of strokes already drawn. Templates leave the comparisons as
+   soon as the writing has more strokes than they can match.
+
+   Results are the same as Recognizer::recognize(). Templates are compared
+   in the calling thread, without pruning. If the band width is non-zero or
+   if the coarse pass is enabled, the session just calls
+   Recognizer::recognize() since the band and the candidates of the coarse
+   pass depend on the whole writing. */
+class Session {
+
+public:
+    Session(Recognizer *recognizer);
+    ~Session();
+
+    Results *recognize(Character *ch, unsigned int n_results);
+    /* Forgets the previous writing */
+    void reset();
+
+private:
+    Recognizer *recognizer;
+    unsigned int model_serial;
+
+    /* the features of the previous writing */
+    float *input;
+    unsigned int n_vectors;
+    unsigned int max_n_vectors;
+
+    /* DTW column of each template, by groups of 4 templates (quads),
+       for the n_done[quad] first vectors of the previous writing, 0
+       meaning that the columns must be computed again */
+    float *columns;
+    unsigned int *column_offsets;
+    unsigned int *n_done;
+
+    /* quantized templates are decoded here, 4 at a time */
+    float *template_buf;
+
+    void free_columns();
+    void init_columns();
+    void extend_columns(unsigned int quad);
+};
+
 }
 
 #endif
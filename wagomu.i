@@ -1,8 +1,22 @@
-%module wagomu
+%module(threads="1") wagomu
 %{
 #include "wagomu.h"
 %}
 
+%include <pybuffer.i>
+
+/* Character::set_points and CharacterBatch::set_points take any object
+   exposing a buffer of packed native floats, e.g. array("f"). The length
+   isn't named size, which SWIG 3 pybuffer.i uses for a local variable. */
+%pybuffer_binary(char *buffer, int length);
+
 %newobject recognize;
+%newobject recognize_batch;
+
+/* Only release the GIL where the time is actually spent */
+%nothread;
+%thread wagomu::Recognizer::recognize;
+%thread wagomu::Recognizer::recognize_batch;
+%thread wagomu::Session::recognize;
 
-%include "wagomu.h"
\ No newline at end of file
+%include "wagomu.h"